@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import asyncio
+import collections
+import io
+import json
+import threading
+import types
+import urllib.error
+import urllib.parse
+import uuid
+
+from hypothesis.database.backend import Backend
+
+from .example_db import (
+    SETUP_MARKER_DIR,
+    CouchBackend,
+    basic_auth_header,
+    deletion_stubs,
+    example_doc,
+    example_id,
+    format_key,
+    outdated_ddoc,
+    read_setup_marker,
+    setup_marker_path,
+    url,
+    value_encodings,
+    write_setup_marker,
+)
+
+
+__all__ = (
+    'AsyncCouchBackend',
+    'AsyncConnectionPool',
+    'SyncCouchBackend',
+)
+
+
+#: Makes generator based coroutines, which run on Python 3.4 as well.
+#: :func:`asyncio.coroutine` is deprecated since Python 3.5 in favor of
+#: :func:`types.coroutine`, so that one is taken where available.
+coroutine = getattr(types, 'coroutine', None) or asyncio.coroutine
+
+
+class AsyncCouchBackend(object):
+    """Asyncio flavor of :class:`~hypothesis_couchdb.example_db.CouchBackend`.
+
+    All the methods are coroutines, which may run concurrently: each one
+    takes its own connection from the pool, so up to `pool_size` requests
+    are in flight at the same time. With `timeout` (in seconds) requests
+    fail with :exc:`asyncio.TimeoutError` if they take longer than that.
+    With `packed` it takes values of
+    :class:`~hypothesis_couchdb.example_db.PackedFormat`. Database setup is
+    verified and noted in `setup_marker_dir` the same way the blocking
+    backend does it, so both share their markers.
+    """
+
+    # The design document is the same as the blocking backend uses.
+    ddoc = CouchBackend.ddoc
+
+    def __init__(self, dburl: str, basic_auth_credentials: tuple=None,
+                 pool_size: int=10,
+                 timeout: float=None,
+                 content_ids: bool=False,
+                 packed: bool=False,
+                 setup_marker_dir: str=SETUP_MARKER_DIR):
+        assert dburl.startswith(('http://', 'https://'))
+        self.url = dburl
+        self.packed = packed
+        self.pool = AsyncConnectionPool(dburl, maxsize=pool_size,
+                                        timeout=timeout)
+        self.content_ids = content_ids
+        self.headers = {'Accept': 'application/json',
+                        'Content-Type': 'application/json'}
+        if basic_auth_credentials:
+            self.headers['Authorization'] = basic_auth_header(
+                *basic_auth_credentials)
+        self.setup_marker_dir = setup_marker_dir
+        self._ensured_setup = False
+        self._setup_lock = None
+
+    def data_type(self):
+        return str if self.packed else list
+
+    @coroutine
+
+    def save(self, key: str, value: list):
+        yield from self._ensure_setup()
+
+        if self.content_ids:
+            docid = example_id(format_key(key), value)
+        else:
+            docid = str(uuid.uuid4())
+        doc = example_doc(docid, format_key(key), value)
+
+        try:
+            yield from request(
+                method='PUT',
+                url=url(self.url, docid),
+                data=json.dumps(doc).encode(),
+                headers=self.headers,
+                pool=self.pool)
+        except urllib.error.HTTPError as err:
+            if err.code != 409 or not self.content_ids:
+                raise
+
+    @coroutine
+
+    def delete(self, key: str, value: list):
+        yield from self._ensure_setup()
+
+        values = value_encodings(value)
+        if self.content_ids:
+            docids = [example_id(format_key(key), value) for value in values]
+        else:
+            result = yield from request(
+                method='GET',
+                url=url(self.url, '_design', 'hypothesis', '_view', 'by_key',
+                        reduce='false',
+                        key=json.dumps(format_key(key))),
+                headers=self.headers,
+                pool=self.pool)
+            docids = [row['id'] for row in result['rows']
+                      if row['value'] in values]
+        if not docids:
+            return
+
+        result = yield from request(
+            method='POST',
+            url=url(self.url, '_all_docs'),
+            data=json.dumps({'keys': docids}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+
+        stubs = deletion_stubs(result['rows'])
+        if not stubs:
+            return
+
+        yield from request(
+            method='POST',
+            url=url(self.url, '_bulk_docs'),
+            data=json.dumps({'docs': stubs}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+
+    @coroutine
+
+    def fetch(self, key: str) -> list:
+        yield from self._ensure_setup()
+
+        result = yield from request(
+            method='GET',
+            url=url(self.url, '_design', 'hypothesis', '_view', 'by_key',
+                    reduce='false',
+                    key=json.dumps(format_key(key))),
+            headers=self.headers,
+            pool=self.pool)
+
+        return [row['value'] for row in result['rows']]
+
+    @coroutine
+
+    def close(self):
+        self.pool.close()
+        # Nothing to wait for, but it's a coroutine as the other methods.
+        yield from ()
+
+    @coroutine
+
+    def _ensure_setup(self):
+        if self._ensured_setup:
+            return
+
+        # Locks are bound to the event loop, so it's created on first use
+        # within the loop which runs this backend.
+        if self._setup_lock is None:
+            self._setup_lock = asyncio.Lock()
+
+        yield from self._setup_lock.acquire()
+        try:
+            if self._ensured_setup:
+                return
+            marker = setup_marker_path(self.setup_marker_dir, self.url,
+                                       self.ddoc())
+            rev = read_setup_marker(marker) if marker else None
+            if rev is None or (yield from self._ddoc_rev()) != rev:
+                rev = yield from self._setup()
+                if marker:
+                    write_setup_marker(marker, rev)
+            self._ensured_setup = True
+        finally:
+            self._setup_lock.release()
+
+    @coroutine
+
+    def _ddoc_rev(self) -> str:
+        """Returns current design document revision without fetching it."""
+        try:
+            headers = yield from self.pool.head(
+                url(self.url, '_design', 'hypothesis'), self.headers)
+        except urllib.error.HTTPError as err:
+            if err.code != 404:
+                raise
+            return None
+        return headers.get('etag', '').strip('"') or None
+
+    @coroutine
+
+    def _setup(self) -> str:
+        """Creates database and design document or updates the last one if
+        it's outdated. Returns the verified design document revision."""
+        try:
+            remote_ddoc = yield from request(
+                'GET', url(self.url, '_design', 'hypothesis'),
+                headers=self.headers,
+                pool=self.pool)
+        except urllib.error.HTTPError as err:
+            if err.code != 404:
+                raise
+            remote_ddoc = None
+
+        ddoc = outdated_ddoc(self.ddoc(), remote_ddoc)
+        if ddoc is None:
+            return remote_ddoc['_rev']
+
+        if remote_ddoc is None:
+            # Missing database is also reported as missing document.
+            try:
+                yield from request('PUT', url(self.url),
+                                   headers=self.headers,
+                                   pool=self.pool)
+            except urllib.error.HTTPError as err:
+                if err.code != 412:
+                    raise
+
+        result = yield from request('PUT',
+                                    url(self.url, '_design', 'hypothesis'),
+                                    data=json.dumps(ddoc).encode(),
+                                    headers=self.headers,
+                                    pool=self.pool)
+        return result['rev']
+
+
+class SyncCouchBackend(Backend):
+    """Blocking adapter for :class:`AsyncCouchBackend` to use it with
+    Hypothesis example database::
+
+        CouchExampleDB(backend_class=SyncCouchBackend)
+
+    The async backend runs within own event loop in a background thread, so
+    the adapter is safe to use from any thread, including the ones which
+    already run an event loop.
+    """
+
+    def __init__(self, dburl: str, basic_auth_credentials: tuple=None,
+                 **options):
+        self.backend = AsyncCouchBackend(dburl, basic_auth_credentials,
+                                         **options)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def data_type(self):
+        return self.backend.data_type()
+
+    def save(self, key: str, value: list):
+        self._run(self.backend.save(key, value))
+
+    def delete(self, key: str, value: list):
+        self._run(self.backend.delete(key, value))
+
+    def fetch(self, key: str) -> list:
+        return self._run(self.backend.fetch(key))
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        try:
+            self._run(self.backend.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class AsyncConnectionPool(object):
+    """Pool of keep-alive HTTP/1.1 connections over asyncio streams.
+
+    Unlike blocking :class:`~hypothesis_couchdb.example_db.ConnectionPool`
+    it also limits amount of simultaneously open connections by `maxsize`:
+    extra requests wait for a free connection. Waiting for it counts towards
+    `timeout` of the request.
+    """
+
+    def __init__(self, url: str, maxsize: int=10, timeout: float=None):
+        if maxsize < 1:
+            raise ValueError('Pool size must be positive')
+        parts = urllib.parse.urlsplit(url)
+        self.ssl = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = collections.deque()
+        self._slots = None
+
+    @coroutine
+
+    def acquire(self) -> tuple:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxsize)
+        yield from self._slots.acquire()
+        if self._idle:
+            return self._idle.pop(), True
+        try:
+            connection = yield from asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl)
+        except BaseException:
+            # Cancellation on timeout must free the slot as well.
+            self._slots.release()
+            raise
+        return connection, False
+
+    def release(self, connection: tuple, reusable: bool=True):
+        if reusable:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+        self._slots.release()
+
+    @coroutine
+
+    def urlopen(self, method: str, url: str, headers: dict,
+                      data: bytes=None) -> bytes:
+        """Makes HTTP request and returns response body.
+
+        Raises :exc:`urllib.error.HTTPError` for error responses just like
+        :func:`urllib.request.urlopen` does.
+        """
+        _, body = yield from self._with_timeout(
+            self._urlopen(method, url, headers, data))
+        return body
+
+    @coroutine
+
+    def head(self, url: str, headers: dict) -> dict:
+        """Makes ``HEAD`` request and returns response headers, which names
+        are lowercased."""
+        response_headers, _ = yield from self._with_timeout(
+            self._urlopen('HEAD', url, headers))
+        return response_headers
+
+    @coroutine
+
+    def _with_timeout(self, coro):
+        if self.timeout is None:
+            return (yield from coro)
+        return (yield from asyncio.wait_for(coro, self.timeout))
+
+    @coroutine
+
+    def _urlopen(self, method: str, url: str, headers: dict,
+                       data: bytes=None) -> tuple:
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        head = ['%s %s HTTP/1.1' % (method, path),
+                'Host: %s:%d' % (self.host, self.port),
+                'Content-Length: %d' % len(data or b'')]
+        head.extend('%s: %s' % item for item in headers.items())
+        message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+        message += data or b''
+
+        while True:
+            connection, reused = yield from self.acquire()
+            reader, writer = connection
+            try:
+                writer.write(message)
+                status, reason, response_headers, body, will_close = (
+                    yield from read_response(reader, method))
+            except BaseException as err:
+                self.release(connection, reusable=False)
+                # Server may close idle keep-alive connection at any moment,
+                # so only fresh connection failure is a real one.
+                if reused and isinstance(err, (ConnectionError,
+                                               asyncio.IncompleteReadError)):
+                    continue
+                raise
+            self.release(connection, reusable=not will_close)
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason,
+                                             response_headers,
+                                             io.BytesIO(body))
+            return response_headers, body
+
+    def close(self):
+        """Closes all idle connections. The pool remains usable after."""
+        idle, self._idle = self._idle, collections.deque()
+        for _, writer in idle:
+            writer.close()
+
+
+@coroutine
+
+
+def request(method: str, url: str, headers: dict, data: bytes=None,
+                  pool: AsyncConnectionPool=None) -> dict:
+    if pool is None:
+        pool = AsyncConnectionPool(url, maxsize=1)
+        try:
+            body = yield from pool.urlopen(method, url, headers, data)
+        finally:
+            pool.close()
+    else:
+        body = yield from pool.urlopen(method, url, headers, data)
+    return json.loads(body.decode('utf-8'))
+
+
+@coroutine
+
+
+def read_response(reader: asyncio.StreamReader,
+                        method: str) -> tuple:
+    """Reads HTTP response from the stream. Returns status code, reason,
+    headers, body and whenever connection should be closed after."""
+    line = yield from reader.readline()
+    if not line:
+        raise ConnectionResetError('Connection closed by server')
+    version, status, reason = (line.decode('latin-1').rstrip('\r\n')
+                               .split(' ', 2) + [''])[:3]
+    status = int(status)
+
+    headers = {}
+    while True:
+        line = yield from reader.readline()
+        if line in (b'\r\n', b'\n'):
+            break
+        if not line:
+            raise ConnectionResetError('Connection closed by server')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    will_close = (version == 'HTTP/1.0'
+                  or headers.get('connection', '').lower() == 'close')
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((yield from reader.readline()).split(b';')[0], 16)
+            if not size:
+                break
+            chunks.append((yield from reader.readexactly(size)))
+            yield from reader.readexactly(2)
+        # Skip trailers.
+        while (yield from reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = yield from reader.readexactly(int(headers['content-length']))
+    else:
+        body = yield from reader.read()
+        will_close = True
+    return status, reason, headers, body, will_close
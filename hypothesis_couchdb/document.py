@@ -13,6 +13,8 @@
 # the License.
 #
 
+import collections.abc
+
 import hypothesis.strategies as st
 
 from . import json
@@ -20,6 +22,9 @@ from . import json
 
 __all__ = (
     'documents',
+    'encoded_documents',
+    'batches',
+    'EncodedDocument',
     'id',
     'rev',
     'deleted',
@@ -29,14 +34,163 @@ __all__ = (
 
 HEXDIGITS = '1234567890abcdef'
 
+#: Strategy for values of random document fields unless other is given.
+RANDOM_FIELDS = json.values()
+
 
 def documents(required_fields=None,
               optional_fields=None,
-              random_fields=json.values()):
-    """Generates various JSON documents as `dict` instances."""
+              random_fields=RANDOM_FIELDS,
+              *,
+              max_depth=None,
+              max_leaves=None,
+              max_encoded_bytes=None):
+    """Generates various JSON documents as `dict` instances.
+
+    With `max_encoded_bytes` set to CouchDB ``max_document_size`` documents
+    are generated small enough to be stored. Fields which don't fit into
+    this and other limits are left out, as ``json.objects`` does. Random
+    fields of ``json.values`` (the default ones) are built then within what
+    the limits leave, so that nothing is generated in vain.
+    """
     return json.objects(required_fields=required_fields,
                         optional_fields=optional_fields,
-                        elements=random_fields)
+                        elements=random_fields,
+                        max_depth=max_depth,
+                        max_leaves=max_leaves,
+                        max_encoded_bytes=max_encoded_bytes)
+
+
+def encoded_documents(required_fields=None,
+                      optional_fields=None,
+                      random_fields=RANDOM_FIELDS,
+                      *,
+                      max_depth=None,
+                      max_leaves=None,
+                      max_encoded_bytes=None):
+    """Generates the same documents as :func:`documents` does, but as
+    read-only :class:`EncodedDocument` instances which carry their JSON."""
+    return documents(required_fields=required_fields,
+                     optional_fields=optional_fields,
+                     random_fields=random_fields,
+                     max_depth=max_depth,
+                     max_leaves=max_leaves,
+                     max_encoded_bytes=max_encoded_bytes).map(EncodedDocument)
+
+
+def batches(size=None, *,
+            min_size=None,
+            average_size=None,
+            max_size=None,
+            docs=None,
+            ids=None,
+            with_rev=False,
+            with_deleted=False):
+    """Generates lists of documents for ``_bulk_docs`` requests, exactly
+    `size` of them or as many as `min_size`, `average_size` and `max_size`
+    allow.
+
+    Documents are drawn from `docs` (small :func:`documents` by default) and
+    get ``_id`` from `ids` (:func:`id` by default). Ids are made unique by
+    construction: repeated ones get ``-N`` suffix, so nothing gets rejected
+    and batches of thousands documents are generated in linear time. The
+    suffix is added regardless of constraints of `ids`, so such ids may be
+    longer than its `max_size` and have ``-`` and digits out of its
+    `alphabet`.
+    With `with_rev` and `with_deleted` documents may have ``_rev`` and
+    ``_deleted`` fields too.
+    """
+    if size is not None:
+        min_size = max_size = size
+    docs = documents(max_leaves=10) if docs is None else docs
+    ids = id() if ids is None else ids
+    revs = st.just(json.ABSENT) | rev() if with_rev else st.just(json.ABSENT)
+    deletions = (st.just(json.ABSENT) | deleted() if with_deleted
+                 else st.just(json.ABSENT))
+
+    def build(items):
+        batch = []
+        docids = unique_ids(docid for docid, _, _, _ in items)
+        for docid, (_, doc, revision, is_deleted) in zip(docids, items):
+            # Drawn document may be shared, so it's copied.
+            doc = dict(doc, _id=docid)
+            if revision is not json.ABSENT:
+                doc['_rev'] = revision
+            if is_deleted is not json.ABSENT:
+                doc['_deleted'] = is_deleted
+            batch.append(doc)
+        return batch
+
+    return st.lists(st.tuples(ids, docs, revs, deletions),
+                    min_size=min_size,
+                    average_size=average_size,
+                    max_size=max_size).map(build)
+
+
+def unique_ids(ids):
+    """Yields given `ids` making them unique: repeated ones get ``-N``
+    suffix with the least `N` not taken yet, whatever alphabet and size the
+    ids have."""
+    seen = set()
+    counters = {}
+    for docid in ids:
+        unique = docid
+        while unique in seen:
+            counters[docid] = counters.get(docid, 0) + 1
+            unique = '{}-{}'.format(docid, counters[docid])
+        seen.add(unique)
+        yield unique
+
+
+class EncodedDocument(collections.abc.Mapping):
+    """Read-only document which is encoded to canonical JSON (see
+    ``json.encode``) once, when it's asked for the first time. The same
+    bytes are returned afterwards, so sending the document again costs no
+    serialization.
+
+    Nested values are shared with the original `dict`, so they must not be
+    changed either.
+    """
+
+    __slots__ = ('_fields', '_encoded')
+
+    def __init__(self, fields: dict):
+        self._fields = fields
+        self._encoded = None
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self._fields)
+
+    def __bytes__(self):
+        return self.encoded
+
+    @property
+    def encoded(self) -> bytes:
+        """Canonical UTF-8 JSON of the document."""
+        if self._encoded is None:
+            self._encoded = json.encode(self._fields)
+        return self._encoded
+
+    def view(self) -> memoryview:
+        """Returns :func:`memoryview` of :attr:`encoded` JSON, which slices
+        it without copying."""
+        return memoryview(self.encoded)
+
+    def copy(self) -> dict:
+        """Returns shallow copy of the document as a regular `dict`."""
+        return dict(self._fields)
 
 
 def id(*, alphabet=None, min_size=1, average_size=None, max_size=None):
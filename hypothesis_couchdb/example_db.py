@@ -14,29 +14,140 @@
 #
 
 import base64
+import codecs
+import collections
+import contextlib
+import gzip
+import hashlib
+import http.client
+import io
 import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
 import uuid
+import zlib
 
 from hypothesis.database import ExampleDatabase
 from hypothesis.database.backend import Backend
 from hypothesis.database.formats import Format
+from hypothesis.errors import BadData
+
+from .instrumentation import (
+    Instrumentation,
+    instrumented,
+)
 
 
 __all__ = (
     'CouchExampleDB',
     'BasicFormat',
+    'PackedFormat',
     'CouchBackend',
+    'ConnectionPool',
+    'FetchCache',
+    'ETagCache',
+    'MirroredCouchBackend',
+    'SpooledCouchBackend',
+    'FallbackBackend',
 )
 
 
+#: Amount of bytes to read from socket at once for streamed responses.
+STREAM_CHUNK_SIZE = 65536
+
+#: Marks beginning of rows array in view response.
+ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+
+#: Where verified database setup is noted to share it between processes.
+SETUP_MARKER_DIR = os.path.join(tempfile.gettempdir(), 'hypothesis-couchdb')
+
+#: Where :class:`SpooledCouchBackend` spools writes of all the processes on
+#: the machine, in a subdirectory per database.
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'hypothesis-couchdb-spool')
+
+#: How long, in milliseconds, a single ``_changes`` long poll request waits
+#: for updates before it gets restarted.
+CHANGES_TIMEOUT = 30000
+
+#: How many ``_changes`` feed results to pull with a single request.
+CHANGES_BATCH_SIZE = 1000
+
+#: How many documents to take with a single ``_find`` request.
+FIND_BATCH_SIZE = 1000
+
+#: How many documents to move with a single request on migration.
+MIGRATE_BATCH_SIZE = 1000
+
+#: How many keys to prune with a single request.
+PRUNE_BATCH_SIZE = 100
+
+#: Starts every packed value. Base64 never starts with it, and neither do
+#: integers which Hypothesis stores as decimal strings, so packed values are
+#: told apart from plain ones stored with :class:`BasicFormat`.
+PACKED_PREFIX = '~'
+
+#: Ways to look examples up by key, see :class:`CouchBackend`.
+LOOKUPS = ('view', 'find')
+
+#: Whenever reads update the index first, see :class:`CouchBackend`.
+VIEW_UPDATES = ('true', 'false', 'lazy')
+
+#: Mango selector of all the examples. Keys are arrays of strings, which all
+#: sort between these two.
+ALL_KEYS = {'key': {'$gte': [], '$lte': [{}]}}
+
+#: Request bodies smaller than that, in bytes, are sent as is. Smaller
+#: example documents fit a single TCP segment anyway while compression of
+#: any body costs about the same ~75us for zlib state setup and shrinks
+#: them by a few bytes only (see ``benchmark --compression``).
+COMPRESSION_THRESHOLD = 1400
+
+#: Level 1 is several times faster than the default 6 on examples of
+#: thousands of integers while the result is just ~10% bigger.
+COMPRESSION_LEVEL = 1
+
+
 class CouchExampleDB(ExampleDatabase):
+    """Hypothesis example database which stores examples in CouchDB.
+
+    Extra keyword arguments are passed to `backend_class`, which is
+    :class:`CouchBackend` by default.
+
+    With `budget` or `max_failures` the backend is wrapped with
+    :class:`FallbackBackend`, so slow or unavailable server doesn't fail or
+    hang the test run.
+
+    With `packed` examples are stored in compact :class:`PackedFormat`.
+    Examples stored before as plain lists remain readable.
+    """
+
     def __init__(self,
                  dburl: str='http://localhost:5984/hypothesis',
-                 basic_auth_credentials: tuple=None):
-        backend = CouchBackend(dburl, basic_auth_credentials)
-        format = BasicFormat()
+                 basic_auth_credentials: tuple=None,
+                 backend_class: type=None,
+                 budget: float=None,
+                 max_failures: int=None,
+                 retry_interval: float=30,
+                 packed: bool=False,
+                 **backend_options):
+        backend_class = backend_class or CouchBackend
+        if packed:
+            backend_options['packed'] = True
+        backend = backend_class(dburl, basic_auth_credentials,
+                                **backend_options)
+        if budget is not None or max_failures is not None:
+            backend = FallbackBackend(backend, budget=budget,
+                                      max_failures=max_failures,
+                                      retry_interval=retry_interval)
+        format = PackedFormat() if packed else BasicFormat()
         super().__init__(backend, format)
 
 
@@ -51,17 +162,183 @@ class BasicFormat(Format):
         return data
 
 
+class PackedFormat(Format):
+    """Packs examples into base64 encoded strings of varints (see
+    :func:`pack_value`), which are several times smaller than JSON lists of
+    integers. Plain values stored with :class:`BasicFormat`, strings
+    included, are passed through as is. Undecodable packed values raise
+    :exc:`~hypothesis.errors.BadData`, so they are skipped on fetch."""
+
+    def data_type(self):
+        return str
+
+    def serialize_basic(self, value) -> str:
+        return pack_value(value)
+
+    def deserialize_data(self, data):
+        if is_packed(data):
+            return unpack_value(data)
+        return data
+
+
 class CouchBackend(Backend):
-    def __init__(self, dburl: str, basic_auth_credentials: tuple=None):
+    """Stores examples as CouchDB documents.
+
+    When `batch_size` or `flush_interval` is specified, saved examples are
+    buffered in memory and get sent with a single ``_bulk_docs`` request once
+    the buffer holds `batch_size` examples, `flush_interval` seconds passed
+    since the first buffered one or on :meth:`flush` and :meth:`close` calls.
+
+    With `content_ids` examples are stored under ids derived from their key
+    and value (see :func:`example_id`), so saving the same example twice
+    keeps a single document and deletion doesn't need to query the view.
+    Databases that already hold examples with random ids have to be converted
+    once with :meth:`migrate`.
+
+    With `prefetch` the first fetch of a key loads examples of all the keys
+    sharing the same prefix (all but the last key segment, e.g. test module
+    or class) with a single view request. Further fetches under that prefix
+    are served from memory. Examples saved by other processes after that
+    moment are not seen until the backend is closed.
+
+    With `cache_size` fetched examples of up to that amount of keys are kept
+    in memory. A background thread follows the database ``_changes`` feed and
+    evicts the keys that were updated by anyone, so the cache stays valid
+    while others write to the same database.
+
+    With `etag_cache_bytes` parsed view responses are kept in memory up to
+    that total size of their bodies along with their ETags. Repeated reads are
+    made conditional with ``If-None-Match`` header, so when nothing changed
+    the server answers ``304 Not Modified`` and the kept rows are reused
+    instead of downloading and parsing them again.
+
+    With `stream` :meth:`fetch` returns generator of values which are parsed
+    from the view response as they come from the socket, so memory usage
+    doesn't depend on amount of examples stored for a key. Streaming is not
+    used when fetched examples are cached or prefetched.
+
+    With `timeout` (in seconds) requests fail with :exc:`socket.timeout`
+    instead of waiting for unresponsive server forever.
+
+    By default examples are looked up with ``by_key`` JavaScript view. With
+    ``lookup='find'`` they are queried with ``_find`` over Mango index on
+    their key instead, which CouchDB builds natively without JavaScript
+    query server and without copying example values into the index. The view
+    is not created then, but it's kept if other clients use it. Streaming is
+    not used with that lookup.
+
+    By default every read waits until CouchDB brings the index up to date,
+    which takes a while after a burst of writes. With ``view_update='false'``
+    reads take the index as is, and with ``view_update='lazy'`` CouchDB also
+    updates it after the response is sent (CouchDB 2.1+ ``update``
+    parameter). Mango index can't be updated lazily, so that is the same as
+    ``'false'`` for ``lookup='find'``. Either way, fetched examples may miss
+    the latest writes. With `warmup` the index is updated in a background
+    thread after writes, so it's fresh by the time of following reads.
+
+    Examples are stored along with their save time. With `max_examples`
+    keys found to hold more examples than that on fetch are pruned on
+    :meth:`close` with a single bulk request (see :meth:`prune`), dropping
+    the oldest examples. With `max_age` all the fetched keys which hold any
+    examples are pruned as well, dropping the ones saved more than that
+    seconds ago.
+    The whole database is pruned with ``hypothesis_couchdb.maintenance``
+    tool.
+
+    With `packed` the backend takes values of :class:`PackedFormat`. Either
+    way, deleted value matches the same example stored in other format.
+
+    With `compression` gzip and deflate encoded responses are accepted and
+    request bodies of at least :data:`COMPRESSION_THRESHOLD` bytes, such as
+    big examples or ``_bulk_docs`` batches, are sent gzip compressed.
+
+    Once database and design document are verified, their revision is noted
+    in `setup_marker_dir`, so other processes on the same machine check them
+    with a single ``HEAD`` request. Pass ``None`` to disable that.
+
+    Pass :class:`~hypothesis_couchdb.instrumentation.Instrumentation` as
+    `instrumentation` to collect calls, latency, traffic and response statuses
+    of each operation. Its report is dumped on :meth:`close`.
+    """
+
+    def __init__(self, dburl: str, basic_auth_credentials: tuple=None,
+                 pool_size: int=10,
+                 timeout: float=None,
+                 compression: bool=False,
+                 batch_size: int=None,
+                 flush_interval: float=None,
+                 content_ids: bool=False,
+                 prefetch: bool=False,
+                 cache_size: int=None,
+                 etag_cache_bytes: int=None,
+                 stream: bool=False,
+                 packed: bool=False,
+                 lookup: str='view',
+                 view_update: str='true',
+                 warmup: bool=False,
+                 max_examples: int=None,
+                 max_age: float=None,
+                 setup_marker_dir: str=SETUP_MARKER_DIR,
+                 instrumentation: Instrumentation=None):
         assert dburl.startswith(('http://', 'https://'))
+        if lookup not in LOOKUPS:
+            raise ValueError('Unknown lookup %r' % (lookup,))
+        if view_update not in VIEW_UPDATES:
+            raise ValueError('Unknown view update mode %r' % (view_update,))
         self.url = dburl
+        self.lookup = lookup
+        self.view_update = view_update
+        self.warmup = warmup
+        self.max_examples = max_examples
+        self.max_age = max_age
+        #: Formatted keys to prune on close: the ones which hold more than
+        #: `max_examples` examples or, with `max_age`, any examples.
+        self.oversized = set()
+        self._warmer = None
+        self._warmup_requested = False
+        self._warmup_lock = threading.Lock()
+        self.timeout = timeout
+        self.packed = packed
+        self.pool = ConnectionPool(
+            dburl, maxsize=pool_size, timeout=timeout,
+            compress_threshold=COMPRESSION_THRESHOLD if compression else None)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.content_ids = content_ids
+        self.prefetch = prefetch
+        self._snapshot = {}
+        self._snapshot_lock = threading.RLock()
+        self.cache = FetchCache(cache_size) if cache_size else None
+        self.etags = ETagCache(etag_cache_bytes) if etag_cache_bytes else None
+        self.stream = stream
+        # Long poll requests are expected to wait for changes that long.
+        self._changes_pool = ConnectionPool(
+            dburl, maxsize=1,
+            timeout=(None if timeout is None
+                     else timeout + CHANGES_TIMEOUT / 1000))
+        self._watcher = None
+        self._watcher_stop = None
+        self._pending = []
+        # Docs which are being sent by flush, still visible for fetches.
+        self._sending = []
+        self._pending_lock = threading.RLock()
+        # Keeps flushes in order and lets deletes wait for sent docs.
+        self._flush_lock = threading.Lock()
+        self._flush_timer = None
+        #: The last error of flush made on timer, if any.
+        self.flush_error = None
         self.headers = {'Accept': 'application/json',
                         'Content-Type': 'application/json'}
+        if compression:
+            self.headers['Accept-Encoding'] = 'gzip, deflate'
         if basic_auth_credentials:
             self.headers['Authorization'] = basic_auth_header(
                 *basic_auth_credentials)
-        self._ensured_db_exists = False
-        self._ensured_ddoc_exists = False
+        self.setup_marker_dir = setup_marker_dir
+        self._ensured_setup = False
+        self.instrumentation = instrumentation
+        self.pool.instrumentation = instrumentation
+        self._changes_pool.instrumentation = instrumentation
 
     def ddoc(self) -> dict:
         return {
@@ -85,7 +362,8 @@ function(newdoc, olddoc){
   assert(isArray(newdoc.key));
   assert(newdoc.value === null
          || !isNaN(newdoc.value)
-         || isArray(newdoc.value));
+         || isArray(newdoc.value)
+         || typeof newdoc.value === 'string');
 }''',
             'views': {
                 'by_key': {
@@ -95,102 +373,1668 @@ function(newdoc, olddoc){
             }
         }
 
+    def find_index(self) -> dict:
+        """Returns Mango index definition for ``lookup='find'``."""
+        return {'index': {'fields': ['key']},
+                'ddoc': 'hypothesis-find',
+                'name': 'by_key',
+                'type': 'json'}
+
     def data_type(self):
-        return list
+        return str if self.packed else list
 
+    @property
+    def buffered(self) -> bool:
+        return self.batch_size is not None or self.flush_interval is not None
+
+    @property
+    def pruning(self) -> bool:
+        """Whether examples are pruned by their save time."""
+        return self.max_examples is not None or self.max_age is not None
+
+    @instrumented('save')
     def save(self, key: str, value: list):
-        self._ensure_setup()
+        doc = example_doc(self._doc_id(format_key(key), value),
+                          format_key(key), value)
 
-        request(
-            method='PUT',
-            url=url(self.url, str(uuid.uuid4())),
-            data=json.dumps({'key': format_key(key),
-                             'value': value,
-                             'type': 'example'}).encode(),
-            headers=self.headers)
+        if self.buffered:
+            self._buffer(doc)
+        else:
+            self._ensure_setup()
+
+            try:
+                request(
+                    method='PUT',
+                    url=url(self.url, doc['_id']),
+                    data=json.dumps(doc).encode(),
+                    headers=self.headers,
+                    pool=self.pool)
+            except urllib.request.HTTPError as err:
+                # Content derived id is taken: this example is already stored.
+                if err.code != 409 or not self.content_ids:
+                    raise
+                if self.pruning:
+                    self._refresh_docs([doc])
+            else:
+                self._warm_up()
+
+        self._snapshot_add(doc)
+        if self.cache is not None:
+            self.cache.invalidate([doc['key']])
+
+    @instrumented('flush')
+    def flush(self):
+        """Sends all buffered examples to the server. The buffer isn't locked
+        meanwhile, so saves and fetches don't wait for the server."""
+        with self._flush_lock:
+            with self._pending_lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+
+                if not self._pending:
+                    return
+                docs, self._pending = self._pending, []
+                self._sending = docs
+
+            try:
+                self._ensure_setup()
+                self._save_docs(docs)
+            except Exception:
+                with self._pending_lock:
+                    self._pending[:0] = docs
+                raise
+            finally:
+                with self._pending_lock:
+                    self._sending = []
+
+            self._warm_up()
+            if self.cache is not None:
+                self.cache.invalidate([doc['key'] for doc in docs])
 
+    @instrumented('delete')
     def delete(self, key: str, value: list):
+        values = value_encodings(value)
+        with self._pending_lock:
+            self._pending = [doc for doc in self._pending
+                             if doc['key'] != format_key(key)
+                             or doc['value'] not in values]
+        self._snapshot_discard(format_key(key), values)
+        if self.cache is not None:
+            self.cache.invalidate([format_key(key)])
+
+        # Examples which flush is sending meanwhile get deleted after.
+        with self._flush_lock:
+            self._ensure_setup()
+
+            if self.content_ids:
+                self._delete_docs([self._doc_id(format_key(key), value)
+                                   for value in values])
+                return
+
+            self._delete_docs([row['id'] for row in self._fetch_rows(key)
+                               if row['value'] in values])
+
+    @instrumented('fetch')
+    def fetch(self, key: str) -> list:
+        if self.prefetch:
+            values = self._fetch_prefetched(format_key(key))
+            self._note_size(key, len(values))
+            return values
+
+        # Pending docs are taken first: the ones flushed meanwhile are known
+        # by id and not returned twice.
+        pending = self._pending_docs(key)
+
         self._ensure_setup()
 
+        if self.stream and self.cache is None and self.lookup == 'view':
+            return self._stream_fetch(key, pending)
+
+        if self.cache is not None:
+            self._ensure_watcher()
+            rows = self.cache.get(format_key(key))
+            generation = self.cache.generation
+            if rows is None:
+                rows = self._fetch_rows(key)
+                self.cache.put(format_key(key), rows, generation)
+        else:
+            rows = self._fetch_rows(key)
+
+        stored = {row['id'] for row in rows}
+        values = [row['value'] for row in rows] + [
+            doc['value'] for doc in pending if doc['_id'] not in stored]
+        self._note_size(key, len(values))
+        return values
+
+    def close(self):
+        with self._snapshot_lock:
+            self._snapshot.clear()
+        if self._watcher_stop is not None:
+            self._watcher_stop.set()
+            self._watcher = self._watcher_stop = None
+        if self.cache is not None:
+            self.cache.clear()
+        if self.etags is not None:
+            self.etags.clear()
+        try:
+            self.flush()
+            if self.oversized:
+                self.prune()
+        finally:
+            self.pool.close()
+            self._changes_pool.close()
+            if self.instrumentation is not None:
+                self.instrumentation.dump()
+
+    @instrumented('migrate')
+    def migrate(self, batch_size: int=MIGRATE_BATCH_SIZE) -> int:
+        """Moves examples stored under random ids to content derived ones,
+        dropping duplicates on the way. Documents are read from the primary
+        index in pages and moved by `batch_size` at once, so memory usage
+        doesn't depend on the database size. Examples which CouchDB refuses
+        to store under the new ids, e.g. by validation, keep their legacy
+        documents. Returns amount of moved documents.
+        """
+        self.flush()
+        self._ensure_setup()
+
+        moved = 0
+        startkey = None
+        while True:
+            params = {'include_docs': 'true', 'limit': batch_size + 1}
+            if startkey is not None:
+                params['startkey'] = json.dumps(startkey)
+            rows = request(
+                method='GET',
+                url=url(self.url, '_all_docs', **params),
+                headers=self.headers,
+                pool=self.pool)['rows']
+            # The extra row starts the next page. Unlike the rows of this
+            # one, it's not deleted meanwhile.
+            startkey = rows.pop()['id'] if len(rows) > batch_size else None
+            moved += self._move_docs([row['doc'] for row in rows])
+            if startkey is None:
+                return moved
+
+    def _move_docs(self, docs: list) -> int:
+        moved = {}
+        targets = {}
+        for doc in docs:
+            if doc.get('type') != 'example':
+                continue
+            docid = example_id(doc['key'], doc['value'])
+            if doc['_id'] == docid:
+                continue
+            targets[doc['_id']] = docid
+            moved[docid] = {key: value for key, value in doc.items()
+                            if key not in ('_id', '_rev')}
+            moved[docid]['_id'] = docid
+        if not targets:
+            return 0
+
+        result = request(
+            method='POST',
+            url=url(self.url, '_bulk_docs'),
+            data=json.dumps({'docs': list(moved.values())}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+        # Conflicts are fine here: they are for already moved examples.
+        # Documents refused otherwise are kept under their legacy ids.
+        stored = {row['id'] for row in result
+                  if row.get('error', 'conflict') == 'conflict'}
+        legacy = [legacy_id for legacy_id, docid in targets.items()
+                  if docid in stored]
+        self._delete_docs(legacy)
+        return len(legacy)
+
+    @instrumented('prune')
+    def prune(self, keys: list=None, dry_run: bool=False,
+              batch_size: int=PRUNE_BATCH_SIZE) -> int:
+        """Deletes examples of formatted `keys` which don't fit retention
+        policy (see :func:`expired_docs`). Examples of every `batch_size`
+        keys are read with a single request and deleted with a single bulk
+        one. By default the keys noted on fetch are pruned. Returns amount
+        of deleted examples, or the ones to delete with `dry_run`."""
+        if keys is None:
+            keys, self.oversized = sorted(self.oversized), set()
+            keys = [list(key) for key in keys]
+        if not keys:
+            return 0
+
+        self._ensure_setup()
+
+        pruned = 0
+        for start in range(0, len(keys), batch_size):
+            pruned += self._prune_keys(keys[start:start + batch_size],
+                                       dry_run)
+        return pruned
+
+    def _prune_keys(self, keys: list, dry_run: bool) -> int:
+        if self.lookup == 'find':
+            # $in takes array fields item by item, so keys are matched one
+            # by one. The range of all keys lets CouchDB use the index.
+            selector = dict(ALL_KEYS)
+            selector['$or'] = [{'key': {'$eq': key}} for key in keys]
+            docs = self._find_docs(selector, update=True)
+        else:
+            result = request(
+                method='POST',
+                url=url(self.url, '_design', 'hypothesis', '_view', 'by_key',
+                        reduce='false',
+                        include_docs='true'),
+                data=json.dumps({'keys': keys}).encode(),
+                headers=self.headers,
+                pool=self.pool)
+            docs = [row['doc'] for row in result['rows'] if row.get('doc')]
+
+        expired = expired_docs(docs, self.max_examples, self.max_age)
+        if expired and not dry_run:
+            # Documents updated meanwhile are left for the next time.
+            request(
+                method='POST',
+                url=url(self.url, '_bulk_docs'),
+                data=json.dumps({'docs': [{'_id': doc['_id'],
+                                           '_rev': doc['_rev'],
+                                           '_deleted': True}
+                                          for doc in expired]}).encode(),
+                headers=self.headers,
+                pool=self.pool)
+            self._warm_up()
+            if self.cache is not None:
+                self.cache.invalidate([doc['key'] for doc in expired])
+        return len(expired)
+
+    def _note_size(self, key: str, count: int):
+        if ((self.max_examples is not None and count > self.max_examples)
+                or (self.max_age is not None and count)):
+            self.oversized.add(tuple(format_key(key)))
+
+    def _doc_id(self, key: list, value: list) -> str:
+        if self.content_ids:
+            return example_id(key, value)
+        return str(uuid.uuid4())
+
+    def _save_docs(self, docs: list):
+        """Stores example `docs` with a single bulk request. Conflicts are
+        for examples which are already stored under content derived ids.
+        When examples are pruned, these are stored once again to note their
+        new save time, so examples which are still saved are not expired."""
         result = request(
+            method='POST',
+            url=url(self.url, '_bulk_docs'),
+            data=json.dumps({'docs': docs}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+        if self.content_ids and self.pruning:
+            self._refresh_docs([doc for doc, row in zip(docs, result)
+                                if row.get('error') == 'conflict'])
+
+    def _refresh_docs(self, docs: list):
+        """Stores `docs` over the existing documents with the same ids.
+        Documents updated meanwhile are left as is."""
+        if not docs:
+            return
+
+        result = request(
+            method='POST',
+            url=url(self.url, '_all_docs'),
+            data=json.dumps({'keys': [doc['_id'] for doc in docs]}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+        revs = {row['id']: row['value']['rev'] for row in result['rows']
+                if 'error' not in row and not row['value'].get('deleted')}
+        docs = [dict(doc, _rev=revs[doc['_id']]) for doc in docs
+                if doc['_id'] in revs]
+        if not docs:
+            return
+
+        request(
+            method='POST',
+            url=url(self.url, '_bulk_docs'),
+            data=json.dumps({'docs': docs}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+
+    def _delete_docs(self, docids: list):
+        if not docids:
+            return
+
+        # Primary index knows current revisions, no need to read docs bodies.
+        result = request(
+            method='POST',
+            url=url(self.url, '_all_docs'),
+            data=json.dumps({'keys': docids}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+
+        stubs = deletion_stubs(result['rows'])
+        if not stubs:
+            return
+
+        request(
+            method='POST',
+            url=url(self.url, '_bulk_docs'),
+            data=json.dumps({'docs': stubs}).encode(),
+            headers=self.headers,
+            pool=self.pool)
+        self._warm_up()
+
+    def _buffer(self, doc: dict):
+        with self._pending_lock:
+            if any(pending['_id'] == doc['_id']
+                   for pending in self._sending + self._pending):
+                return
+            self._pending.append(doc)
+            full = (self.batch_size is not None
+                    and len(self._pending) >= self.batch_size)
+            if (not full and self.flush_interval is not None
+                    and self._flush_timer is None):
+                self._flush_timer = threading.Timer(self.flush_interval,
+                                                    self._flush_quietly)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        # Flush takes the buffer lock on its own, so it's not held here.
+        if full:
+            self.flush()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception as err:
+            # Examples stay buffered for the next flush.
+            self.flush_error = err
+        else:
+            self.flush_error = None
+
+    def _pending_docs(self, key: str) -> list:
+        with self._pending_lock:
+            return [doc for doc in self._sending + self._pending
+                    if doc['key'] == format_key(key)]
+
+    def _fetch_rows(self, key: str) -> list:
+        if self.lookup == 'find':
+            return self._find_rows({'key': {'$eq': format_key(key)}})
+
+        return self._view_rows(url(self.url, '_design', 'hypothesis', '_view',
+                                   'by_key',
+                                   reduce='false',
+                                   key=json.dumps(format_key(key)),
+                                   **self._view_params()))
+
+    def _view_rows(self, view_url: str) -> list:
+        """Returns view rows, revalidating the ones known by their ETag."""
+        if self.etags is None:
+            return request('GET', view_url, headers=self.headers,
+                           pool=self.pool)['rows']
+
+        cached = self.etags.get(view_url)
+        headers = self.headers
+        if cached is not None:
+            headers = dict(headers, **{'If-None-Match': cached[0]})
+        with self.pool.open('GET', view_url, headers) as response:
+            body = response.read()
+            if response.status == 304 and cached is not None:
+                return cached[1]
+            etag = response.getheader('ETag')
+        rows = json.loads(body.decode('utf-8'))['rows']
+        if etag:
+            self.etags.put(view_url, etag, rows, len(body))
+        return rows
+
+    def _view_params(self) -> dict:
+        if self.view_update == 'true':
+            return {}
+        return {'update': self.view_update}
+
+    def _find_rows(self, selector: dict, update: bool=None) -> list:
+        """Returns examples matching Mango `selector` as view rows."""
+        return [{'id': doc['_id'], 'key': doc['key'], 'value': doc['value']}
+                for doc in self._find_docs(selector, update,
+                                           fields=['_id', 'key', 'value'])]
+
+    def _find_docs(self, selector: dict, update: bool=None,
+                   fields: list=None) -> list:
+        """Returns documents matching Mango `selector`. Unless `update` is
+        given, the index is updated as `view_update` says."""
+        if update is None:
+            update = self.view_update == 'true'
+        docs = []
+        query = {'selector': selector, 'limit': FIND_BATCH_SIZE}
+        if fields is not None:
+            query['fields'] = fields
+        if not update:
+            query['update'] = False
+        while True:
+            result = request(
+                method='POST',
+                url=url(self.url, '_find'),
+                data=json.dumps(query).encode(),
+                headers=self.headers,
+                pool=self.pool)
+            docs.extend(result['docs'])
+            if len(result['docs']) < FIND_BATCH_SIZE:
+                return docs
+            query['bookmark'] = result['bookmark']
+
+    def _stream_fetch(self, key: str, pending: list):
+        # Request is made right away, so it's done within fetch operation
+        # while rows are read as the generator goes.
+        stack = contextlib.ExitStack()
+        response = stack.enter_context(self.pool.open(
             method='GET',
             url=url(self.url, '_design', 'hypothesis', '_view', 'by_key',
                     reduce='false',
-                    include_docs='true',
-                    key=json.dumps(format_key(key))),
-            headers=self.headers)
+                    key=json.dumps(format_key(key)),
+                    **self._view_params()),
+            headers=self.headers))
+        return self._stream_values(stack, response, pending, key)
 
-        for row in result['rows']:
-            if row['value'] != value:
-                continue
-            request(
-                method='DELETE',
-                url=url(self.url, row['id'],
-                        rev=row['doc']['_rev']),
-                headers=self.headers)
+    def _stream_values(self, stack: contextlib.ExitStack,
+                       response: http.client.HTTPResponse, pending: list,
+                       key: str):
+        stored = set()
+        count = 0
+        with stack:
+            for row in iter_rows(response):
+                if pending:
+                    stored.add(row['id'])
+                count += 1
+                yield row['value']
+
+        for doc in pending:
+            if doc['_id'] not in stored:
+                count += 1
+                yield doc['value']
+        self._note_size(key, count)
+
+    def _fetch_prefetched(self, key: list) -> list:
+        prefix = key_prefix(key)
+        with self._snapshot_lock:
+            if prefix not in self._snapshot:
+                self._snapshot[prefix] = self._load_prefix(prefix)
+            return list(self._snapshot[prefix].get(tuple(key), {}).values())
+
+    def _load_prefix(self, prefix: tuple) -> dict:
+        with self._pending_lock:
+            pending = [doc for doc in self._sending + self._pending
+                       if key_prefix(doc['key']) == prefix]
 
-    def fetch(self, key: str) -> list:
         self._ensure_setup()
 
+        # Objects are sorted after strings, so [prefix..., {}] is the upper
+        # bound for all the keys that start with the prefix.
+        startkey, endkey = list(prefix), list(prefix) + [{}]
+        if self.lookup == 'find':
+            rows = self._find_rows({'key': {'$gte': startkey,
+                                            '$lte': endkey}})
+        else:
+            rows = self._view_rows(url(self.url, '_design', 'hypothesis',
+                                       '_view', 'by_key',
+                                       reduce='false',
+                                       startkey=json.dumps(startkey),
+                                       endkey=json.dumps(endkey),
+                                       **self._view_params()))
+
+        snapshot = {}
+        for row in rows:
+            rows = snapshot.setdefault(tuple(row['key']), {})
+            rows[row['id']] = row['value']
+        for doc in pending:
+            rows = snapshot.setdefault(tuple(doc['key']), {})
+            rows[doc['_id']] = doc['value']
+        return snapshot
+
+    def _snapshot_add(self, doc: dict):
+        with self._snapshot_lock:
+            snapshot = self._snapshot.get(key_prefix(doc['key']))
+            if snapshot is not None:
+                rows = snapshot.setdefault(tuple(doc['key']), {})
+                rows[doc['_id']] = doc['value']
+
+    def _snapshot_discard(self, key: list, values: list):
+        with self._snapshot_lock:
+            snapshot = self._snapshot.get(key_prefix(key))
+            if snapshot is None or tuple(key) not in snapshot:
+                return
+            rows = snapshot[tuple(key)]
+            for docid in [docid for docid in rows if rows[docid] in values]:
+                del rows[docid]
+
+    def _warm_up(self):
+        """Makes the index get updated in a background thread. Requests made
+        meanwhile are coalesced into a single following update."""
+        if not self.warmup:
+            return
+        with self._warmup_lock:
+            self._warmup_requested = True
+            if self._warmer is not None:
+                return
+            self._warmer = threading.Thread(target=self._warm_up_forever)
+            self._warmer.daemon = True
+            self._warmer.start()
+
+    def _warm_up_forever(self):
+        while True:
+            with self._warmup_lock:
+                if not self._warmup_requested:
+                    self._warmer = None
+                    return
+                self._warmup_requested = False
+            try:
+                self._update_index()
+            except Exception:
+                # Readers would update the index on their own then.
+                pass
+
+    @instrumented('warmup')
+    def _update_index(self):
+        if self.lookup == 'find':
+            request(
+                method='POST',
+                url=url(self.url, '_find'),
+                data=json.dumps({'selector': ALL_KEYS,
+                                 'fields': ['_id'],
+                                 'limit': 1}).encode(),
+                headers=self.headers,
+                pool=self.pool)
+        else:
+            request(
+                method='GET',
+                url=url(self.url, '_design', 'hypothesis', '_view', 'by_key',
+                        reduce='false',
+                        limit='0'),
+                headers=self.headers,
+                pool=self.pool)
+
+    @instrumented('changes')
+    def _ensure_watcher(self):
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+
+        # Cache is only valid for changes since this moment.
+        self.cache.clear()
         result = request(
             method='GET',
-            url=url(self.url, '_design', 'hypothesis', '_view', 'by_key',
-                    reduce='false',
-                    key=json.dumps(format_key(key))),
-            headers=self.headers)
+            url=url(self.url, '_changes', since='now', limit='0'),
+            headers=self.headers,
+            pool=self._changes_pool)
 
-        return [row['value'] for row in result['rows']]
+        self._watcher_stop = threading.Event()
+        self._watcher = threading.Thread(
+            target=self._watch_changes,
+            args=(result['last_seq'], self._watcher_stop))
+        self._watcher.daemon = True
+        self._watcher.start()
 
-    def close(self):
-        pass
+    def _watch_changes(self, since, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                result = self._poll_changes(since)
+            except Exception:
+                # Without the feed cached data cannot be trusted anymore.
+                # Next fetch will start over.
+                self.cache.clear()
+                return
+            self.cache.invalidate_changes(result['results'])
+            since = result['last_seq']
 
-    def _ensure_setup(self):
-        self._ensure_db_exists()
-        self._ensure_ddoc_exists()
+    @instrumented('changes')
+    def _poll_changes(self, since) -> dict:
+        return request(
+            method='GET',
+            url=url(self.url, '_changes',
+                    feed='longpoll',
+                    include_docs='true',
+                    timeout=CHANGES_TIMEOUT,
+                    since=since),
+            headers=self.headers,
+            pool=self._changes_pool)
 
-    def _ensure_db_exists(self):
-        if self._ensured_db_exists:
+    def _ensure_setup(self):
+        if self._ensured_setup:
             return
 
+        self._verify_setup()
+        self._ensured_setup = True
+
+    @instrumented('setup')
+    def _verify_setup(self):
+        marker = self._setup_marker_path()
+        rev = read_setup_marker(marker) if marker else None
+        if rev is None or self._ddoc_rev() != rev:
+            rev = self._setup()
+            if self.lookup == 'find':
+                # Existing index is reported as such, not as an error.
+                request('POST', url(self.url, '_index'),
+                        data=json.dumps(self.find_index()).encode(),
+                        headers=self.headers,
+                        pool=self.pool)
+            if marker:
+                write_setup_marker(marker, rev)
+
+    def _expected_ddoc(self) -> dict:
+        ddoc = self.ddoc()
+        if self.lookup != 'view':
+            del ddoc['views']
+        return ddoc
+
+    def _setup_marker_path(self) -> str:
+        return setup_marker_path(self.setup_marker_dir, self.url,
+                                 self._expected_ddoc())
+
+    def _ddoc_rev(self) -> str:
+        """Returns current design document revision without fetching it."""
         try:
-            request('GET', url(self.url), headers=self.headers)
+            with self.pool.open('HEAD', url(self.url, '_design', 'hypothesis'),
+                                headers=self.headers) as response:
+                response.read()
+                return response.getheader('ETag', '').strip('"') or None
         except urllib.request.HTTPError as err:
             if err.code != 404:
                 raise
-            request('PUT', url(self.url), headers=self.headers)
-
-        self._ensured_db_exists = True
-
-    def _ensure_ddoc_exists(self):
-        if self._ensured_ddoc_exists:
-            return
+            return None
 
+    def _setup(self) -> str:
+        """Creates database and design document or updates the last one if
+        it's outdated. Returns the verified design document revision."""
         try:
             remote_ddoc = request('GET',
                                   url(self.url, '_design', 'hypothesis'),
-                                  headers=self.headers)
+                                  headers=self.headers,
+                                  pool=self.pool)
         except urllib.request.HTTPError as err:
             if err.code != 404:
                 raise
+            remote_ddoc = None
+
+        ddoc = outdated_ddoc(self._expected_ddoc(), remote_ddoc)
+        if ddoc is None:
+            return remote_ddoc['_rev']
+
+        if remote_ddoc is None:
+            # Missing database is also reported as missing document.
+            try:
+                request('PUT', url(self.url), headers=self.headers,
+                        pool=self.pool)
+            except urllib.request.HTTPError as err:
+                if err.code != 412:
+                    raise
+
+        result = request('PUT',
+                         url(self.url, '_design', 'hypothesis'),
+                         data=json.dumps(ddoc).encode(),
+                         headers=self.headers,
+                         pool=self.pool)
+        return result['rev']
+
+
+class MirroredCouchBackend(Backend):
+    """Serves examples from a local SQLite database at `path` and replicates
+    them with CouchDB at `dburl` in a background thread every
+    `sync_interval` seconds, so tests never wait for the network.
+
+    Local changes are pushed with ``_bulk_docs`` requests, remote ones are
+    pulled from the ``_changes`` feed. Examples are stored under content
+    derived ids (see :func:`example_id`), so the same example saved on
+    several machines is the same document. Conflicts are resolved this way:
+
+    - local changes which are not pushed yet win over remote ones;
+    - pushed deletion removes the document whatever its remote revision is;
+    - pushed example is restored even if it was deleted remotely.
+
+    In other words, the last pushed change wins. Extra keyword arguments are
+    passed to :class:`CouchBackend` which is used to talk to CouchDB.
+    """
+
+    def __init__(self, dburl: str, basic_auth_credentials: tuple=None,
+                 path: str='.hypothesis/couchdb-mirror.db',
+                 sync_interval: float=10,
+                 **options):
+        options['content_ids'] = True
+        self.remote = CouchBackend(dburl, basic_auth_credentials, **options)
+        self.path = path
+        self.sync_interval = sync_interval
+        #: The last replication error, if any.
+        self.sync_error = None
+        self._conn = None
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._syncer = None
+        self._syncer_stop = None
+
+    @property
+    def instrumentation(self) -> Instrumentation:
+        return self.remote.instrumentation
+
+    def data_type(self):
+        return self.remote.data_type()
+
+    @instrumented('save')
+    def save(self, key: str, value: list):
+        self._ensure_syncer()
+        docid = example_id(format_key(key), value)
+        with self._cursor() as cursor:
+            cursor.execute('''
+                select deleted from examples where id = ?
+            ''', (docid,))
+            if cursor.fetchone() in (None, (1,)):
+                cursor.execute('''
+                    insert or replace into examples(id, key, value, saved_at,
+                                                    deleted, dirty)
+                    values(?, ?, ?, ?, 0, 1)
+                ''', (docid, canonical_json(format_key(key)),
+                      canonical_json(value), int(time.time())))
+            elif self.remote.pruning:
+                # Example is saved once again: note its new save time.
+                cursor.execute('''
+                    update examples set saved_at = ?, dirty = 1 where id = ?
+                ''', (int(time.time()), docid))
+
+    @instrumented('delete')
+    def delete(self, key: str, value: list):
+        self._ensure_syncer()
+        with self._cursor() as cursor:
+            for value in value_encodings(value):
+                cursor.execute('''
+                    update examples set deleted = 1, dirty = 1
+                    where key = ? and value = ? and deleted = 0
+                ''', (canonical_json(format_key(key)), canonical_json(value)))
+
+    @instrumented('fetch')
+    def fetch(self, key: str) -> list:
+        self._ensure_syncer()
+        with self._cursor() as cursor:
+            cursor.execute('''
+                select value from examples where key = ? and deleted = 0
+            ''', (canonical_json(format_key(key)),))
+            return [json.loads(value) for (value,) in cursor.fetchall()]
+
+    @instrumented('sync')
+    def sync(self):
+        """Pushes local changes to CouchDB and pulls remote ones."""
+        with self._sync_lock:
+            self._push()
+            self._pull()
+
+    def close(self):
+        if self._syncer_stop is not None:
+            self._syncer_stop.set()
+            self._syncer.join()
+            self._syncer = self._syncer_stop = None
+        try:
+            self._push()
+        except Exception as err:
+            self.sync_error = err
+        finally:
+            self.remote.close()
+            with self._lock:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+
+    @contextlib.contextmanager
+    def _cursor(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+            except Exception:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+            finally:
+                cursor.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.executescript('''
+            create table if not exists examples(
+                id text primary key,
+                key text not null,
+                value text not null,
+                saved_at integer,
+                deleted integer not null default 0,
+                dirty integer not null default 0
+            );
+            create index if not exists examples_by_key on examples(key);
+            create table if not exists meta(
+                name text primary key,
+                value text not null
+            );
+        ''')
+        columns = [row[1] for row in conn.execute('''
+            pragma table_info(examples)
+        ''')]
+        if 'saved_at' not in columns:
+            # Mirrors made before save time was kept get it on push.
+            conn.execute('''
+                alter table examples add column saved_at integer
+            ''')
+        return conn
+
+    def _ensure_syncer(self):
+        with self._lock:
+            if self._syncer is not None:
+                return
+            self._syncer_stop = threading.Event()
+            self._syncer = threading.Thread(target=self._sync_forever,
+                                            args=(self._syncer_stop,))
+            self._syncer.daemon = True
+            self._syncer.start()
+
+    def _sync_forever(self, stop: threading.Event):
+        while True:
+            try:
+                self.sync()
+            except Exception as err:
+                # Replication is best effort: tests keep working with local
+                # examples while server is unavailable.
+                self.sync_error = err
+            else:
+                self.sync_error = None
+            if stop.wait(self.sync_interval):
+                return
 
-            request('PUT',
-                    url(self.url, '_design', 'hypothesis'),
-                    data=json.dumps(self.ddoc()).encode(),
-                    headers=self.headers)
+    def _push(self):
+        with self._cursor() as cursor:
+            cursor.execute('''
+                select id, key, value, saved_at, deleted from examples
+                where dirty = 1
+            ''')
+            rows = cursor.fetchall()
+        if not rows:
+            return
+
+        self.remote._ensure_setup()
+
+        docs = [example_doc(docid, json.loads(key), json.loads(value),
+                            saved_at)
+                for docid, key, value, saved_at, deleted in rows
+                if not deleted]
+        if docs:
+            self.remote._save_docs(docs)
+            self.remote._warm_up()
+        self.remote._delete_docs([docid for docid, _, _, _, deleted in rows
+                                  if deleted])
+
+        # Rows changed once again while pushing remain dirty.
+        with self._cursor() as cursor:
+            for docid, _, _, _, deleted in rows:
+                if deleted:
+                    cursor.execute('''
+                        delete from examples
+                        where id = ? and deleted = 1 and dirty = 1
+                    ''', (docid,))
+                else:
+                    cursor.execute('''
+                        update examples set dirty = 0
+                        where id = ? and deleted = 0
+                    ''', (docid,))
+
+    def _pull(self):
+        self.remote._ensure_setup()
+
+        with self._cursor() as cursor:
+            cursor.execute('''
+                select value from meta where name = 'since'
+            ''')
+            row = cursor.fetchone()
+        since = json.loads(row[0]) if row else 0
+
+        while True:
+            result = request(
+                method='GET',
+                url=url(self.remote.url, '_changes',
+                        include_docs='true',
+                        limit=CHANGES_BATCH_SIZE,
+                        since=since),
+                headers=self.remote.headers,
+                pool=self.remote.pool)
+            with self._cursor() as cursor:
+                for change in result['results']:
+                    self._apply_change(cursor, change)
+                since = result['last_seq']
+                cursor.execute('''
+                    insert or replace into meta(name, value)
+                    values('since', ?)
+                ''', (json.dumps(since),))
+            if len(result['results']) < CHANGES_BATCH_SIZE:
+                return
+
+    def _apply_change(self, cursor: sqlite3.Cursor, change: dict):
+        cursor.execute('''
+            select dirty from examples where id = ?
+        ''', (change['id'],))
+        if cursor.fetchone() == (1,):
+            return
+
+        doc = change.get('doc') or {}
+        if change.get('deleted') or doc.get('type') != 'example':
+            cursor.execute('''
+                delete from examples where id = ?
+            ''', (change['id'],))
+            return
+
+        cursor.execute('''
+            insert or replace into examples(id, key, value, saved_at,
+                                            deleted, dirty)
+            values(?, ?, ?, ?, 0, 0)
+        ''', (change['id'], canonical_json(doc['key']),
+              canonical_json(doc['value']), doc.get('saved_at')))
+
+
+class SpooledCouchBackend(Backend):
+    """Coalesces writes of all the processes on the same machine, such as
+    parallel test workers, into shared batched requests to CouchDB at
+    `dburl`.
+
+    Saved and deleted examples are written to `spool_dir` as small files.
+    Once this process spooled `batch_size` of them, `flush_interval` seconds
+    passed since it spooled the first one or on :meth:`flush` and
+    :meth:`close` calls, the process claims all the spooled files, whoever
+    wrote them, merges them and sends the saved examples with a single
+    ``_bulk_docs`` request and the deleted ones with another. Examples are
+    stored under content derived ids (see :func:`example_id`), so the same
+    example saved by several workers is a single document. When the server
+    is unavailable the files are put back and sent by the next flush of any
+    process. Until a flush succeeds, `batch_size` doesn't trigger flushes
+    any more and they are retried every `flush_interval` seconds only.
+
+    The first fetch of a key loads examples of all the keys sharing the
+    same prefix, as :class:`CouchBackend` does with `prefetch`, and leaves
+    them in `spool_dir` as a snapshot. Other processes take it instead of
+    querying the server while it's younger than `snapshot_ttl` seconds.
+    Flushed writes discard the snapshots they affect, spooled ones are
+    applied to snapshots on load.
+
+    By default `spool_dir` is a subdirectory of :data:`SPOOL_DIR` derived
+    from `dburl`. Extra keyword arguments are passed to
+    :class:`CouchBackend` which is used to talk to CouchDB.
+    """
+
+    def __init__(self, dburl: str, basic_auth_credentials: tuple=None,
+                 spool_dir: str=None,
+                 batch_size: int=100,
+                 flush_interval: float=1,
+                 snapshot_ttl: float=60,
+                 **options):
+        options['content_ids'] = True
+        self.remote = CouchBackend(dburl, basic_auth_credentials, **options)
+        if spool_dir is None:
+            digest = hashlib.sha256(dburl.encode('utf-8')).hexdigest()
+            spool_dir = os.path.join(SPOOL_DIR, digest[:16])
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.snapshot_ttl = snapshot_ttl
+        #: The last error of flush made on timer, on `batch_size` or on
+        #: close, if any.
+        self.flush_error = None
+        self._snapshot = {}
+        self._lock = threading.RLock()
+        self._flush_timer = None
+        # Files spooled by this process since the last flush.
+        self._spooled = 0
+
+    @property
+    def instrumentation(self) -> Instrumentation:
+        return self.remote.instrumentation
+
+    def data_type(self):
+        return self.remote.data_type()
+
+    @instrumented('save')
+    def save(self, key: str, value: list):
+        doc = example_doc(example_id(format_key(key), value),
+                          format_key(key), value)
+        self._spool({'save': doc})
+
+    @instrumented('delete')
+    def delete(self, key: str, value: list):
+        self._spool({'delete': {
+            'key': format_key(key),
+            'values': value_encodings(value),
+            'ids': [example_id(format_key(key), value)
+                    for value in value_encodings(value)]}})
+
+    @instrumented('fetch')
+    def fetch(self, key: str) -> list:
+        prefix = key_prefix(format_key(key))
+        with self._lock:
+            if prefix not in self._snapshot:
+                self._snapshot[prefix] = self._load_snapshot(prefix)
+            return list(self._snapshot[prefix].get(tuple(format_key(key)),
+                                                   {}).values())
+
+    @instrumented('flush')
+    def flush(self):
+        """Sends writes spooled by all the processes to the server."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._spooled = 0
+
+        claim_dir = self._claim()
+        if claim_dir is None:
+            return
+        names = sorted(os.listdir(claim_dir))
+        try:
+            docs, deleted = {}, {}
+            for entry in self._read_entries(claim_dir, names):
+                if 'save' in entry:
+                    doc = entry['save']
+                    docs[doc['_id']] = doc
+                    deleted.pop(doc['_id'], None)
+                else:
+                    for docid in entry['delete']['ids']:
+                        deleted[docid] = entry['delete']['key']
+                        docs.pop(docid, None)
+
+            if docs:
+                self.remote._ensure_setup()
+                self.remote._save_docs(list(docs.values()))
+                self.remote._warm_up()
+            if deleted:
+                self.remote._ensure_setup()
+                self.remote._delete_docs(sorted(deleted))
+        except Exception:
+            for name in names:
+                os.replace(os.path.join(claim_dir, name),
+                           os.path.join(self.spool_dir, name))
+            raise
+        finally:
+            shutil.rmtree(claim_dir, ignore_errors=True)
+
+        self._discard_snapshots(
+            [doc['key'] for doc in docs.values()] + list(deleted.values()))
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception as err:
+            # Spooled writes are kept for the next flush of any process.
+            self.flush_error = err
+        finally:
+            with self._lock:
+                self._snapshot.clear()
+            self.remote.close()
+
+    def _spool(self, entry: dict):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        # Names sort in order of writes, so the last write of an example
+        # wins on flush.
+        name = '%017.6f-%s.json' % (time.time(), uuid.uuid4().hex)
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir, prefix='.')
+        with os.fdopen(fd, 'w', encoding='utf-8') as spooled:
+            json.dump(entry, spooled)
+        os.replace(tmp_path, os.path.join(self.spool_dir, name))
+
+        with self._lock:
+            self._apply_entries(self._snapshot, [entry])
+            self._spooled += 1
+            # After a failed flush retries are left to the timer, so saves
+            # don't wait for the unavailable server one after another.
+            flush = (self.batch_size is not None
+                     and self._spooled >= self.batch_size
+                     and self.flush_error is None)
+            if flush:
+                self._spooled = 0
+            else:
+                self._start_flush_timer()
+        if flush:
+            # Failed flush puts files back, so saves don't fail on it.
+            self._flush_quietly()
+
+    def _start_flush_timer(self):
+        with self._lock:
+            if self.flush_interval is None or self._flush_timer is not None:
+                return
+            self._flush_timer = threading.Timer(self.flush_interval,
+                                                self._flush_quietly)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception as err:
+            self.flush_error = err
+            # Saves don't flush until it succeeds, so retry on timer.
+            self._start_flush_timer()
         else:
-            local_ddoc = self.ddoc()
-            expected_view = local_ddoc['views']['by_key']
-            stored_view = remote_ddoc.get('views', {}).get('by_key', {})
+            self.flush_error = None
 
-            if expected_view != stored_view:
-                remote_ddoc.setdefault('views', {})
-                remote_ddoc['views']['by_key'] = expected_view
-                request('PUT',
-                        url(self.url, '_design', 'hypothesis'),
-                        data=json.dumps(remote_ddoc).encode(),
-                        headers=self.headers)
+    def _spooled_names(self) -> list:
+        try:
+            return sorted(name for name in os.listdir(self.spool_dir)
+                          if name.endswith('.json')
+                          and not name.startswith(('.', 'snapshot-')))
+        except FileNotFoundError:
+            return []
 
-        self._ensured_ddoc_exists = True
+    def _claim(self) -> str:
+        """Moves all spooled files to a new directory and returns it. Files
+        moved meanwhile by other processes are theirs."""
+        names = self._spooled_names()
+        if not names:
+            return None
+        claim_dir = tempfile.mkdtemp(dir=self.spool_dir, prefix='.claim-')
+        claimed = 0
+        for name in names:
+            try:
+                os.rename(os.path.join(self.spool_dir, name),
+                          os.path.join(claim_dir, name))
+            except FileNotFoundError:
+                continue
+            claimed += 1
+        if not claimed:
+            os.rmdir(claim_dir)
+            return None
+        return claim_dir
+
+    def _read_entries(self, path: str, names: list):
+        for name in names:
+            try:
+                with open(os.path.join(path, name), encoding='utf-8') as fp:
+                    yield json.load(fp)
+            except FileNotFoundError:
+                # Claimed by the other process meanwhile.
+                continue
+
+    def _apply_entries(self, snapshot: dict, entries):
+        for entry in entries:
+            if 'save' in entry:
+                doc = entry['save']
+                rows = snapshot.get(key_prefix(doc['key']))
+                if rows is not None:
+                    rows.setdefault(tuple(doc['key']), {})[doc['_id']] = \
+                        doc['value']
+                continue
+            key = entry['delete']['key']
+            rows = snapshot.get(key_prefix(key), {}).get(tuple(key), {})
+            for docid in [docid for docid in rows
+                          if rows[docid] in entry['delete']['values']]:
+                del rows[docid]
+
+    def _snapshot_path(self, prefix: tuple) -> str:
+        digest = hashlib.sha256(canonical_json(list(prefix)).encode('utf-8'))
+        return os.path.join(self.spool_dir,
+                            'snapshot-%s.json' % digest.hexdigest())
+
+    def _load_snapshot(self, prefix: tuple) -> dict:
+        """Returns examples of the keys under `prefix` from the shared
+        snapshot, querying the server if it's missing or outdated. Spooled
+        writes are applied on top of it."""
+        path = self._snapshot_path(prefix)
+        rows = None
+        try:
+            with open(path, encoding='utf-8') as fp:
+                shared = json.load(fp)
+            if time.time() - shared['created'] < self.snapshot_ttl:
+                rows = shared['rows']
+        except (OSError, ValueError):
+            pass
+
+        if rows is None:
+            created = time.time()
+            loaded = self.remote._load_prefix(prefix)
+            rows = [[list(key), docid, value]
+                    for key, values in loaded.items()
+                    for docid, value in values.items()]
+            write_snapshot(path, {'created': created, 'rows': rows})
+
+        examples = {}
+        for key, docid, value in rows:
+            examples.setdefault(tuple(key), {})[docid] = value
+        snapshot = {prefix: examples}
+        self._apply_entries(snapshot,
+                            self._read_entries(self.spool_dir,
+                                               self._spooled_names()))
+        return examples
+
+    def _discard_snapshots(self, keys: list):
+        for prefix in {key_prefix(key) for key in keys}:
+            try:
+                os.remove(self._snapshot_path(prefix))
+            except FileNotFoundError:
+                pass
+
+
+class FallbackBackend(Backend):
+    """Guards `backend` with a circuit breaker which switches to in-memory
+    examples store once the server is considered unavailable.
+
+    The breaker opens when `max_failures` calls fail in a row or when calls
+    to `backend` took more than `budget` seconds in total. A failed call is
+    served from memory as well, so errors never reach the tests.
+
+    Saved and fetched examples are kept in memory all the time, so once the
+    breaker is open fetches return what is known so far. Writes made while
+    it's open are queued. After `retry_interval` seconds the queue is
+    replayed and the breaker closes back if that succeeds. Exhausted budget
+    keeps the breaker open for the rest of the run. What's left in the queue
+    is replayed on :meth:`close` unless the budget is exhausted.
+    """
+
+    def __init__(self, backend: Backend, budget: float=None,
+                 max_failures: int=None, retry_interval: float=30):
+        self.backend = backend
+        self.budget = budget
+        self.max_failures = max_failures
+        self.retry_interval = retry_interval
+        #: Seconds spent within `backend` calls so far.
+        self.spent = 0.0
+        #: The last error of `backend`, if any.
+        self.error = None
+        self.failures = 0
+        self.opened_at = None
+        #: Writes to replay as ``(method name, key, value)`` tuples.
+        self.queue = []
+        self._examples = {}
+        self._lock = threading.RLock()
+        self._replay_lock = threading.Lock()
+
+    @property
+    def degraded(self) -> bool:
+        """Whether calls are served from memory."""
+        return self.opened_at is not None
+
+    @property
+    def exhausted(self) -> bool:
+        return self.budget is not None and self.spent >= self.budget
+
+    def data_type(self):
+        return self.backend.data_type()
+
+    def save(self, key: str, value: list):
+        with self._lock:
+            values = self._examples.setdefault(key, [])
+            if value not in values:
+                values.append(value)
+        self._write('save', key, value)
+
+    def delete(self, key: str, value: list):
+        with self._lock:
+            values = self._examples.get(key, [])
+            if value in values:
+                values.remove(value)
+        self._write('delete', key, value)
+
+    def fetch(self, key: str) -> list:
+        if self._available():
+            try:
+                # Streamed values are read here to catch errors in time.
+                values = self._call(lambda: list(self.backend.fetch(key)))
+            except Exception:
+                pass
+            else:
+                with self._lock:
+                    # Queued writes are not seen by the server yet.
+                    for method, qkey, value in self.queue:
+                        if qkey != key:
+                            continue
+                        if method == 'save' and value not in values:
+                            values.append(value)
+                        elif method == 'delete' and value in values:
+                            values.remove(value)
+                    self._examples[key] = values
+                return list(values)
+        with self._lock:
+            return list(self._examples.get(key, []))
+
+    def replay(self) -> bool:
+        """Sends queued writes to `backend`. Returns whenever the queue got
+        empty. Concurrent replays take turns, so every write is sent once
+        and in order."""
+        with self._replay_lock:
+            while True:
+                with self._lock:
+                    if not self.queue:
+                        return True
+                    method, key, value = self.queue[0]
+                try:
+                    self._call(
+                        lambda: getattr(self.backend, method)(key, value))
+                except Exception:
+                    return False
+                with self._lock:
+                    # Writes are only taken off the queue here.
+                    self.queue.pop(0)
+
+    def close(self):
+        try:
+            if self.queue and not self.exhausted:
+                self.replay()
+        finally:
+            self.backend.close()
+
+    def _write(self, method: str, key: str, value: list):
+        # Writes must reach the server in order, so the queue goes first.
+        if self._available() and self.replay():
+            try:
+                self._call(lambda: getattr(self.backend, method)(key, value))
+            except Exception:
+                pass
+            else:
+                return
+        with self._lock:
+            self.queue.append((method, key, value))
+
+    def _available(self) -> bool:
+        """Returns whenever `backend` may be called, retrying it with the
+        queue replay once `retry_interval` passed."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.exhausted:
+                return False
+            if time.monotonic() - self.opened_at < self.retry_interval:
+                return False
+            # Half-open: let the replay decide. Meanwhile others keep using
+            # the memory.
+            self.opened_at = time.monotonic()
+        if not self.replay():
+            return False
+        with self._lock:
+            self.opened_at = None
+            self.failures = 0
+        return True
+
+    def _call(self, func):
+        start = time.monotonic()
+        try:
+            result = func()
+        except Exception as err:
+            with self._lock:
+                self.spent += time.monotonic() - start
+                self.error = err
+                self.failures += 1
+                if self.exhausted or (self.max_failures is not None
+                                      and self.failures >= self.max_failures):
+                    self._open()
+            raise
+        with self._lock:
+            self.spent += time.monotonic() - start
+            self.failures = 0
+            if self.exhausted:
+                self._open()
+        return result
+
+    def _open(self):
+        if self.opened_at is None:
+            self.opened_at = time.monotonic()
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive HTTP connections to a single server.
+
+    Connections are taken from the pool for a single request and returned
+    back once the response is read, so the TCP (and TLS) handshake happens
+    only when there is no idle connection left. At most `maxsize` idle
+    connections are kept open, extra ones are closed on release.
+
+    With `timeout` (in seconds) connecting and every socket read and write
+    fail with :exc:`socket.timeout` if they take longer than that.
+
+    With `compress_threshold` request bodies of at least that many bytes are
+    sent gzip compressed. Responses are decoded according to their
+    ``Content-Encoding`` anyway.
+
+    When `instrumentation` is set, every request is recorded there.
+    """
+
+    def __init__(self, url: str, maxsize: int=10, timeout: float=None,
+                 compress_threshold: int=None):
+        if maxsize < 1:
+            raise ValueError('Pool size must be positive')
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.compress_threshold = compress_threshold
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self.instrumentation = None
+
+    def acquire(self) -> tuple:
+        """Returns idle connection with flag whatever it was used before or
+        a new one if pool is empty."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        if self.timeout is None:
+            return self.connection_class(self.host, self.port), False
+        return self.connection_class(self.host, self.port,
+                                     timeout=self.timeout), False
+
+    def release(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def urlopen(self, method: str, url: str, headers: dict,
+                data: bytes=None) -> bytes:
+        """Makes HTTP request and returns response body.
+
+        Raises :exc:`urllib.error.HTTPError` for error responses just like
+        :func:`urllib.request.urlopen` does.
+        """
+        with self.open(method, url, headers, data) as response:
+            return response.read()
+
+    @contextlib.contextmanager
+    def open(self, method: str, url: str, headers: dict, data: bytes=None):
+        """Makes HTTP request and returns context manager for unread
+        :class:`http.client.HTTPResponse`. The connection returns back to the
+        pool on exit only if the response was read till the end.
+
+        Raises :exc:`urllib.error.HTTPError` for error responses.
+        """
+        data, headers = self._encode(data, headers)
+        if self.instrumentation is None:
+            with self._open(method, url, headers, data) as response:
+                yield response
+            return
+
+        instrumentation = self.instrumentation
+        operation = instrumentation.current_operation
+        start = time.perf_counter()
+        status = None
+        received = [0]
+        try:
+            with self._open(method, url, headers, data,
+                            received) as response:
+                status = response.status
+                yield response
+        except urllib.error.HTTPError as err:
+            status = err.code
+            raise
+        finally:
+            instrumentation.record_request(
+                operation, method, url, status, len(data or b''),
+                received[0], time.perf_counter() - start)
+
+    def _encode(self, data: bytes, headers: dict) -> tuple:
+        if (data is None or self.compress_threshold is None
+                or len(data) < self.compress_threshold):
+            return data, headers
+        return (gzip.compress(data, COMPRESSION_LEVEL),
+                dict(headers, **{'Content-Encoding': 'gzip'}))
+
+    @contextlib.contextmanager
+    def _open(self, method: str, url: str, headers: dict, data: bytes=None,
+              received: list=None):
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        while True:
+            conn, reused = self.acquire()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except Exception as err:
+                conn.close()
+                # Server may close idle keep-alive connection at any moment,
+                # so only fresh connection failure is a real one.
+                if reused and isinstance(err, (http.client.HTTPException,
+                                               ConnectionError)):
+                    continue
+                raise
+            break
+
+        if received is not None:
+            counted_read(response, received)
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding in ('gzip', 'deflate'):
+            decoded_read(response)
+        try:
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status,
+                                             response.reason, response.msg,
+                                             io.BytesIO(response.read()))
+            yield response
+        finally:
+            if response.isclosed() and not response.will_close:
+                self.release(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        """Closes all idle connections. The pool remains usable after."""
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn in idle:
+            conn.close()
+
+
+class FetchCache(object):
+    """Thread-safe LRU cache of view rows by formatted example key.
+
+    Entries are evicted on updates of documents they contain, so it keeps
+    track of document ids to recognize deleted ones in the changes feed.
+    """
+
+    def __init__(self, maxsize: int):
+        if maxsize < 1:
+            raise ValueError('Cache size must be positive')
+        self.maxsize = maxsize
+        #: Incremented on every invalidation. Rows fetched from the server
+        #: while it changes may be already stale and must not be stored.
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._keys_by_id = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: list) -> list:
+        with self._lock:
+            rows = self._entries.get(tuple(key))
+            if rows is not None:
+                self._entries.move_to_end(tuple(key))
+            return rows
+
+    def put(self, key: list, rows: list, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._discard(tuple(key))
+            self._entries[tuple(key)] = rows
+            for row in rows:
+                self._keys_by_id[row['id']] = tuple(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, keys: list):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._discard(tuple(key))
+
+    def invalidate_changes(self, results: list):
+        """Evicts entries affected by ``_changes`` feed results."""
+        keys = []
+        with self._lock:
+            for result in results:
+                if result['id'] in self._keys_by_id:
+                    keys.append(self._keys_by_id[result['id']])
+                key = result.get('doc', {}).get('key')
+                if isinstance(key, list):
+                    keys.append(key)
+        if results:
+            self.invalidate(keys)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_id.clear()
+
+    def _discard(self, key: tuple):
+        for row in self._entries.pop(key, ()):
+            self._keys_by_id.pop(row['id'], None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ETagCache(object):
+    """Thread-safe LRU cache of parsed responses by URL along with their
+    ETags. Holds responses of up to `maxbytes` total size of their bodies.
+    """
+
+    def __init__(self, maxbytes: int):
+        if maxbytes < 1:
+            raise ValueError('Cache size must be positive')
+        self.maxbytes = maxbytes
+        #: Total size of held responses.
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> tuple:
+        """Returns ETag and parsed response for the URL, if any."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            self._entries.move_to_end(url)
+            return entry[:2]
+
+    def put(self, url: str, etag: str, value, size: int):
+        with self._lock:
+            self._discard(url)
+            if size > self.maxbytes:
+                return
+            self._entries[url] = (etag, value, size)
+            self.size += size
+            while self.size > self.maxbytes:
+                self._discard(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, url: str):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
 
 
 def quote(segment: str, safe: str='') -> str:
@@ -206,13 +2050,135 @@ def url(base_url: str, *path: str, **params) -> str:
     return rval
 
 
-def request(method: str, url: str, headers: dict, data: bytes=None) -> dict:
+def request(method: str, url: str, headers: dict, data: bytes=None,
+            pool: 'ConnectionPool'=None, timeout: float=None) -> dict:
+    if pool is not None:
+        return json.loads(pool.urlopen(method, url, headers,
+                                       data).decode('utf-8'))
     req = urllib.request.Request(url, method=method, data=data,
                                  headers=headers)
-    with urllib.request.urlopen(req) as response:
+    if timeout is None:
+        response = urllib.request.urlopen(req)
+    else:
+        response = urllib.request.urlopen(req, timeout=timeout)
+    with response:
         return json.loads(response.read().decode('utf-8'))
 
 
+def counted_read(response: http.client.HTTPResponse, counter: list):
+    """Makes response add amount of read body bytes to ``counter[0]``."""
+    read = response.read
+
+    def wrapper(*args, **kwargs):
+        chunk = read(*args, **kwargs)
+        counter[0] += len(chunk)
+        return chunk
+
+    response.read = wrapper
+
+
+def decoded_read(response: http.client.HTTPResponse):
+    """Makes response decompress gzip or deflate encoded body on read."""
+    read = response.read
+    # Both gzip and zlib headers are recognized automatically.
+    decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def wrapper(amt=None):
+        if amt is None:
+            return decoder.decompress(read()) + decoder.flush()
+        # Compressed chunk may give no output yet, but empty result means
+        # the end of the body.
+        while True:
+            chunk = read(amt)
+            if not chunk:
+                return decoder.flush()
+            data = decoder.decompress(chunk)
+            if data:
+                return data
+
+    response.read = wrapper
+
+
+def read_setup_marker(path: str) -> str:
+    try:
+        with open(path, encoding='utf-8') as marker:
+            return marker.read().strip() or None
+    except OSError:
+        return None
+
+
+def setup_marker_path(marker_dir: str, dburl: str, ddoc: dict) -> str:
+    """Returns path of the marker which notes verified design document
+    `ddoc` of database at `dburl`, or ``None`` without `marker_dir`."""
+    if marker_dir is None:
+        return None
+    ddoc = json.dumps(ddoc, sort_keys=True)
+    digest = hashlib.sha256('\n'.join((dburl, ddoc)).encode('utf-8'))
+    return os.path.join(marker_dir, digest.hexdigest())
+
+
+def write_setup_marker(path: str, rev: str):
+    """Atomically notes verified design document revision. Failures are
+    ignored since the marker is only an optimization."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as marker:
+            marker.write(rev)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def write_snapshot(path: str, snapshot: dict):
+    """Atomically writes shared snapshot of examples. Failures are ignored
+    since the snapshot is only an optimization."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            json.dump(snapshot, fp)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def iter_rows(response: http.client.HTTPResponse,
+              chunk_size: int=STREAM_CHUNK_SIZE):
+    """Yields rows of view response one by one while reading it from the
+    stream, so only a single row is kept in memory at once."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = None
+    while True:
+        chunk = response.read(chunk_size)
+        buf += text.decode(chunk, final=not chunk)
+        if pos is None:
+            match = ROWS_START.search(buf)
+            if match is None:
+                if not chunk:
+                    raise ValueError('Response has no rows')
+                continue
+            pos = match.end()
+        while True:
+            while pos < len(buf) and buf[pos] in ', \t\r\n':
+                pos += 1
+            if buf.startswith(']', pos):
+                # Drain the rest to let the connection be reused.
+                while response.read(chunk_size):
+                    pass
+                return
+            try:
+                row, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if not chunk:
+                    raise
+                break
+            yield row
+        buf, pos = buf[pos:], 0
+
+
 def basic_auth_header(username: str, password: str) -> str:
     return 'Basic %s' % (
         base64.b64encode(
@@ -223,3 +2189,222 @@ def basic_auth_header(username: str, password: str) -> str:
 
 def format_key(key: str) -> list:
     return key.split('.')
+
+
+def key_prefix(key: list) -> tuple:
+    """Returns prefix of formatted key which groups it with its siblings.
+    Single segment keys are their own prefixes."""
+    return tuple(key[:-1] if len(key) > 1 else key)
+
+
+def canonical_json(value) -> str:
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+def pack_value(value) -> str:
+    """Packs basic data into base64 string.
+
+    Every value is a tag byte followed by its payload: integers are zigzag
+    varints, strings are varint length followed by UTF-8 bytes, lists are
+    varint length followed by their items. Lists of integers, the most
+    common examples, have a tag of their own which saves tag byte per item.
+    The result starts with :data:`PACKED_PREFIX`.
+    """
+    buf = bytearray()
+    _pack(value, buf)
+    data = base64.b64encode(bytes(buf)).decode('ascii').rstrip('=')
+    return PACKED_PREFIX + data
+
+
+def unpack_value(data: str):
+    """Unpacks basic data packed by :func:`pack_value`. Raises
+    :exc:`~hypothesis.errors.BadData` if it's not a valid packed value."""
+    if not is_packed(data):
+        raise BadData('Not a packed value: %r' % (data,))
+    data = data[len(PACKED_PREFIX):]
+    try:
+        buf = base64.b64decode(data + '=' * (-len(data) % 4), validate=True)
+        value, pos = _unpack(buf, 0)
+    except ValueError as err:
+        raise BadData('Bad packed value: %s' % (err,))
+    if pos != len(buf):
+        raise BadData('Trailing data after packed value')
+    return value
+
+
+def is_packed(data) -> bool:
+    """Tells whenever stored `data` is packed by :func:`pack_value`."""
+    return isinstance(data, str) and data.startswith(PACKED_PREFIX)
+
+
+def value_encodings(value) -> list:
+    """Returns the ways basic data `value` is stored: plain and packed."""
+    try:
+        if is_packed(value):
+            return [value, unpack_value(value)]
+        return [value, pack_value(value)]
+    except (TypeError, ValueError):
+        return [value]
+
+
+_NONE, _FALSE, _TRUE, _INT, _STR, _LIST, _INT_LIST = range(7)
+
+
+def _pack(value, buf: bytearray):
+    if value is None:
+        buf.append(_NONE)
+    elif value is False:
+        buf.append(_FALSE)
+    elif value is True:
+        buf.append(_TRUE)
+    elif isinstance(value, int):
+        buf.append(_INT)
+        _pack_varint(value << 1 if value >= 0 else (~value << 1) | 1, buf)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        buf.append(_STR)
+        _pack_varint(len(data), buf)
+        buf.extend(data)
+    elif isinstance(value, list):
+        if value and all(type(item) is int for item in value):
+            buf.append(_INT_LIST)
+            _pack_varint(len(value), buf)
+            for item in value:
+                _pack_varint(item << 1 if item >= 0 else (~item << 1) | 1,
+                             buf)
+        else:
+            buf.append(_LIST)
+            _pack_varint(len(value), buf)
+            for item in value:
+                _pack(item, buf)
+    else:
+        raise TypeError('Cannot pack %r' % (value,))
+
+
+def _pack_varint(number: int, buf: bytearray):
+    while number > 0x7f:
+        buf.append(number & 0x7f | 0x80)
+        number >>= 7
+    buf.append(number)
+
+
+def _unpack(buf: bytes, pos: int) -> tuple:
+    if pos >= len(buf):
+        raise ValueError('Truncated packed value')
+    tag = buf[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _INT:
+        number, pos = _unpack_varint(buf, pos)
+        return _unzigzag(number), pos
+    if tag == _STR:
+        size, pos = _unpack_varint(buf, pos)
+        if pos + size > len(buf):
+            raise ValueError('Truncated packed value')
+        return buf[pos:pos + size].decode('utf-8'), pos + size
+    if tag in (_LIST, _INT_LIST):
+        size, pos = _unpack_varint(buf, pos)
+        items = []
+        for _ in range(size):
+            if tag == _INT_LIST:
+                number, pos = _unpack_varint(buf, pos)
+                items.append(_unzigzag(number))
+            else:
+                item, pos = _unpack(buf, pos)
+                items.append(item)
+        return items, pos
+    raise ValueError('Unknown packed value tag %d' % tag)
+
+
+def _unpack_varint(buf: bytes, pos: int) -> tuple:
+    number = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError('Truncated packed value')
+        byte = buf[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return number, pos
+        shift += 7
+
+
+def _unzigzag(number: int) -> int:
+    return number >> 1 if not number & 1 else ~(number >> 1)
+
+
+def expired_docs(docs: list, max_examples: int=None, max_age: float=None,
+                 now: float=None) -> list:
+    """Returns example documents which don't fit retention policy: all but
+    `max_examples` most recently saved ones of each key and the ones saved
+    more than `max_age` seconds ago. Documents without save time are taken
+    as the oldest ones, but they are never too old."""
+    now = time.time() if now is None else now
+    by_key = collections.defaultdict(list)
+    for doc in docs:
+        by_key[tuple(doc['key'])].append(doc)
+
+    expired = []
+    for key_docs in by_key.values():
+        key_docs.sort(key=lambda doc: doc.get('saved_at', 0), reverse=True)
+        for number, doc in enumerate(key_docs):
+            if max_examples is not None and number >= max_examples:
+                expired.append(doc)
+            elif (max_age is not None and 'saved_at' in doc
+                  and doc['saved_at'] < now - max_age):
+                expired.append(doc)
+    return expired
+
+
+def example_id(key: list, value) -> str:
+    """Returns document id derived from formatted example key and value."""
+    data = canonical_json([key, value])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def example_doc(docid: str, key: list, value, saved_at: int=None) -> dict:
+    """Returns document of example with formatted `key`. It's taken as saved
+    now unless `saved_at` is given."""
+    return {'_id': docid,
+            'key': key,
+            'value': value,
+            'type': 'example',
+            'saved_at': int(time.time()) if saved_at is None else saved_at}
+
+
+def deletion_stubs(rows: list) -> list:
+    """Returns stubs which delete documents of ``_all_docs`` `rows`, skipping
+    the missing and already deleted ones."""
+    return [{'_id': row['id'],
+             '_rev': row['value']['rev'],
+             '_deleted': True}
+            for row in rows
+            if 'error' not in row and not row['value'].get('deleted')]
+
+
+def outdated_ddoc(local_ddoc: dict, remote_ddoc: dict) -> dict:
+    """Returns design document to store for `remote_ddoc` to have the view
+    and validation of `local_ddoc`, keeping everything else of it. Missing
+    `remote_ddoc` is ``None`` and gets replaced by `local_ddoc` as is.
+    Returns ``None`` when it's up to date."""
+    if remote_ddoc is None:
+        return local_ddoc
+
+    expected_view = local_ddoc.get('views', {}).get('by_key')
+    stored_view = remote_ddoc.get('views', {}).get('by_key', {})
+    expected_validate = local_ddoc['validate_doc_update']
+
+    if ((expected_view is None or expected_view == stored_view)
+            and expected_validate == remote_ddoc.get('validate_doc_update')):
+        return None
+
+    ddoc = dict(remote_ddoc)
+    if expected_view is not None:
+        ddoc['views'] = dict(ddoc.get('views', {}), by_key=expected_view)
+    ddoc['validate_doc_update'] = expected_validate
+    return ddoc
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import bisect
+import contextlib
+import copy
+import functools
+import threading
+import time
+
+
+__all__ = (
+    'Instrumentation',
+    'instrumented',
+)
+
+
+#: Upper bounds, in seconds, of latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, float('inf'))
+
+
+class Instrumentation(object):
+    """Collects statistics of example database operations and HTTP requests
+    they make.
+
+    Every operation call (``save``, ``fetch``, ``delete``, ``setup`` etc.)
+    is counted along with its latency and failure. Every HTTP request is
+    attributed to the operation which made it and counted along with its
+    latency, response status and amount of bytes sent and received.
+
+    Optional `hook` is called with a dict for each of these events. Once
+    backend gets closed, :meth:`report` is written to `stream` if it's
+    given. The same instance may be shared between several backends.
+    """
+
+    def __init__(self, hook=None, stream=None):
+        self.hook = hook
+        self.stream = stream
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def current_operation(self) -> str:
+        """Name of the operation which runs in the current thread."""
+        return getattr(self._local, 'operation', None)
+
+    @contextlib.contextmanager
+    def operation(self, name: str):
+        """Context manager which measures operation call and attributes
+        requests made within it to that operation."""
+        previous = self.current_operation
+        self._local.operation = name
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            self._local.operation = previous
+            self.record_call(name, time.perf_counter() - start, error)
+
+    def record_call(self, operation: str, duration: float,
+                    error: Exception=None):
+        with self._lock:
+            stats = self._operation_stats(operation)
+            stats['calls'] += 1
+            stats['errors'] += error is not None
+            add_latency(stats['latency'], duration)
+        if self.hook is not None:
+            self.hook({'event': 'call',
+                       'operation': operation,
+                       'duration': duration,
+                       'error': error})
+
+    def record_request(self, operation: str, method: str, url: str,
+                       status: int, sent: int, received: int,
+                       duration: float):
+        operation = operation or 'other'
+        with self._lock:
+            stats = self._operation_stats(operation)
+            stats['requests'] += 1
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            add_latency(stats['request_latency'], duration)
+        if self.hook is not None:
+            self.hook({'event': 'request',
+                       'operation': operation,
+                       'method': method,
+                       'url': url,
+                       'status': status,
+                       'sent': sent,
+                       'received': received,
+                       'duration': duration})
+
+    def summary(self) -> dict:
+        """Returns collected statistics by operation names."""
+        with self._lock:
+            return copy.deepcopy(self._stats)
+
+    def report(self) -> str:
+        """Returns collected statistics as a human readable table."""
+        lines = ['%-10s %7s %6s %8s %10s %10s %9s %9s %9s  %s' % (
+            'operation', 'calls', 'errors', 'requests', 'sent', 'received',
+            'avg', 'p95', 'max', 'statuses')]
+        for operation, stats in sorted(self.summary().items()):
+            latency = stats['latency']
+            if not latency['count']:
+                latency = stats['request_latency']
+            lines.append('%-10s %7d %6d %8d %10d %10d %8.1fms %8.1fms %8.1fms'
+                         '  %s' % (
+                             operation,
+                             stats['calls'],
+                             stats['errors'],
+                             stats['requests'],
+                             stats['bytes_sent'],
+                             stats['bytes_received'],
+                             mean(latency) * 1000,
+                             percentile(latency, 0.95) * 1000,
+                             latency['max'] * 1000,
+                             ' '.join('%s:%d' % item for item in sorted(
+                                 stats['statuses'].items(),
+                                 key=lambda item: str(item[0])))))
+        return '\n'.join(lines)
+
+    def dump(self):
+        """Writes :meth:`report` to the `stream`, if any."""
+        if self.stream is not None:
+            self.stream.write(self.report() + '\n')
+            self.stream.flush()
+
+    def _operation_stats(self, operation: str) -> dict:
+        if operation not in self._stats:
+            self._stats[operation] = {
+                'calls': 0,
+                'errors': 0,
+                'latency': new_latency(),
+                'requests': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'statuses': {},
+                'request_latency': new_latency(),
+            }
+        return self._stats[operation]
+
+
+def instrumented(operation: str):
+    """Decorates backend method to measure it as the named operation when
+    the backend has instrumentation enabled."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.instrumentation is None:
+                return func(self, *args, **kwargs)
+            with self.instrumentation.operation(operation):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def new_latency() -> dict:
+    return {'count': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'histogram': [0] * len(LATENCY_BUCKETS)}
+
+
+def add_latency(latency: dict, duration: float):
+    latency['count'] += 1
+    latency['total'] += duration
+    latency['max'] = max(latency['max'], duration)
+    latency['histogram'][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+
+def mean(latency: dict) -> float:
+    return latency['total'] / latency['count'] if latency['count'] else 0.0
+
+
+def percentile(latency: dict, fraction: float) -> float:
+    """Returns upper bound of the histogram bucket which holds the requested
+    fraction of measurements, but not more than the max one."""
+    threshold = latency['count'] * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, latency['histogram']):
+        seen += count
+        if count and seen >= threshold:
+            return min(bound, latency['max'])
+    return latency['max']
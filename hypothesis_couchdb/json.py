@@ -13,8 +13,10 @@
 # the License.
 #
 
-import math
-from functools import reduce
+import itertools
+import sys
+import weakref
+from json import dumps
 
 import hypothesis.strategies as st
 
@@ -30,6 +32,39 @@ __all__ = (
 )
 
 
+#: Marks optional object field which is not generated.
+ABSENT = object()
+
+#: Kinds of tokens which nested values are built from: a scalar value,
+#: opening of an array or object and closing of the innermost open one.
+LEAF, ARRAY, OBJECT, CLOSE = range(4)
+
+#: Bytes taken by ``json.dumps`` to separate array items or object members.
+ITEM_SEPARATOR_SIZE = len(', ')
+
+#: Bytes taken by ``json.dumps`` to separate object member key from value.
+KEY_SEPARATOR_SIZE = len(': ')
+
+#: Bytes taken by empty array or object.
+EMPTY_CONTAINER_SIZE = len('[]')
+
+#: Default limit of scalar values in nested ones.
+MAX_LEAVES = 100
+
+#: The least byte budget for values, so any of them fits ``null`` at least.
+MIN_ENCODED_BYTES = len('null')
+
+#: The least bytes taken by an array item along with its separator.
+MIN_ITEM_SIZE = ITEM_SEPARATOR_SIZE + len('0')
+
+#: The least bytes taken by an object member along with its separator.
+MIN_MEMBER_SIZE = MIN_ITEM_SIZE + len('""') + KEY_SEPARATOR_SIZE
+
+#: Limits of the strategies made by :func:`values`, so arrays and objects of
+#: them are built from tokens within what their own limits leave.
+VALUES_LIMITS = weakref.WeakKeyDictionary()
+
+
 def nulls():
     """Generates ``None`` values.
 
@@ -57,8 +92,26 @@ def numbers(min_value=None, max_value=None):
     min_value_int = int(min_value) if min_value is not None else None
     max_value_int = int(max_value) if max_value is not None else None
     integers = st.integers(min_value=min_value_int, max_value=max_value_int)
-    floats = st.floats(min_value=min_value, max_value=max_value)
-    return integers | floats.filter(math.isfinite)
+    return integers | finite_floats(min_value, max_value)
+
+
+def finite_floats(min_value=None, max_value=None):
+    """Generates finite floats without rejecting special values: they are
+    never produced."""
+    if min_value is not None and max_value is not None:
+        return st.floats(min_value=min_value, max_value=max_value)
+
+    floats = st.floats(allow_nan=False, allow_infinity=False)
+    # Half-bounded floats are shifted by the bound, which may overflow.
+    if min_value is not None:
+        min_value = float(min_value)
+        return st.just(min_value) | floats.map(
+            lambda x: min(min_value + abs(x), sys.float_info.max))
+    if max_value is not None:
+        max_value = float(max_value)
+        return st.just(max_value) | floats.map(
+            lambda x: max(max_value - abs(x), -sys.float_info.max))
+    return floats
 
 
 def strings(*, alphabet=None, min_size=None, average_size=None, max_size=None):
@@ -76,20 +129,68 @@ def arrays(elements, *,
            min_size=None,
            average_size=None,
            max_size=None,
-           unique_by=None):
+           unique_by=None,
+           max_depth=None,
+           max_leaves=None,
+           max_encoded_bytes=None):
     """Returns a strategy that generates lists of specified `elements`.
     The `elements` must be valid Hypothesis strategy.
 
     While choice of elements left here for user side, it's not recommended to
     use anything that produces non-serializable to JSON values.
 
+    Elements which would make the list nested deeper than `max_depth`, hold
+    more than `max_leaves` scalar values in total or take more than
+    `max_encoded_bytes` encoded to JSON (see :func:`encoded_size`) are left
+    out, so lists may get shorter than `min_size` then. No more elements are
+    drawn than the limits may hold. Elements of :func:`values` are built one
+    by one from tokens within what the limits leave, `average_size` is not
+    used then.
+
     Basically is a proxy to ``hypothesis.strategies.lists()``.
     """
-    return st.lists(elements,
-                    min_size=min_size,
-                    average_size=average_size,
-                    max_size=max_size,
-                    unique_by=unique_by)
+    if max_depth is None and max_leaves is None and max_encoded_bytes is None:
+        return st.lists(elements,
+                        min_size=min_size,
+                        average_size=average_size,
+                        max_size=max_size,
+                        unique_by=unique_by)
+
+    check_limits(max_depth, max_leaves, max_encoded_bytes, min_depth=1)
+
+    if elements in VALUES_LIMITS:
+        limits = VALUES_LIMITS[elements]
+
+        def build(tokens):
+            budget = Budget(max_depth, max_leaves, max_encoded_bytes)
+            items, seen = [], set()
+            for _, item in build_items(tokens, budget, limits):
+                if len(items) == max_size:
+                    break
+                if unique_by is not None and unique_by(item) in seen:
+                    continue
+                if budget.take(item):
+                    items.append(item)
+                    if unique_by is not None:
+                        seen.add(unique_by(item))
+            return items
+
+        return tokens(MAX_LEAVES if max_leaves is None
+                      else max_leaves).map(build)
+
+    max_size = least(max_size, max_items(max_depth, max_leaves,
+                                         max_encoded_bytes, MIN_ITEM_SIZE))
+    strategy = st.lists(elements,
+                        min_size=least(min_size, max_size),
+                        average_size=least(average_size, max_size),
+                        max_size=max_size,
+                        unique_by=unique_by)
+
+    def fit(items):
+        budget = Budget(max_depth, max_leaves, max_encoded_bytes)
+        return [item for item in items if budget.take(item)]
+
+    return strategy.map(fit)
 
 
 def objects(elements=None, *,
@@ -97,7 +198,10 @@ def objects(elements=None, *,
             optional_fields=None,
             min_size=None,
             average_size=None,
-            max_size=None):
+            max_size=None,
+            max_depth=None,
+            max_leaves=None,
+            max_encoded_bytes=None):
     """Returns a strategy that generates dicts of specified `elements`.
 
     The `elements` must be valid Hypothesis strategy. The keys are ensured to
@@ -109,44 +213,331 @@ def objects(elements=None, *,
     Also possible to ensure that some fields with values generated by a certain
     strategy are always exists (`required_fields`) or just optional
     (`optional_fields`).
+
+    Fields which would make the dict nested deeper than `max_depth`, hold
+    more than `max_leaves` scalar values in total or take more than
+    `max_encoded_bytes` encoded to JSON (see :func:`encoded_size`) are left
+    out. Required fields are never left out, so they have to fit by
+    themselves, while optional and then random ones take what remains. No
+    more random fields are drawn than the limits may hold. Random fields of
+    :func:`values` are built one by one from tokens within what remains,
+    `average_size` is not used then.
     """
     def check_type(varname, var, expected):
         if not isinstance(var, expected):
             raise TypeError('{} must be {}, got {}'.format(
                 varname, expected, type(var)))
 
-    acc = []
-    if required_fields:
-        check_type('required_fields', required_fields, dict)
-        for key in required_fields:
-            check_type('required field name', key, str)
-        acc.append(st.fixed_dictionaries(required_fields))
+    limited = not (max_depth is None and max_leaves is None
+                   and max_encoded_bytes is None)
+    if limited:
+        check_limits(max_depth, max_leaves, max_encoded_bytes, min_depth=1)
 
+    parts = []
+    if elements and limited and elements in VALUES_LIMITS:
+        parts.append(tokens(MAX_LEAVES if max_leaves is None
+                            else max_leaves))
+    elif elements:
+        if limited:
+            max_size = least(max_size,
+                             max_items(max_depth, max_leaves,
+                                       max_encoded_bytes, MIN_MEMBER_SIZE))
+            min_size = least(min_size, max_size)
+            average_size = least(average_size, max_size)
+        parts.append(st.dictionaries(strings(), elements,
+                                     min_size=min_size,
+                                     average_size=average_size,
+                                     max_size=max_size))
+    else:
+        parts.append(st.just(None))
+
+    optional_keys = []
     if optional_fields:
         check_type('optional_fields', optional_fields, dict)
         for key in optional_fields:
             check_type('optional field name', key, str)
-        acc.append(st.sets(st.sampled_from(optional_fields)).flatmap(
-            lambda keys: st.fixed_dictionaries({key: optional_fields[key]
-                                                for key in keys})))
-    if elements:
-        acc.append(st.dictionaries(strings(), elements,
-                                   min_size=min_size,
-                                   average_size=average_size,
-                                   max_size=max_size))
-
-    if not acc:
+        # Absent field goes first, so it's what optional fields shrink to.
+        optional_keys = sorted(optional_fields)
+        parts.append(st.tuples(*[st.just(ABSENT) | optional_fields[key]
+                                 for key in optional_keys]))
+    else:
+        parts.append(st.just(()))
+
+    required_keys = []
+    if required_fields:
+        check_type('required_fields', required_fields, dict)
+        for key in required_fields:
+            check_type('required field name', key, str)
+        required_keys = sorted(required_fields)
+        parts.append(st.tuples(*[required_fields[key]
+                                 for key in required_keys]))
+    else:
+        parts.append(st.just(()))
+
+    if not (elements or optional_fields or required_fields):
         raise RuntimeError('object must have any strategy for fields')
 
-    return st.tuples(*reversed(acc)).map(
-        lambda s: reduce(lambda a, d: dict(a, **d), s))
+    def build(values):
+        random, optional, required = values
+        if limited:
+            return fit(random,
+                       zip(optional_keys, optional),
+                       zip(required_keys, required))
+        # Drawn dictionary is a fresh one, so it's filled in place.
+        obj = random if random is not None else {}
+        obj.update((key, value)
+                   for key, value in zip(optional_keys, optional)
+                   if value is not ABSENT)
+        obj.update(zip(required_keys, required))
+        return obj
+
+    def fit(random, optional, required):
+        budget = Budget(max_depth, max_leaves, max_encoded_bytes)
+        obj = {}
+        for key, value in required:
+            budget.take(value, key, force=True)
+            obj[key] = value
+        for key, value in optional:
+            if (value is not ABSENT and key not in obj
+                    and budget.take(value, key)):
+                obj[key] = value
+        if isinstance(random, dict):
+            members = random.items()
+        elif random:
+            members = build_items(random, budget, VALUES_LIMITS[elements],
+                                  keyed=True)
+        else:
+            members = ()
+        taken = 0
+        for key, value in members:
+            if taken == max_size:
+                break
+            if key not in obj and budget.take(value, key):
+                obj[key] = value
+                taken += 1
+        return obj
 
+    return st.tuples(*parts).map(build)
 
-def values():
+
+def values(*, max_depth=None, max_leaves=MAX_LEAVES, max_encoded_bytes=None):
     """Returns a strategy that unifies all strategies that produced valid JSON
     serializable values.
+
+    Nested arrays and objects are built from a flat list of tokens, so the
+    work to generate a value is bounded: there are no more than `max_leaves`
+    scalar values in it. Containers are nested no deeper than `max_depth` and
+    the value takes no more than `max_encoded_bytes` encoded to JSON (see
+    :func:`encoded_size`). These limits are tracked while the value is built,
+    tokens which would exceed them are left out, so nothing gets rejected.
     """
-    def extend(children):
-        return arrays(children) | objects(children)
+    check_limits(max_depth, max_leaves, max_encoded_bytes)
+    strategy = tokens(max_leaves).map(
+        lambda tokens: build_value(tokens, max_depth, max_leaves,
+                                   max_encoded_bytes))
+    VALUES_LIMITS[strategy] = (max_depth, max_leaves, max_encoded_bytes)
+    return strategy
+
+
+def tokens(max_leaves=MAX_LEAVES):
+    """Generates lists of tokens to build nested JSON values from with
+    :func:`build_value`."""
     simple_values = nulls() | booleans() | numbers() | strings()
-    return simple_values | st.recursive(simple_values, extend)
+    keys = strings()
+    # Scalars go first, so tokens shrink to them rather than to containers.
+    token = (st.tuples(st.just(LEAF), keys, simple_values)
+             | st.tuples(st.just(ARRAY), keys, st.none())
+             | st.tuples(st.just(OBJECT), keys, st.none())
+             | st.just((CLOSE, '', None)))
+    max_tokens = None if max_leaves is None else 2 * max_leaves + 1
+    return st.lists(token, max_size=max_tokens)
+
+
+def build_value(tokens, max_depth=None, max_leaves=None,
+                max_encoded_bytes=None, root=None, default=None):
+    """Builds JSON value from `tokens`. The first token which fits into
+    limits makes the value, which is a scalar or a container filled with the
+    following tokens till it's closed, or `default` if there is no such
+    token. Tokens which don't fit are left out and so is the content of
+    containers they open. Tokens which follow the value are not consumed,
+    so an iterator of them may be used to build the next value.
+
+    Given `root` container is filled with the tokens instead. What it holds
+    already counts against the limits and is never replaced.
+    """
+    value = root if root is not None else default
+    # Open containers, None stands for the left out ones.
+    stack = []
+    leaves = size = 0
+    if root is not None:
+        stack.append(root)
+        _, leaves, size = measure(root)
+    for kind, key, leaf in tokens:
+        if kind == CLOSE:
+            # Closing of the value itself completes it.
+            if stack and stack.pop() is not None and not stack:
+                break
+            continue
+        if stack and stack[-1] is None:
+            if kind != LEAF:
+                stack.append(None)
+            continue
+
+        parent = stack[-1] if stack else None
+        if kind == LEAF:
+            node, cost = leaf, encoded_size(leaf)
+            fits = within(leaves + 1, max_leaves)
+        else:
+            node, cost = [] if kind == ARRAY else {}, EMPTY_CONTAINER_SIZE
+            fits = within(len(stack) + 1, max_depth)
+        if parent:
+            cost += ITEM_SEPARATOR_SIZE
+        if isinstance(parent, dict):
+            cost += encoded_size(key) + KEY_SEPARATOR_SIZE
+            fits = fits and key not in parent
+        if not fits or not within(size + cost, max_encoded_bytes):
+            if kind != LEAF:
+                stack.append(None)
+            continue
+
+        size += cost
+        if kind == LEAF:
+            leaves += 1
+        if parent is None:
+            value = node
+        elif isinstance(parent, dict):
+            parent[key] = node
+        else:
+            parent.append(node)
+        if kind != LEAF:
+            stack.append(node)
+        elif not stack:
+            break
+    return value
+
+
+def build_items(tokens, budget, limits, keyed=False):
+    """Yields items of a container built from `tokens` one by one, each
+    within `limits` of :func:`values` they are made for and within what
+    `budget` of the container has left at the time. Items are yielded as
+    ``(key, value)`` pairs, with the key of the first token of the value for
+    object members and ``None`` for array items."""
+    max_depth, max_leaves, max_encoded_bytes = limits
+    tokens = iter(tokens)
+    for token in tokens:
+        key = token[1] if keyed else None
+        size = budget.size
+        if not budget.empty:
+            size += ITEM_SEPARATOR_SIZE
+        if keyed:
+            size += encoded_size(key) + KEY_SEPARATOR_SIZE
+        if budget.max_leaves is not None:
+            max_leaves = least(max_leaves, budget.max_leaves - budget.leaves)
+        if budget.max_encoded_bytes is not None:
+            max_encoded_bytes = least(max_encoded_bytes,
+                                      budget.max_encoded_bytes - size)
+        if budget.max_depth is not None:
+            max_depth = least(max_depth, budget.max_depth - 1)
+        value = build_value(itertools.chain([token], tokens), max_depth,
+                            max_leaves, max_encoded_bytes, default=ABSENT)
+        if value is not ABSENT:
+            yield key, value
+
+
+class Budget(object):
+    """Tracks depth, scalar values and encoded size of a container while it's
+    filled, so values which don't fit into limits are left out of it."""
+
+    def __init__(self, max_depth=None, max_leaves=None,
+                 max_encoded_bytes=None):
+        self.max_depth = max_depth
+        self.max_leaves = max_leaves
+        self.max_encoded_bytes = max_encoded_bytes
+        self.leaves = 0
+        self.size = EMPTY_CONTAINER_SIZE
+        self.empty = True
+
+    def take(self, value, key=None, force=False) -> bool:
+        """Accounts `value` as the next item of the container, or as its
+        member under `key`, if it fits into limits or `force` is set.
+        Returns whether it's taken."""
+        depth, leaves, size = measure(value)
+        if key is not None:
+            size += encoded_size(key) + KEY_SEPARATOR_SIZE
+        if not self.empty:
+            size += ITEM_SEPARATOR_SIZE
+        if not force and not (
+                within(depth + 1, self.max_depth)
+                and within(self.leaves + leaves, self.max_leaves)
+                and within(self.size + size, self.max_encoded_bytes)):
+            return False
+        self.leaves += leaves
+        self.size += size
+        self.empty = False
+        return True
+
+
+def measure(value) -> tuple:
+    """Returns nesting depth of `value`, amount of scalar values in it and
+    its :func:`encoded_size`."""
+    if isinstance(value, list):
+        items = [measure(item) for item in value]
+        size = 0
+    elif isinstance(value, dict):
+        items = [measure(item) for item in value.values()]
+        size = sum(encoded_size(key) + KEY_SEPARATOR_SIZE for key in value)
+    else:
+        return 0, 1, encoded_size(value)
+    size += EMPTY_CONTAINER_SIZE + ITEM_SEPARATOR_SIZE * max(len(items) - 1, 0)
+    return (1 + max([item[0] for item in items] or [0]),
+            sum(item[1] for item in items),
+            size + sum(item[2] for item in items))
+
+
+def encoded_size(value) -> int:
+    """Returns size of `value` in bytes as ``json.dumps`` encodes it with
+    default arguments. Non-ASCII characters are escaped then, so neither
+    compact nor UTF-8 encoding of the value is bigger."""
+    return len(dumps(value))
+
+
+def encode(value) -> bytes:
+    """Encodes `value` to canonical JSON: compact, with sorted object keys
+    and non-ASCII characters escaped, so it's valid UTF-8 as well."""
+    return dumps(value, sort_keys=True, separators=(',', ':'),
+                 allow_nan=False).encode('ascii')
+
+
+def within(amount, limit) -> bool:
+    return limit is None or amount <= limit
+
+
+def least(*limits):
+    """Returns the least of `limits` which are set, if any."""
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def max_items(max_depth, max_leaves, max_encoded_bytes, item_size):
+    """Returns how many items of at least `item_size` bytes a container
+    may hold within the limits, or ``None`` if there is no such bound.
+    Items hold a scalar value at least when they can't be containers."""
+    limit = None
+    if max_encoded_bytes is not None:
+        limit = ((max_encoded_bytes - EMPTY_CONTAINER_SIZE
+                  + ITEM_SEPARATOR_SIZE) // item_size)
+    if max_depth == 1:
+        limit = least(limit, max_leaves)
+    return limit
+
+
+def check_limits(max_depth, max_leaves, max_encoded_bytes, min_depth=0):
+    if max_depth is not None and max_depth < min_depth:
+        raise ValueError('max_depth must be at least {}, got {}'.format(
+            min_depth, max_depth))
+    if max_leaves is not None and max_leaves < 0:
+        raise ValueError('max_leaves must not be negative, got {}'.format(
+            max_leaves))
+    if max_encoded_bytes is not None and max_encoded_bytes < MIN_ENCODED_BYTES:
+        raise ValueError('max_encoded_bytes must be at least {}, got {}'
+                         .format(MIN_ENCODED_BYTES, max_encoded_bytes))
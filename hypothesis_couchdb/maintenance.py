@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Enforces retention policy over the whole example database. Run it as::
+
+  python -m hypothesis_couchdb.maintenance \\
+      http://localhost:5984/hypothesis --max-examples 100 --max-age 90 \\
+      --compact
+
+Oversized keys are found with ``_count`` reduce of ``by_key`` view, their
+examples which don't fit the policy are deleted with ``_bulk_docs`` requests
+and then database and view compaction are started.
+"""
+
+import argparse
+import getpass
+import os
+import sys
+
+from .example_db import (
+    PRUNE_BATCH_SIZE,
+    CouchBackend,
+    request,
+    url,
+)
+
+
+__all__ = (
+    'key_counts',
+    'prune',
+    'compact',
+)
+
+
+#: Environment variable to take password from instead of asking for it.
+PASSWORD_ENV = 'HYPOTHESIS_COUCHDB_PASSWORD'
+
+
+def key_counts(backend: CouchBackend) -> list:
+    """Returns formatted keys along with amount of their examples."""
+    backend._ensure_setup()
+    result = request(
+        method='GET',
+        url=url(backend.url, '_design', 'hypothesis', '_view', 'by_key',
+                group='true'),
+        headers=backend.headers,
+        pool=backend.pool)
+    return [(row['key'], row['value']) for row in result['rows']]
+
+
+def prune(backend: CouchBackend, dry_run: bool=False,
+          batch_size: int=PRUNE_BATCH_SIZE) -> int:
+    """Prunes the keys which may not fit retention policy of `backend`: the
+    ones with more than `max_examples` examples or all of them when
+    `max_age` is set. Returns amount of deleted examples, or the ones to
+    delete with `dry_run`."""
+    counts = key_counts(backend)
+    if backend.max_age is not None:
+        keys = [key for key, _ in counts]
+    elif backend.max_examples is not None:
+        keys = [key for key, count in counts if count > backend.max_examples]
+    else:
+        keys = []
+
+    return backend.prune(keys, dry_run=dry_run, batch_size=batch_size)
+
+
+def compact(backend: CouchBackend):
+    """Starts compaction of the database and ``by_key`` view along with
+    cleanup of outdated view indexes. Requires admin privileges."""
+    for path in (('_compact',), ('_compact', 'hypothesis'),
+                 ('_view_cleanup',)):
+        request(
+            method='POST',
+            url=url(backend.url, *path),
+            headers=backend.headers,
+            pool=backend.pool)
+
+
+def main(argv: list=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m hypothesis_couchdb.maintenance',
+        description='Prunes and compacts CouchDB example database.')
+    parser.add_argument('dburl',
+                        help='database URL, e.g. '
+                             'http://localhost:5984/hypothesis')
+    parser.add_argument('--max-examples', type=int,
+                        help='amount of the latest examples to keep per key')
+    parser.add_argument('--max-age', type=float, metavar='DAYS',
+                        help='delete examples saved earlier than that')
+    parser.add_argument('--user',
+                        help='user name; password is taken from %s '
+                             'environment variable or asked' % PASSWORD_ENV)
+    parser.add_argument('--compact', action='store_true',
+                        help='start database and view compaction after')
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only count examples to delete")
+    args = parser.parse_args(argv)
+    if args.max_examples is None and args.max_age is None and not args.compact:
+        parser.error('nothing to do')
+
+    credentials = None
+    if args.user:
+        credentials = (args.user,
+                       os.environ.get(PASSWORD_ENV) or getpass.getpass())
+    backend = CouchBackend(
+        args.dburl, credentials,
+        max_examples=args.max_examples,
+        max_age=None if args.max_age is None else args.max_age * 86400,
+        setup_marker_dir=None)
+    try:
+        deleted = prune(backend, dry_run=args.dry_run)
+        sys.stdout.write('%s %d examples\n' % (
+            'Would delete' if args.dry_run else 'Deleted', deleted))
+        if args.compact and not args.dry_run:
+            compact(backend)
+            sys.stdout.write('Compaction started\n')
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Benchmarks example database backends against :class:`FakeCouchDB`.
+
+Run it as::
+
+  python -m hypothesis_couchdb.tests.benchmark --latency 2 -o results.json
+
+Results are written as JSON: a list of measurements, one per operation and
+scenario, so two runs may be compared with :func:`compare`::
+
+  python -m hypothesis_couchdb.tests.benchmark --compare old.json new.json
+
+With ``--compression`` it measures instead how much and how fast example
+documents of different sizes get compressed, which is what
+:data:`~hypothesis_couchdb.example_db.COMPRESSION_THRESHOLD` is based on.
+
+With ``--indexing`` it measures how long the first fetch after a lot of
+saves, which has to update the index, and the following ones take with each
+of :data:`~hypothesis_couchdb.example_db.LOOKUPS`.
+"""
+
+import argparse
+import concurrent.futures
+import gzip
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+
+from hypothesis_couchdb import (
+    example_db,
+)
+from hypothesis_couchdb.tests.fake_couchdb import (
+    FakeCouchDB,
+)
+
+
+__all__ = (
+    'run',
+    'run_scenario',
+    'compare',
+    'compression',
+    'indexing',
+)
+
+
+#: Operations measured within each scenario, in order of their run.
+OPERATIONS = ('save', 'fetch', 'delete')
+
+
+def run(examples: tuple=(1, 10, 100),
+        concurrency: tuple=(1, 4),
+        keys: int=10,
+        latency: float=0,
+        backend_class: type=example_db.CouchBackend,
+        **options) -> dict:
+    """Runs scenario for each combination of amount of `examples` per key
+    and `concurrency` against own fake server which delays every request by
+    `latency` seconds. Extra keyword arguments are passed to `backend_class`.
+    """
+    results = []
+    with FakeCouchDB(latency=latency) as couch:
+        for number, (per_key, workers) in enumerate(
+                itertools.product(examples, concurrency)):
+            dburl = '%s/bench%d' % (couch.url, number)
+            results.extend(run_scenario(dburl, per_key, workers, keys,
+                                        backend_class, **options))
+    return {'python': platform.python_version(),
+            'backend': backend_class.__name__,
+            'options': options,
+            'latency': latency,
+            'results': results}
+
+
+def run_scenario(dburl: str, examples: int, concurrency: int, keys: int,
+                 backend_class: type=example_db.CouchBackend,
+                 **options) -> list:
+    """Saves `examples` per each of `keys` from `concurrency` threads, then
+    fetches and deletes them all the same way. Returns measurement for each
+    operation."""
+    options.setdefault('setup_marker_dir', None)
+    backend = backend_class(dburl, **options)
+    items = [('bench.Test.test_%d' % key, [key, value])
+             for key in range(keys) for value in range(examples)]
+    calls = {
+        'save': [(backend.save, item) for item in items],
+        'fetch': [(fetch_all(backend), ('bench.Test.test_%d' % key,))
+                  for key in range(keys)],
+        'delete': [(backend.delete, item) for item in items],
+    }
+    try:
+        # Setup cost is not a part of any operation.
+        backend.fetch('bench.Test.setup')
+        results = []
+        for operation in OPERATIONS:
+            results.append(dict(measure(calls[operation], concurrency),
+                                operation=operation,
+                                examples=examples,
+                                concurrency=concurrency,
+                                keys=keys))
+            if hasattr(backend, 'flush'):
+                backend.flush()
+        return results
+    finally:
+        backend.close()
+
+
+def fetch_all(backend: example_db.Backend):
+    # Streamed fetch is not done until all values are read.
+    return lambda key: list(backend.fetch(key))
+
+
+def measure(calls: list, concurrency: int) -> dict:
+    """Makes all the `calls` with `concurrency` threads. Returns throughput
+    and latency statistic."""
+    def timed(func, args):
+        start = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        durations = sorted(executor.map(lambda call: timed(*call), calls))
+    elapsed = time.perf_counter() - start
+    return {'calls': len(durations),
+            'seconds': elapsed,
+            'ops_per_second': len(durations) / elapsed if elapsed else 0,
+            'latency': {'mean': sum(durations) / len(durations),
+                        'p50': percentile(durations, 0.5),
+                        'p95': percentile(durations, 0.95),
+                        'p99': percentile(durations, 0.99),
+                        'max': durations[-1]}}
+
+
+def percentile(durations: list, fraction: float) -> float:
+    """Returns nearest-rank percentile of sorted `durations`."""
+    index = max(0, min(len(durations) - 1,
+                       int(round(fraction * len(durations))) - 1))
+    return durations[index]
+
+
+def compare(old: dict, new: dict) -> list:
+    """Returns throughput ratio of `new` run to `old` one for each
+    measurement found in both."""
+    def index(run):
+        return {(result['operation'], result['examples'],
+                 result['concurrency'], result['keys']): result
+                for result in run['results']}
+
+    old, new = index(old), index(new)
+    return [{'operation': key[0],
+             'examples': key[1],
+             'concurrency': key[2],
+             'keys': key[3],
+             'old': old[key]['ops_per_second'],
+             'new': new[key]['ops_per_second'],
+             'ratio': (new[key]['ops_per_second']
+                       / old[key]['ops_per_second'])}
+            for key in sorted(old) if key in new]
+
+
+def compression(sizes: tuple=(1, 4, 16, 64, 256, 1024, 4096, 16384),
+                levels: tuple=(1, 6), repeat: int=100) -> list:
+    """Compresses example documents which values are lists of `sizes`
+    random bytes with each of compression `levels`. Returns raw and
+    compressed size along with the time compression takes."""
+    results = []
+    for size in sizes:
+        value = [random.randrange(256) for _ in range(size)]
+        data = json.dumps({'_id': '0' * 64,
+                           'key': ['bench', 'Test', 'test_0'],
+                           'value': value,
+                           'type': 'example'}).encode()
+        for level in levels:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                compressed = gzip.compress(data, level)
+            elapsed = time.perf_counter() - start
+            results.append({'examples': size,
+                            'level': level,
+                            'bytes': len(data),
+                            'compressed_bytes': len(compressed),
+                            'ratio': len(compressed) / len(data),
+                            'seconds': elapsed / repeat})
+    return results
+
+
+def indexing(docs: int=10000, keys: int=100, repeat: int=10,
+             lookups: tuple=example_db.LOOKUPS) -> list:
+    """Saves `docs` examples spread over `keys` with each of `lookups`,
+    then measures the first fetch, which updates the index, and `repeat`
+    fetches of other keys, which only query it."""
+    results = []
+    with FakeCouchDB() as couch:
+        for lookup in lookups:
+            backend = example_db.CouchBackend(
+                '%s/indexing_%s' % (couch.url, lookup), lookup=lookup,
+                batch_size=1000, setup_marker_dir=None)
+            try:
+                for number in range(docs):
+                    backend.save('bench.Test.test_%d' % (number % keys),
+                                 [number])
+                backend.flush()
+                start = time.perf_counter()
+                backend.fetch('bench.Test.test_0')
+                index_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                for number in range(1, repeat + 1):
+                    backend.fetch('bench.Test.test_%d' % (number % keys))
+                query_seconds = (time.perf_counter() - start) / repeat
+            finally:
+                backend.close()
+            results.append({'lookup': lookup,
+                            'docs': docs,
+                            'keys': keys,
+                            'index_seconds': index_seconds,
+                            'query_seconds': query_seconds})
+    return results
+
+
+def main(argv: list=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m hypothesis_couchdb.tests.benchmark',
+        description='Benchmarks CouchDB example database.')
+    parser.add_argument('--examples', type=int, nargs='+',
+                        default=[1, 10, 100],
+                        help='amounts of examples per key')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4],
+                        help='amounts of threads to call backend from')
+    parser.add_argument('--keys', type=int, default=10,
+                        help='amount of keys to store examples for')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='artificial server latency in milliseconds')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=JSON',
+                        help='backend option, e.g. content_ids=true')
+    parser.add_argument('-o', '--output', help='file to write results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare results of two runs instead')
+    parser.add_argument('--compression', action='store_true',
+                        help='measure compression of example documents '
+                             'instead')
+    parser.add_argument('--indexing', type=int, metavar='DOCS',
+                        help='measure index update and query cost of '
+                             'lookups over that amount of examples instead')
+    args = parser.parse_args(argv)
+
+    if args.compression:
+        result = compression()
+    elif args.indexing:
+        result = indexing(docs=args.indexing, keys=args.keys)
+    elif args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            result = compare(json.load(old), json.load(new))
+    else:
+        options = {}
+        for option in args.option:
+            name, _, value = option.partition('=')
+            options[name] = json.loads(value)
+        result = run(examples=args.examples,
+                     concurrency=args.concurrency,
+                     keys=args.keys,
+                     latency=args.latency / 1000,
+                     **options)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
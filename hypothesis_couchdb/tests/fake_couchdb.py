@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""In-process CouchDB stand-in which implements just enough of HTTP API to
+serve :class:`hypothesis_couchdb.example_db.CouchBackend`."""
+
+import gzip
+import hashlib
+import http.server
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+
+__all__ = (
+    'FakeCouchDB',
+)
+
+
+class FakeCouchDB(object):
+    """Runs fake CouchDB server in a background thread on a random port.
+
+    Every request is delayed by `latency` seconds to mimic the network
+    round trip of a remote server.
+
+    Documents bigger than `max_document_size` bytes of JSON, if it's set,
+    are refused with ``too_large`` error.
+
+    Gzip encoded request bodies are accepted as CouchDB does. With
+    `compress` responses are gzip encoded for clients which accept that,
+    like a compressing proxy in front of CouchDB does.
+    """
+
+    def __init__(self, latency: float=0, compress: bool=False,
+                 max_document_size: int=None):
+        self.latency = latency
+        self.max_document_size = max_document_size
+        self.compress = compress
+        self.databases = {}
+        self.connections = 0
+        self.requests = []
+        #: Amount of requests which came with gzip encoded body.
+        self.encoded_requests = 0
+        self.lock = threading.RLock()
+        self.updated = threading.Condition(self.lock)
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.couch = self
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d' % self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method: str, path: list, query: dict, body) -> tuple:
+        with self.lock:
+            self.requests.append((method, '/' + '/'.join(path)))
+            if not path:
+                return 200, {'couchdb': 'Welcome'}
+            dbname, path = path[0], path[1:]
+            if not path:
+                return self.handle_db(method, dbname)
+            if dbname not in self.databases:
+                return 404, {'error': 'not_found', 'reason': 'no_db_file'}
+            db = self.databases[dbname]
+            if path == ['_bulk_docs']:
+                return self.handle_bulk_docs(method, db, body)
+            if path == ['_all_docs']:
+                return self.handle_all_docs(method, db, query, body)
+            if path == ['_changes']:
+                return self.handle_changes(method, db, query)
+            if path == ['_index']:
+                return self.handle_index(method, db, body)
+            if path == ['_find']:
+                return self.handle_find(method, db, body)
+            if path[0] in ('_compact', '_view_cleanup'):
+                if method != 'POST':
+                    return 405, {'error': 'method_not_allowed'}
+                db.compactions.append('/'.join(path))
+                return 202, {'ok': True}
+            if path[0] == '_design' and len(path) > 2:
+                if path[2] == '_view' and len(path) == 4:
+                    return self.handle_view(method, db, path[1], path[3],
+                                            query, body)
+            if path[0] in ('_design', '_local'):
+                path = ['/'.join(path)]
+            if len(path) != 1:
+                return 404, {'error': 'not_found', 'reason': 'missing'}
+            return self.handle_doc(method, db, path[0], query, body)
+
+    def handle_db(self, method: str, dbname: str) -> tuple:
+        if method in ('GET', 'HEAD'):
+            if dbname not in self.databases:
+                return 404, {'error': 'not_found', 'reason': 'no_db_file'}
+            db = self.databases[dbname]
+            return 200, {'db_name': dbname,
+                         'doc_count': len(db),
+                         'update_seq': db.update_seq}
+        if method == 'PUT':
+            if dbname in self.databases:
+                return 412, {'error': 'file_exists'}
+            self.databases[dbname] = Database()
+            return 201, {'ok': True}
+        if method == 'DELETE':
+            if self.databases.pop(dbname, None) is None:
+                return 404, {'error': 'not_found', 'reason': 'missing'}
+            return 200, {'ok': True}
+        return 405, {'error': 'method_not_allowed'}
+
+    def handle_doc(self, method: str, db: dict, docid: str, query: dict,
+                   body) -> tuple:
+        if method in ('GET', 'HEAD'):
+            if docid not in db:
+                return 404, {'error': 'not_found', 'reason': 'missing'}
+            return 200, db[docid]
+        if method == 'PUT':
+            body['_id'] = docid
+            return self.update_doc(db, body)
+        if method == 'DELETE':
+            return self.update_doc(db, {'_id': docid,
+                                        '_rev': query.get('rev'),
+                                        '_deleted': True})
+        return 405, {'error': 'method_not_allowed'}
+
+    def handle_bulk_docs(self, method: str, db: dict, body: dict) -> tuple:
+        if method != 'POST':
+            return 405, {'error': 'method_not_allowed'}
+        results = []
+        for doc in body['docs']:
+            status, result = self.update_doc(db, doc)
+            if status >= 400:
+                result = dict(result, id=doc.get('_id'))
+            results.append(result)
+        return 201, results
+
+    def handle_all_docs(self, method: str, db: dict, query: dict,
+                        body) -> tuple:
+        if method == 'POST':
+            keys = body['keys']
+        elif method == 'GET' and 'keys' in query:
+            keys = json.loads(query['keys'])
+        elif method == 'GET':
+            keys = sorted(db)
+            if 'startkey' in query:
+                startkey = json.loads(query['startkey'])
+                keys = [docid for docid in keys if docid >= startkey]
+            if 'limit' in query:
+                keys = keys[:int(query['limit'])]
+        else:
+            return 405, {'error': 'method_not_allowed'}
+        rows = []
+        for docid in keys:
+            if docid not in db:
+                rows.append({'key': docid, 'error': 'not_found'})
+                continue
+            row = {'id': docid, 'key': docid,
+                   'value': {'rev': db[docid]['_rev']}}
+            if query.get('include_docs') == 'true':
+                row['doc'] = db[docid]
+            rows.append(row)
+        return 200, {'total_rows': len(db), 'offset': 0, 'rows': rows}
+
+    def handle_changes(self, method: str, db: dict, query: dict) -> tuple:
+        if method != 'GET':
+            return 405, {'error': 'method_not_allowed'}
+        since = query.get('since', '0')
+        since = db.update_seq if since == 'now' else int(since)
+        if query.get('feed') == 'longpoll' and db.update_seq <= since:
+            self.updated.wait_for(lambda: db.update_seq > since,
+                                  int(query.get('timeout', 60000)) / 1000)
+        results = []
+        for docid, (seq, rev, deleted) in sorted(db.changes.items(),
+                                                 key=lambda i: i[1][0]):
+            if seq <= since:
+                continue
+            result = {'seq': seq, 'id': docid, 'changes': [{'rev': rev}]}
+            if deleted:
+                result['deleted'] = True
+            if query.get('include_docs') == 'true':
+                result['doc'] = db[docid] if not deleted else {
+                    '_id': docid, '_rev': rev, '_deleted': True}
+            results.append(result)
+        if 'limit' in query:
+            results = results[:int(query['limit'])]
+        last_seq = results[-1]['seq'] if results else max(since,
+                                                          db.update_seq)
+        return 200, {'results': results, 'last_seq': last_seq}
+
+    def handle_view(self, method: str, db: dict, ddoc: str, view: str,
+                    query: dict, body: dict=None) -> tuple:
+        if method not in ('GET', 'POST'):
+            return 405, {'error': 'method_not_allowed'}
+        if '_design/' + ddoc not in db:
+            return 404, {'error': 'not_found', 'reason': 'missing'}
+        update = {'ok': 'false', 'update_after': 'lazy'}.get(
+            query.get('stale'), query.get('update', 'true'))
+        rows = sorted((dict(row) for row in self.update_index(
+                          db, 'view', self.map_view,
+                          update=update == 'true')),
+                      key=lambda row: (collate(row['key']), row['id']))
+        if update == 'lazy':
+            self.update_index(db, 'view', self.map_view)
+        if 'key' in query:
+            key = json.loads(query['key'])
+            rows = [row for row in rows if row['key'] == key]
+        if method == 'POST':
+            rows = [row for key in body['keys']
+                    for row in rows if row['key'] == key]
+        if 'startkey' in query:
+            startkey = collate(json.loads(query['startkey']))
+            rows = [row for row in rows if collate(row['key']) >= startkey]
+        if 'endkey' in query:
+            endkey = collate(json.loads(query['endkey']))
+            rows = [row for row in rows if collate(row['key']) <= endkey]
+        if query.get('reduce', 'true') == 'true':
+            if query.get('group') != 'true':
+                return 200, {'rows': [{'key': None, 'value': len(rows)}]}
+            groups = []
+            for row in rows:
+                if groups and groups[-1]['key'] == row['key']:
+                    groups[-1]['value'] += 1
+                else:
+                    groups.append({'key': row['key'], 'value': 1})
+            return 200, {'rows': groups}
+        if query.get('include_docs') == 'true':
+            for row in rows:
+                row['doc'] = db[row['id']]
+        return 200, {'total_rows': len(rows), 'offset': 0, 'rows': rows}
+
+    def map_view(self, doc: dict) -> dict:
+        """Mimics ``function(doc){ emit(doc.key, doc.value) }``. Documents
+        make a round trip through JSON as they do to JavaScript query server
+        and back."""
+        if doc['_id'].startswith('_design/'):
+            return None
+        doc = json.loads(json.dumps(doc))
+        return json.loads(json.dumps({'id': doc['_id'],
+                                      'key': doc.get('key'),
+                                      'value': doc.get('value')}))
+
+    def handle_index(self, method: str, db: dict, body: dict) -> tuple:
+        if method != 'POST':
+            return 405, {'error': 'method_not_allowed'}
+        fields = body['index']['fields']
+        name = body.get('name') or '-'.join(fields)
+        result = {'id': '_design/' + body.get('ddoc', name), 'name': name}
+        if db.mango_indexes.get(name) == fields:
+            return 200, dict(result, result='exists')
+        db.mango_indexes[name] = fields
+        db.indexes.pop('mango:' + name, None)
+        return 200, dict(result, result='created')
+
+    def handle_find(self, method: str, db: dict, body: dict) -> tuple:
+        if method != 'POST':
+            return 405, {'error': 'method_not_allowed'}
+        selector = body['selector']
+        for name, fields in sorted(db.mango_indexes.items()):
+            if all(field in selector for field in fields):
+                docs = self.update_index(
+                    db, 'mango:' + name,
+                    lambda doc: doc if all(field in doc
+                                           for field in fields) else None,
+                    update=body.get('update', True))
+                break
+        else:
+            # Without suitable index all the documents are scanned.
+            docs = [doc for docid, doc in db.items()
+                    if not docid.startswith('_design/')]
+        docs = sorted((doc for doc in docs if match(selector, doc)),
+                      key=lambda doc: doc['_id'])
+        skip = int(body.get('bookmark') or 0)
+        docs = docs[skip:skip + body.get('limit', 25)]
+        if 'fields' in body:
+            docs = [{field: doc[field] for field in body['fields']
+                     if field in doc}
+                    for doc in docs]
+        return 200, {'docs': docs, 'bookmark': str(skip + len(docs))}
+
+    def update_index(self, db: dict, name: str, mapper,
+                     update: bool=True) -> list:
+        """Brings index up to date with documents changed since the last
+        query and returns its rows. `mapper` returns index row for a
+        document or ``None`` to skip it. Without `update` stale rows are
+        returned as is."""
+        seq, rows = db.indexes.get(name, (0, {}))
+        if not update:
+            return list(rows.values())
+        if seq < db.update_seq:
+            db.index_updates += 1
+        for docid, (changed, _, deleted) in db.changes.items():
+            if changed <= seq:
+                continue
+            rows.pop(docid, None)
+            if not deleted:
+                row = mapper(db[docid])
+                if row is not None:
+                    rows[docid] = row
+        db.indexes[name] = (db.update_seq, rows)
+        return list(rows.values())
+
+    def update_doc(self, db: dict, doc: dict) -> tuple:
+        docid = doc.setdefault('_id', uuid.uuid4().hex)
+        current = db.get(docid)
+        if current is not None and current['_rev'] != doc.get('_rev'):
+            return 409, {'error': 'conflict',
+                         'reason': 'Document update conflict.'}
+        if current is None and doc.get('_deleted'):
+            return 404, {'error': 'not_found', 'reason': 'missing'}
+        if (self.max_document_size is not None and not doc.get('_deleted')
+                and len(json.dumps(doc)) > self.max_document_size):
+            return 413, {'error': 'too_large', 'reason': 'Document too large'}
+        pos = int(current['_rev'].split('-')[0]) + 1 if current else 1
+        digest = hashlib.md5(json.dumps(doc, sort_keys=True).encode())
+        rev = '%d-%s' % (pos, digest.hexdigest())
+        if doc.get('_deleted'):
+            del db[docid]
+        else:
+            doc['_rev'] = rev
+            db[docid] = doc
+        db.update_seq += 1
+        db.changes[docid] = (db.update_seq, rev, bool(doc.get('_deleted')))
+        self.updated.notify_all()
+        return 201, {'ok': True, 'id': docid, 'rev': rev}
+
+
+class Database(dict):
+    """Documents by ids along with the changes feed state."""
+
+    def __init__(self):
+        super().__init__()
+        self.update_seq = 0
+        self.changes = {}
+        #: Indexes by name as ``(update_seq, rows by document id)``, which
+        #: are updated on query as CouchDB does.
+        self.indexes = {}
+        #: Fields of Mango indexes by index name.
+        self.mango_indexes = {}
+        #: Amount of queries which had to update an index.
+        self.index_updates = 0
+        #: Requested compactions and cleanups.
+        self.compactions = []
+
+
+def collate(value) -> tuple:
+    """Returns sort key which follows CouchDB views collation rules."""
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, tuple(map(collate, value)))
+    return (6, tuple((collate(k), collate(v)) for k, v in value.items()))
+
+
+def match(selector: dict, doc: dict) -> bool:
+    """Returns whenever document matches Mango `selector` made of fields
+    equality and ``$eq``, ``$gt``, ``$gte``, ``$lt``, ``$lte``, ``$in``
+    conditions combined with ``$or``. Like CouchDB does, ``$in`` matches
+    array fields when any of their items is in the list."""
+    operators = {'$eq': lambda a, b: a == b,
+                 '$gt': lambda a, b: a > b,
+                 '$gte': lambda a, b: a >= b,
+                 '$lt': lambda a, b: a < b,
+                 '$lte': lambda a, b: a <= b,
+                 # Collated lists are (5, items) tuples.
+                 '$in': lambda a, b: any(item in b[1] for item in
+                                         (a[1] if a[0] == 5 else [a]))}
+    for field, condition in selector.items():
+        if field == '$or':
+            if not any(match(sub, doc) for sub in condition):
+                return False
+            continue
+        if field not in doc:
+            return False
+        if not (isinstance(condition, dict)
+                and all(op in operators for op in condition)):
+            condition = {'$eq': condition}
+        for op, value in condition.items():
+            if not operators[op](collate(doc[field]), collate(value)):
+                return False
+    return True
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients which gave up waiting for response are not server errors.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.couch.lock:
+            self.server.couch.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_request(self):
+        parts = urllib.parse.urlsplit(self.path)
+        path = [urllib.parse.unquote(segment)
+                for segment in parts.path.split('/') if segment]
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            with self.server.couch.lock:
+                self.server.couch.encoded_requests += 1
+            body = gzip.decompress(body)
+        body = json.loads(body.decode('utf-8')) if body else None
+        if self.server.couch.latency:
+            time.sleep(self.server.couch.latency)
+        status, result = self.server.couch.handle(self.command, path, query,
+                                                  body)
+        if isinstance(result, dict) and 'rows' in result:
+            etag = '"%s"' % hashlib.md5(json.dumps(
+                result, sort_keys=True).encode('utf-8')).hexdigest()
+            if (self.command == 'GET'
+                    and self.headers.get('If-None-Match') == etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_rows(status, result, etag)
+        else:
+            self.send_json(status, result)
+
+    @property
+    def compress(self) -> bool:
+        return (self.server.couch.compress
+                and 'gzip' in self.headers.get('Accept-Encoding', ''))
+
+    def send_rows(self, status: int, result: dict, etag: str=None):
+        """Sends view-like result in chunks, row by row, as CouchDB does."""
+        rows = result.pop('rows')
+        head = json.dumps(result)[:-1]
+        chunks = [(head + (',' if result else '') + '"rows":[\r\n')]
+        chunks.extend((',\r\n' if i else '') + json.dumps(row)
+                      for i, row in enumerate(rows))
+        chunks.append('\r\n]}\n')
+        chunks = [chunk.encode('utf-8') for chunk in chunks]
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if self.compress:
+            self.send_header('Content-Encoding', 'gzip')
+            encoder = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            chunks = [encoder.compress(chunk) for chunk in chunks]
+            chunks.append(encoder.flush())
+        self.end_headers()
+        for data in chunks:
+            if data:
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii'))
+                self.wfile.write(data + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, status: int, result):
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.compress:
+            self.send_header('Content-Encoding', 'gzip')
+            data = gzip.compress(data)
+        self.send_header('Content-Length', str(len(data)))
+        if isinstance(result, dict) and '_id' in result and '_rev' in result:
+            self.send_header('ETag', '"%s"' % result['_rev'])
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = do_request
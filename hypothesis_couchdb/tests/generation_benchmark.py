@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+"""Benchmarks generation of values by public strategies of
+:mod:`hypothesis_couchdb.json` and :mod:`hypothesis_couchdb.document`.
+
+Run it as::
+
+  python -m hypothesis_couchdb.tests.generation_benchmark -o results.json
+
+For each strategy it measures how many examples per second are generated,
+which share of attempts gets rejected by filters or recursion limits and the
+average size of generated values serialized to JSON. Examples which take
+longer than :data:`EXAMPLE_TIMEOUT` are abandoned and counted as timed out.
+Two runs may be compared with :func:`compare`::
+
+  python -m hypothesis_couchdb.tests.generation_benchmark \\
+      --compare old.json new.json
+"""
+
+import argparse
+import contextlib
+import json
+import platform
+import random
+import signal
+import sys
+import threading
+import time
+
+from hypothesis.control import BuildContext
+from hypothesis.errors import (
+    BadTemplateDraw,
+    UnsatisfiedAssumption,
+)
+from hypothesis.internal.examplesource import ParameterSource
+
+from hypothesis_couchdb import (
+    document,
+    json as json_st,
+)
+
+
+__all__ = (
+    'strategies',
+    'run',
+    'measure',
+    'compare',
+    'ExampleTimeout',
+)
+
+
+#: Attempts to generate an example are given up after that many rejections
+#: per example in a row, so hopeless filters don't hang the benchmark.
+MAX_REJECTIONS = 100
+
+#: Seconds to give a single example before it's abandoned. Timeouts rely on
+#: ``SIGALRM``, so they are only available on Unix from the main thread.
+EXAMPLE_TIMEOUT = 1.0
+
+
+class ExampleTimeout(Exception):
+    """Generation of a single example took longer than allowed."""
+
+
+def strategies() -> dict:
+    """Returns strategies to measure by their names."""
+    return {
+        'json.nulls': json_st.nulls(),
+        'json.booleans': json_st.booleans(),
+        'json.numbers': json_st.numbers(),
+        'json.strings': json_st.strings(),
+        'json.arrays': json_st.arrays(json_st.values()),
+        'json.objects': json_st.objects(json_st.values()),
+        'json.values': json_st.values(),
+        'document.documents': document.documents(),
+        'document.encoded_documents': document.encoded_documents(),
+        'document.batches': document.batches(size=100),
+        'document.id': document.id(),
+        'document.rev': document.rev(),
+        'document.deleted': document.deleted(),
+        'document.local_seq': document.local_seq(),
+    }
+
+
+def run(examples: int=1000, names: list=None, seed: int=0,
+        timeout: float=EXAMPLE_TIMEOUT) -> dict:
+    """Measures generation of `examples` values by each of the strategies
+    with given `names`, all of them by default."""
+    available = strategies()
+    results = []
+    for name in sorted(names or available):
+        result = measure(available[name], examples, seed, timeout)
+        result['strategy'] = name
+        results.append(result)
+    return {'python': platform.python_version(),
+            'examples': examples,
+            'seed': seed,
+            'results': results}
+
+
+def measure(strategy, examples: int, seed: int=0,
+            timeout: float=EXAMPLE_TIMEOUT) -> dict:
+    """Generates `examples` values as Hypothesis does: parameters are taken
+    from :class:`ParameterSource`, which switches them after rejections.
+    Attempts rejected by filters or recursion limits are counted and
+    retried. Only generation itself is timed, serialization is not."""
+    rnd = random.Random(seed)
+    parameters = ParameterSource(rnd, strategy)
+    generated = rejected = timed_out = size = 0
+    rejected_in_row = 0
+    elapsed = 0.0
+    with example_timeout(timeout) as arm:
+        while (generated < examples
+               and rejected_in_row < MAX_REJECTIONS
+               and timed_out < examples):
+            start = time.perf_counter()
+            try:
+                arm()
+                parameter = parameters.pick_a_parameter()
+                template = strategy.draw_template(rnd, parameter)
+                with BuildContext():
+                    value = strategy.reify(template)
+            except (UnsatisfiedAssumption, BadTemplateDraw):
+                parameters.mark_bad()
+                rejected += 1
+                rejected_in_row += 1
+                continue
+            except ExampleTimeout:
+                timed_out += 1
+                continue
+            finally:
+                arm(disarm=True)
+                elapsed += time.perf_counter() - start
+            rejected_in_row = 0
+            generated += 1
+            # Read-only mappings, such as encoded documents, are measured
+            # as the objects they hold.
+            size += len(json.dumps(value, default=dict).encode('utf-8'))
+    return {'examples': generated,
+            'seconds': elapsed,
+            'examples_per_second': generated / elapsed if elapsed else 0,
+            'rejected': rejected,
+            'rejection_ratio': rejected / ((generated + rejected) or 1),
+            'timed_out': timed_out,
+            'average_bytes': size / (generated or 1)}
+
+
+@contextlib.contextmanager
+def example_timeout(timeout: float):
+    """Yields function which arms or disarms the timer that interrupts
+    generation of an example with :exc:`ExampleTimeout`. Does nothing when
+    there is no `timeout` or it's not supported."""
+    def interrupt(signum, frame):
+        raise ExampleTimeout()
+
+    def arm(disarm=False):
+        signal.setitimer(signal.ITIMER_REAL, 0 if disarm else timeout)
+
+    supported = (timeout and hasattr(signal, 'setitimer')
+                 and threading.current_thread() is threading.main_thread())
+    if not supported:
+        yield lambda disarm=False: None
+        return
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    try:
+        yield arm
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def compare(old: dict, new: dict) -> list:
+    """Returns generation rate ratio of `new` run to `old` one for each
+    strategy found in both, along with both rejection ratios."""
+    old = {result['strategy']: result for result in old['results']}
+    new = {result['strategy']: result for result in new['results']}
+    return [{'strategy': name,
+             'old': old[name]['examples_per_second'],
+             'new': new[name]['examples_per_second'],
+             'ratio': (new[name]['examples_per_second']
+                       / old[name]['examples_per_second']),
+             'old_rejection_ratio': old[name]['rejection_ratio'],
+             'new_rejection_ratio': new[name]['rejection_ratio'],
+             'old_timed_out': old[name]['timed_out'],
+             'new_timed_out': new[name]['timed_out']}
+            for name in sorted(old) if name in new]
+
+
+def main(argv: list=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m hypothesis_couchdb.tests.generation_benchmark',
+        description='Benchmarks generation of JSON values and documents.')
+    parser.add_argument('--examples', type=int, default=1000,
+                        help='amount of examples to generate per strategy')
+    parser.add_argument('--strategy', action='append', dest='names',
+                        choices=sorted(strategies()),
+                        help='strategy to measure, all by default')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('--timeout', type=float, default=EXAMPLE_TIMEOUT,
+                        help='seconds to give a single example, 0 to wait '
+                             'as long as it takes')
+    parser.add_argument('-o', '--output', help='file to write results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare results of two runs instead')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            result = compare(json.load(old), json.load(new))
+    else:
+        result = run(examples=args.examples, names=args.names,
+                     seed=args.seed, timeout=args.timeout)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
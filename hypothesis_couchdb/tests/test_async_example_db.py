@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import tempfile
+import unittest
+import urllib.error
+
+from hypothesis_couchdb import (
+    example_db,
+)
+
+try:
+    import asyncio
+except ImportError:
+    # Python 3.3 has no asyncio unless its backport is installed.
+    asyncio = None
+else:
+    from hypothesis_couchdb import async_example_db
+from hypothesis_couchdb.tests.fake_couchdb import (
+    FakeCouchDB,
+)
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class AsyncCouchBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = FakeCouchDB().start()
+        self.addCleanup(self.couch.stop)
+        self.dburl = self.couch.url + '/hypothesis'
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.marker_dir = tmpdir.name
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def run_loop(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def make_backend(self, **kwargs):
+        kwargs.setdefault('setup_marker_dir', self.marker_dir)
+        backend = async_example_db.AsyncCouchBackend(self.dburl, **kwargs)
+        self.addCleanup(self.run_loop, backend.close())
+        return backend
+
+    def test_save_fetch_delete(self):
+        backend = self.make_backend()
+        self.run_loop(backend.save('test.foo', [1, 2]))
+        self.run_loop(backend.save('test.foo', [3]))
+        self.assertEqual(sorted(self.run_loop(backend.fetch('test.foo'))),
+                         [[1, 2], [3]])
+        self.run_loop(backend.delete('test.foo', [1, 2]))
+        self.assertEqual(self.run_loop(backend.fetch('test.foo')), [[3]])
+
+    def test_content_ids(self):
+        backend = self.make_backend(content_ids=True)
+        self.run_loop(backend.save('test', [1]))
+        self.run_loop(backend.save('test', [1]))
+        self.assertEqual(self.run_loop(backend.fetch('test')), [[1]])
+        self.run_loop(backend.delete('test', [1]))
+        self.assertEqual(self.run_loop(backend.fetch('test')), [])
+
+    def test_concurrent_requests(self):
+        backend = self.make_backend(pool_size=4)
+        self.run_loop(asyncio.gather(*[backend.save('test', [i])
+                                       for i in range(20)]))
+        self.assertEqual(sorted(self.run_loop(backend.fetch('test'))),
+                         [[i] for i in range(20)])
+        self.assertLessEqual(self.couch.connections, 4)
+        ddocs = [req for req in self.couch.requests
+                 if req == ('PUT', '/hypothesis/_design/hypothesis')]
+        self.assertEqual(len(ddocs), 1)
+
+    def test_setup_marker(self):
+        self.run_loop(self.make_backend().fetch('test'))
+        self.couch.requests.clear()
+        self.run_loop(self.make_backend().fetch('test'))
+        self.assertEqual(
+            [req for req in self.couch.requests if '_view' not in req[1]],
+            [('HEAD', '/hypothesis/_design/hypothesis')])
+
+    def test_shares_setup_marker_with_blocking_backend(self):
+        backend = example_db.CouchBackend(self.dburl,
+                                          setup_marker_dir=self.marker_dir)
+        backend.fetch('test')
+        backend.close()
+        self.couch.requests.clear()
+        self.run_loop(self.make_backend().fetch('test'))
+        self.assertEqual(
+            [req for req in self.couch.requests if '_view' not in req[1]],
+            [('HEAD', '/hypothesis/_design/hypothesis')])
+
+    def test_outdated_validation_is_updated(self):
+        self.run_loop(self.make_backend().fetch('test'))
+        ddoc = dict(self.couch.databases['hypothesis']['_design/hypothesis'])
+        ddoc['validate_doc_update'] = 'function(newdoc, olddoc){}'
+        self.couch.handle('PUT', ['hypothesis', '_design', 'hypothesis'], {},
+                          ddoc)
+        self.run_loop(self.make_backend(setup_marker_dir=None).fetch('test'))
+        ddoc = self.couch.databases['hypothesis']['_design/hypothesis']
+        self.assertIn("typeof newdoc.value === 'string'",
+                      ddoc['validate_doc_update'])
+
+    def test_http_error(self):
+        pool = async_example_db.AsyncConnectionPool(self.dburl)
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self.run_loop(pool.urlopen('GET', self.dburl, {}))
+        self.assertEqual(ctx.exception.code, 404)
+        pool.close()
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            async_example_db.AsyncConnectionPool(self.dburl, maxsize=0)
+
+    def test_timeout(self):
+        pool = async_example_db.AsyncConnectionPool(self.dburl, maxsize=1,
+                                                    timeout=0.05)
+        self.addCleanup(pool.close)
+        self.couch.latency = 0.2
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_loop(pool.urlopen('GET', self.couch.url, {}))
+        self.couch.latency = 0
+        self.assertEqual(
+            self.run_loop(pool.urlopen('GET', self.couch.url, {})),
+            b'{"couchdb": "Welcome"}')
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class SyncCouchBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = FakeCouchDB().start()
+        self.addCleanup(self.couch.stop)
+
+    def test_example_db(self):
+        db = example_db.CouchExampleDB(
+            self.couch.url + '/hypothesis',
+            backend_class=async_example_db.SyncCouchBackend,
+            setup_marker_dir=None)
+        self.addCleanup(db.close)
+        db.backend.save('test', [1])
+        self.assertEqual(db.backend.fetch('test'), [[1]])
+        db.backend.delete('test', [1])
+        self.assertEqual(db.backend.fetch('test'), [])
+
+    def test_close_stops_loop(self):
+        backend = async_example_db.SyncCouchBackend(
+            self.couch.url + '/hypothesis', setup_marker_dir=None)
+        backend.fetch('test')
+        backend.close()
+        self.assertFalse(backend.thread.is_alive())
+        self.assertTrue(backend.loop.is_closed())
+        backend.close()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import io
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from hypothesis_couchdb.tests import (
+    benchmark,
+)
+from hypothesis_couchdb.tests.fake_couchdb import (
+    FakeCouchDB,
+)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_run(self):
+        result = benchmark.run(examples=(1, 3), concurrency=(1, 2), keys=2,
+                               content_ids=True)
+        self.assertEqual(result['options'], {'content_ids': True})
+        self.assertEqual(len(result['results']), 2 * 2 * 3)
+        for item in result['results']:
+            self.assertEqual(item['calls'],
+                             2 if item['operation'] == 'fetch'
+                             else 2 * item['examples'])
+            self.assertGreater(item['ops_per_second'], 0)
+            self.assertLessEqual(item['latency']['p50'],
+                                 item['latency']['max'])
+        json.dumps(result)
+
+    def test_latency(self):
+        with FakeCouchDB(latency=0.05) as couch:
+            results = benchmark.run_scenario(couch.url + '/bench', 1, 1, 1)
+        for item in results:
+            self.assertGreaterEqual(item['latency']['max'], 0.05)
+
+    def test_percentile(self):
+        durations = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(durations, 0.5), 50)
+        self.assertEqual(benchmark.percentile(durations, 0.95), 95)
+        self.assertEqual(benchmark.percentile([7], 0.99), 7)
+
+    def test_compare(self):
+        old = {'results': [{'operation': 'save', 'examples': 1,
+                            'concurrency': 1, 'keys': 1,
+                            'ops_per_second': 100}]}
+        new = {'results': [{'operation': 'save', 'examples': 1,
+                            'concurrency': 1, 'keys': 1,
+                            'ops_per_second': 150},
+                           {'operation': 'fetch', 'examples': 1,
+                            'concurrency': 1, 'keys': 1,
+                            'ops_per_second': 150}]}
+        self.assertEqual(benchmark.compare(old, new), [
+            {'operation': 'save', 'examples': 1, 'concurrency': 1, 'keys': 1,
+             'old': 100, 'new': 150, 'ratio': 1.5}])
+
+    def test_compression(self):
+        results = benchmark.compression(sizes=(1, 1024), levels=(1,),
+                                        repeat=1)
+        self.assertEqual([item['examples'] for item in results], [1, 1024])
+        self.assertLess(results[1]['compressed_bytes'], results[1]['bytes'])
+        self.assertLess(results[1]['ratio'], results[0]['ratio'])
+
+    def test_indexing(self):
+        results = benchmark.indexing(docs=20, keys=4, repeat=2)
+        self.assertEqual([item['lookup'] for item in results],
+                         ['view', 'find'])
+        for item in results:
+            self.assertGreater(item['index_seconds'], 0)
+            self.assertGreater(item['query_seconds'], 0)
+
+    def test_main(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        output = os.path.join(tmpdir.name, 'results.json')
+        benchmark.main(['--examples', '1', '--concurrency', '1',
+                        '--keys', '1', '--option', 'stream=true',
+                        '-o', output])
+        with open(output) as fobj:
+            result = json.load(fobj)
+        self.assertEqual(result['options'], {'stream': True})
+        stdout = io.StringIO()
+        with unittest.mock.patch('sys.stdout', stdout):
+            benchmark.main(['--compare', output, output])
+        self.assertEqual([item['ratio'] for item in json.loads(
+            stdout.getvalue())], [1.0] * 3)
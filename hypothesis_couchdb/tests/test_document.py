@@ -13,6 +13,8 @@
 # the License.
 #
 
+import collections.abc
+import json as stdjson
 import string
 import hypothesis
 import unittest
@@ -40,6 +42,106 @@ class DocumentTestCase(unittest.TestCase):
         st = document.documents(required_fields={'test': json.nulls()})
         self.assertEqual(hypothesis.find(st, lambda _: True), {'test': None})
 
+    @hypothesis.given(document.documents(
+        required_fields={'_id': document.id(max_size=100)},
+        max_encoded_bytes=1024))
+    def test_document_max_encoded_bytes(self, value):
+        self.assertIn('_id', value)
+        self.assertLessEqual(json.encoded_size(value), 1024)
+
+    @hypothesis.given(document.documents(
+        optional_fields={'test': json.values()},
+        max_depth=2, max_leaves=10))
+    def test_document_limits(self, value):
+        depth, leaves, _ = json.measure(value)
+        self.assertLessEqual(depth, 2)
+        self.assertLessEqual(leaves, 10)
+
+    def test_document_with_limits(self):
+        st = document.documents(max_encoded_bytes=100)
+        self.assertEqual(hypothesis.find(st, lambda _: True), {})
+        self.assertEqual(hypothesis.find(st, lambda v: v), {'': None})
+
+    def test_encoded_document(self):
+        self.assertEqual(hypothesis.find(document.encoded_documents(),
+                                         lambda _: True), {})
+
+    @hypothesis.given(document.encoded_documents(
+        required_fields={'_id': document.id()},
+        max_encoded_bytes=4096))
+    def test_encoded_documents(self, value):
+        self.assertIsInstance(value, document.EncodedDocument)
+        self.assertIsInstance(value, collections.abc.Mapping)
+        self.assertIn('_id', value)
+        self.assertEqual(stdjson.loads(bytes(value).decode()), value)
+
+    def test_encoded_document_is_encoded_once(self):
+        doc = document.EncodedDocument({'b': [1, 'ё'], 'a': None})
+        self.assertEqual(doc.encoded, b'{"a":null,"b":[1,"\\u0451"]}')
+        self.assertIs(doc.encoded, doc.encoded)
+        self.assertIs(bytes(doc), doc.encoded)
+        self.assertIs(doc.view().obj, doc.encoded)
+        self.assertEqual(doc.view()[:5].tobytes(), b'{"a":')
+
+    def test_encoded_document_is_read_only(self):
+        doc = document.EncodedDocument({'a': 1})
+        with self.assertRaises(TypeError):
+            doc['a'] = 2
+        with self.assertRaises(AttributeError):
+            doc.extra = 1
+        copy = doc.copy()
+        copy['a'] = 2
+        self.assertEqual(doc, {'a': 1})
+        self.assertEqual(repr(doc), "EncodedDocument({'a': 1})")
+
+    @hypothesis.given(document.batches(
+        ids=document.id(alphabet='ab', max_size=2),
+        min_size=1, max_size=50))
+    def test_batches_have_unique_ids(self, value):
+        self.assertGreaterEqual(len(value), 1)
+        self.assertLessEqual(len(value), 50)
+        ids = [doc['_id'] for doc in value]
+        self.assertEqual(len(set(ids)), len(ids))
+        for doc in value:
+            self.assertNotIn('_rev', doc)
+            self.assertNotIn('_deleted', doc)
+
+    @hypothesis.given(document.batches(
+        size=3, ids=document.id(alphabet='ab', max_size=1)))
+    def test_batches_ids_suffix_ignores_ids_constraints(self, value):
+        ids = [doc['_id'] for doc in value]
+        self.assertEqual(len(set(ids)), 3)
+        # Three unique ids can't be drawn from two one letter ones.
+        self.assertTrue(any(len(docid) > 1 for docid in ids))
+        for docid in ids:
+            self.assertRegex(docid, r'^[ab](-\d+)?$')
+
+    def test_batches_shrink(self):
+        self.assertEqual(hypothesis.find(document.batches(size=3),
+                                         lambda _: True),
+                         [{'_id': '0'}, {'_id': '0-1'}, {'_id': '0-2'}])
+
+    @hypothesis.given(document.batches(size=5, with_rev=True,
+                                       with_deleted=True))
+    def test_batches_with_rev_and_deleted(self, value):
+        self.assertEqual(len(value), 5)
+        for doc in value:
+            if '_rev' in doc:
+                self.check_rev(doc['_rev'])
+            self.assertIn(doc.get('_deleted', False), (True, False))
+
+    def test_batches_may_have_rev_and_deleted(self):
+        st = document.batches(min_size=1, with_rev=True, with_deleted=True)
+        self.assertEqual(
+            hypothesis.find(st, lambda v: '_rev' in v[0] and v[0].get(
+                '_deleted')),
+            [{'_id': '0', '_rev': '0-' + '1' * 32, '_deleted': True}])
+
+    def test_unique_ids(self):
+        self.assertEqual(list(document.unique_ids(['a', 'a', 'a-1', 'b',
+                                                   'a'])),
+                         ['a', 'a-1', 'a-1-1', 'b', 'a-2'])
+
     @hypothesis.given(document.id())
     def test_id(self, value):
         self.assertIsInstance(value, str)
@@ -0,0 +1,1479 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import io
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+
+from hypothesis.errors import BadData
+
+from hypothesis_couchdb import (
+    example_db,
+    instrumentation,
+)
+from hypothesis_couchdb.tests.fake_couchdb import (
+    FakeCouchDB,
+)
+
+
+class ExampleDBTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = FakeCouchDB().start()
+        self.addCleanup(self.couch.stop)
+        self.dburl = self.couch.url + '/hypothesis'
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.marker_dir = tmpdir.name
+
+    def make_backend(self, **kwargs):
+        kwargs.setdefault('setup_marker_dir', self.marker_dir)
+        backend = example_db.CouchBackend(self.dburl, **kwargs)
+        self.addCleanup(backend.close)
+        return backend
+
+
+class CouchBackendTestCase(ExampleDBTestCase):
+
+    def test_save_fetch_delete(self):
+        backend = self.make_backend()
+        backend.save('test.foo', [1, 2])
+        backend.save('test.foo', [3])
+        backend.save('test.bar', [4])
+        self.assertEqual(sorted(backend.fetch('test.foo')), [[1, 2], [3]])
+        backend.delete('test.foo', [1, 2])
+        self.assertEqual(list(backend.fetch('test.foo')), [[3]])
+        self.assertEqual(list(backend.fetch('test.bar')), [[4]])
+
+    def test_delete_is_bulk(self):
+        backend = self.make_backend()
+        for _ in range(5):
+            backend.save('test', [1])
+        backend.save('test', [2])
+        del self.couch.requests[:]
+        backend.delete('test', [1])
+        self.assertEqual(self.couch.requests, [
+            ('GET', '/hypothesis/_design/hypothesis/_view/by_key'),
+            ('POST', '/hypothesis/_all_docs'),
+            ('POST', '/hypothesis/_bulk_docs'),
+        ])
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+
+    def test_delete_missing(self):
+        backend = self.make_backend()
+        backend.save('test', [1])
+        del self.couch.requests[:]
+        backend.delete('test', [2])
+        self.assertEqual(len(self.couch.requests), 1)
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_setup_creates_database_and_ddoc(self):
+        backend = self.make_backend()
+        self.assertEqual(list(backend.fetch('test')), [])
+        self.assertIn('hypothesis', self.couch.databases)
+        self.assertIn('_design/hypothesis',
+                      self.couch.databases['hypothesis'])
+
+    def test_connections_are_reused(self):
+        backend = self.make_backend()
+        for i in range(10):
+            backend.save('test', [i])
+            backend.fetch('test')
+        self.assertEqual(self.couch.connections, 1)
+
+    def test_close_resets_pool(self):
+        backend = self.make_backend()
+        backend.fetch('test')
+        backend.close()
+        self.assertEqual(len(backend.pool._idle), 0)
+        backend.fetch('test')
+        self.assertEqual(self.couch.connections, 2)
+
+
+class SetupCouchBackendTestCase(ExampleDBTestCase):
+
+    def test_first_setup(self):
+        self.make_backend().fetch('test')
+        self.assertEqual(self.couch.requests[:3], [
+            ('GET', '/hypothesis/_design/hypothesis'),
+            ('PUT', '/hypothesis'),
+            ('PUT', '/hypothesis/_design/hypothesis'),
+        ])
+        self.assertEqual(len(os.listdir(self.marker_dir)), 1)
+
+    def test_setup_is_shared(self):
+        self.make_backend().fetch('test')
+        del self.couch.requests[:]
+        self.make_backend().fetch('test')
+        self.assertEqual(self.couch.requests[0],
+                         ('HEAD', '/hypothesis/_design/hypothesis'))
+        self.assertEqual(len(self.couch.requests), 2)
+
+    def test_outdated_ddoc_is_updated(self):
+        self.make_backend().fetch('test')
+        ddoc = dict(self.couch.databases['hypothesis']['_design/hypothesis'])
+        ddoc['views'] = {'by_key': {'map': 'function(doc){}'}}
+        self.couch.handle('PUT', ['hypothesis', '_design', 'hypothesis'], {},
+                          ddoc)
+        del self.couch.requests[:]
+        self.make_backend().fetch('test')
+        self.assertEqual(self.couch.requests[:3], [
+            ('HEAD', '/hypothesis/_design/hypothesis'),
+            ('GET', '/hypothesis/_design/hypothesis'),
+            ('PUT', '/hypothesis/_design/hypothesis'),
+        ])
+        ddoc = self.couch.databases['hypothesis']['_design/hypothesis']
+        self.assertEqual(ddoc['views'], example_db.CouchBackend.ddoc(None)[
+            'views'])
+
+    def test_deleted_database_is_recreated(self):
+        self.make_backend().fetch('test')
+        self.couch.handle('DELETE', ['hypothesis'], {}, None)
+        self.assertEqual(list(self.make_backend().fetch('test')), [])
+
+    def test_existing_database(self):
+        self.couch.handle('PUT', ['hypothesis'], {}, None)
+        self.assertEqual(list(self.make_backend().fetch('test')), [])
+
+    def test_without_marker(self):
+        self.make_backend(setup_marker_dir=None).fetch('test')
+        self.make_backend(setup_marker_dir=None).fetch('test')
+        self.assertEqual(os.listdir(self.marker_dir), [])
+        self.assertNotIn(('HEAD', '/hypothesis/_design/hypothesis'),
+                         self.couch.requests)
+
+
+class BufferedCouchBackendTestCase(ExampleDBTestCase):
+
+    def saves(self):
+        return [req for req in self.couch.requests
+                if req[0] in ('PUT', 'POST') and 'hypothesis/' in req[1]
+                and '_design' not in req[1]]
+
+    def test_flush_on_batch_size(self):
+        backend = self.make_backend(batch_size=3)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        self.assertEqual(self.saves(), [])
+        backend.save('test', [3])
+        self.assertEqual(self.saves(), [('POST', '/hypothesis/_bulk_docs')])
+        self.assertEqual(len(self.couch.databases['hypothesis']), 4)
+
+    def test_flush_on_interval(self):
+        backend = self.make_backend(flush_interval=0.01)
+        backend.save('test', [1])
+        backend._flush_timer.join()
+        self.assertEqual(self.saves(), [('POST', '/hypothesis/_bulk_docs')])
+
+    def test_flush_on_close(self):
+        backend = self.make_backend(batch_size=100)
+        backend.save('test', [1])
+        backend.close()
+        self.assertEqual(self.saves(), [('POST', '/hypothesis/_bulk_docs')])
+
+    def test_fetch_sees_pending_writes(self):
+        backend = self.make_backend(batch_size=2)
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        backend.save('test', [2])
+        backend.save('test', [3])
+        self.assertEqual(sorted(backend.fetch('test')), [[1], [2], [3]])
+        self.assertEqual(list(backend.fetch('other')), [])
+
+    def test_delete_pending_write(self):
+        backend = self.make_backend(batch_size=100)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        backend.delete('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+        backend.flush()
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+
+    def test_failed_flush_keeps_pending_writes(self):
+        backend = self.make_backend(batch_size=100)
+        backend.save('test', [1])
+        self.couch.stop()
+        with self.assertRaises(OSError):
+            backend.flush()
+        self.assertEqual(len(backend._pending), 1)
+        backend._pending = []
+
+    def test_flush_does_not_block_buffer(self):
+        backend = self.make_backend(batch_size=100)
+        backend.save('test', [1])
+        self.couch.latency = 0.5
+        flusher = threading.Thread(target=backend.flush)
+        flusher.start()
+        while not backend._sending:
+            time.sleep(0.001)
+        start = time.perf_counter()
+        backend.save('test', [2])
+        self.assertEqual(sorted(doc['value']
+                                for doc in backend._pending_docs('test')),
+                         [[1], [2]])
+        self.assertLess(time.perf_counter() - start, 0.25)
+        flusher.join()
+        self.couch.latency = 0
+        self.assertEqual(sorted(backend.fetch('test')), [[1], [2]])
+
+    def test_failed_flush_on_interval_is_kept(self):
+        backend = self.make_backend(flush_interval=0.01)
+        self.couch.stop()
+        backend.save('test', [1])
+        backend._flush_timer.join()
+        self.assertIsInstance(backend.flush_error, OSError)
+        self.assertEqual(len(backend._pending), 1)
+        backend._pending = []
+
+
+class ContentIdsCouchBackendTestCase(ExampleDBTestCase):
+
+    def test_example_id(self):
+        self.assertEqual(example_db.example_id(['a', 'b'], [1, 2]),
+                         example_db.example_id(['a', 'b'], [1, 2]))
+        self.assertNotEqual(example_db.example_id(['a', 'b'], [1, 2]),
+                            example_db.example_id(['a', 'b'], [2, 1]))
+        self.assertNotEqual(example_db.example_id(['a', 'b'], [1]),
+                            example_db.example_id(['a.b'], [1]))
+
+    def test_save_is_idempotent(self):
+        backend = self.make_backend(content_ids=True)
+        backend.save('test', [1])
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_buffered_save_is_idempotent(self):
+        backend = self.make_backend(content_ids=True, batch_size=100)
+        backend.save('test', [1])
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        backend.flush()
+        backend.save('test', [1])
+        backend.flush()
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_delete_does_not_query_view(self):
+        backend = self.make_backend(content_ids=True)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        del self.couch.requests[:]
+        backend.delete('test', [1])
+        self.assertEqual(self.couch.requests, [
+            ('POST', '/hypothesis/_all_docs'),
+            ('POST', '/hypothesis/_bulk_docs'),
+        ])
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+
+    def test_migrate(self):
+        legacy = self.make_backend()
+        legacy.save('test', [1])
+        legacy.save('test', [1])
+        legacy.save('test', [2])
+        backend = self.make_backend(content_ids=True)
+        self.assertEqual(backend.migrate(), 3)
+        self.assertEqual(backend.migrate(), 0)
+        self.assertEqual(sorted(backend.fetch('test')), [[1], [2]])
+        backend.delete('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+
+    def test_migrate_in_batches(self):
+        legacy = self.make_backend()
+        for value in range(7):
+            legacy.save('test', [value % 5])
+        backend = self.make_backend(content_ids=True)
+        del self.couch.requests[:]
+        self.assertEqual(backend.migrate(batch_size=2), 7)
+        pages = [req for req in self.couch.requests
+                 if req == ('GET', '/hypothesis/_all_docs')]
+        self.assertGreater(len(pages), 3)
+        self.assertEqual(sorted(backend.fetch('test')),
+                         [[0], [1], [2], [3], [4]])
+        self.assertEqual(backend.migrate(batch_size=2), 0)
+
+    def test_migrate_keeps_refused_examples(self):
+        legacy = self.make_backend()
+        legacy.save('test', [1])
+        legacy.save('test', list(range(100)))
+        self.couch.max_document_size = 300
+        backend = self.make_backend(content_ids=True)
+        self.assertEqual(backend.migrate(), 1)
+        self.assertEqual(sorted(backend.fetch('test')),
+                         [list(range(100)), [1]])
+        ids = {doc['_id']: doc['value']
+               for doc in self.couch.databases['hypothesis'].values()
+               if doc.get('type') == 'example'}
+        self.assertEqual(ids[example_db.example_id(['test'], [1])], [1])
+
+
+class PrefetchCouchBackendTestCase(ExampleDBTestCase):
+
+    def view_requests(self):
+        return [req for req in self.couch.requests if '_view' in req[1]]
+
+    def test_key_prefix(self):
+        self.assertEqual(example_db.key_prefix(['a', 'b', 'c']), ('a', 'b'))
+        self.assertEqual(example_db.key_prefix(['a']), ('a',))
+
+    def test_prefix_loaded_once(self):
+        writer = self.make_backend()
+        writer.save('mod.Case.test_a', [1])
+        writer.save('mod.Case.test_b', [2])
+        writer.save('mod.Case.test_b', [3])
+        writer.save('mod.Other.test_a', [4])
+        writer.save('mod.Case', [5])
+        backend = self.make_backend(prefetch=True)
+        del self.couch.requests[:]
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[1]])
+        self.assertEqual(sorted(backend.fetch('mod.Case.test_b')),
+                         [[2], [3]])
+        self.assertEqual(list(backend.fetch('mod.Case.test_c')), [])
+        self.assertEqual(len(self.view_requests()), 1)
+        self.assertEqual(list(backend.fetch('mod.Other.test_a')), [[4]])
+        self.assertEqual(len(self.view_requests()), 2)
+
+    def test_snapshot_follows_own_writes(self):
+        backend = self.make_backend(prefetch=True, batch_size=100,
+                                    content_ids=True)
+        backend.save('mod.Case.test_a', [1])
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[1]])
+        backend.save('mod.Case.test_a', [2])
+        backend.delete('mod.Case.test_a', [1])
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[2]])
+        backend.flush()
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[2]])
+        self.assertEqual(len(self.view_requests()), 1)
+
+    def test_close_drops_snapshot(self):
+        backend = self.make_backend(prefetch=True)
+        backend.fetch('mod.Case.test_a')
+        self.make_backend().save('mod.Case.test_a', [1])
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [])
+        backend.close()
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[1]])
+
+
+class CachedCouchBackendTestCase(ExampleDBTestCase):
+
+    def view_requests(self):
+        return [req for req in self.couch.requests if '_view' in req[1]]
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline, 'timed out')
+            time.sleep(0.01)
+
+    def test_repeated_fetch_is_cached(self):
+        backend = self.make_backend(cache_size=10)
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.assertEqual(len(self.view_requests()), 1)
+
+    def test_own_writes_invalidate(self):
+        backend = self.make_backend(cache_size=10)
+        self.assertEqual(list(backend.fetch('test')), [])
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        backend.delete('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [])
+
+    def test_others_writes_invalidate(self):
+        backend = self.make_backend(cache_size=10)
+        other = self.make_backend()
+        self.assertEqual(list(backend.fetch('test')), [])
+        other.save('test', [1])
+        self.wait_for(lambda: backend.cache.get(['test']) is None)
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        other.delete('test', [1])
+        self.wait_for(lambda: backend.cache.get(['test']) is None)
+        self.assertEqual(list(backend.fetch('test')), [])
+
+    def test_lru_eviction(self):
+        cache = example_db.FetchCache(2)
+        cache.put(['a'], [{'id': '1', 'value': 1}], cache.generation)
+        cache.put(['b'], [], cache.generation)
+        cache.get(['a'])
+        cache.put(['c'], [], cache.generation)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(['b']))
+        self.assertIsNotNone(cache.get(['a']))
+
+    def test_stale_rows_are_not_cached(self):
+        cache = example_db.FetchCache(2)
+        generation = cache.generation
+        cache.invalidate([['a']])
+        cache.put(['a'], [], generation)
+        self.assertIsNone(cache.get(['a']))
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            example_db.FetchCache(0)
+
+
+class ETagCouchBackendTestCase(ExampleDBTestCase):
+
+    def test_not_modified_rows_are_reused(self):
+        stats = instrumentation.Instrumentation()
+        backend = self.make_backend(etag_cache_bytes=10000,
+                                    instrumentation=stats)
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.assertEqual(stats.summary()['fetch']['statuses'],
+                         {200: 1, 304: 1})
+        self.assertEqual(len(backend.etags), 1)
+
+    def test_changed_rows_are_refetched(self):
+        backend = self.make_backend(etag_cache_bytes=10000)
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.make_backend().save('test', [2])
+        self.assertEqual(sorted(backend.fetch('test')), [[1], [2]])
+        backend.delete('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+
+    def test_connection_is_reused(self):
+        backend = self.make_backend(etag_cache_bytes=10000)
+        for _ in range(3):
+            backend.fetch('test')
+        self.assertEqual(self.couch.connections, 1)
+
+    def test_prefetch(self):
+        backend = self.make_backend(etag_cache_bytes=10000, prefetch=True)
+        backend.save('mod.Case.test_a', [1])
+        backend.close()
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[1]])
+        self.assertEqual(len(backend.etags), 1)
+
+    def test_bounded_size(self):
+        cache = example_db.ETagCache(100)
+        cache.put('a', '"1"', [1], 60)
+        cache.put('b', '"2"', [2], 30)
+        cache.get('a')
+        cache.put('c', '"3"', [3], 30)
+        self.assertEqual(cache.size, 90)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), ('"1"', [1]))
+        cache.put('d', '"4"', [4], 101)
+        self.assertIsNone(cache.get('d'))
+        cache.put('a', '"5"', [5], 10)
+        self.assertEqual(cache.size, 40)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            example_db.ETagCache(0)
+
+
+class StreamingCouchBackendTestCase(ExampleDBTestCase):
+
+    def test_fetch_is_generator(self):
+        backend = self.make_backend(stream=True)
+        for i in range(100):
+            backend.save('test', [i] * i)
+        values = backend.fetch('test')
+        self.assertNotIsInstance(values, list)
+        self.assertEqual(sorted(values, key=len),
+                         [[i] * i for i in range(100)])
+
+    def test_connection_is_reused(self):
+        backend = self.make_backend(stream=True)
+        backend.save('test', [1])
+        for _ in range(3):
+            self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.assertEqual(self.couch.connections, 1)
+
+    def test_abandoned_stream_closes_connection(self):
+        backend = self.make_backend(stream=True)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        values = backend.fetch('test')
+        next(values)
+        values.close()
+        self.assertEqual(len(list(backend.fetch('test'))), 2)
+
+    def test_pending_writes(self):
+        backend = self.make_backend(stream=True, batch_size=100)
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_iter_rows(self):
+        rows = [{'id': str(i), 'key': ['k'], 'value': 'é' * i}
+                for i in range(50)]
+        data = json.dumps({'total_rows': 50, 'offset': 0, 'rows': rows},
+                          ensure_ascii=False).encode('utf-8')
+        self.assertEqual(list(example_db.iter_rows(io.BytesIO(data),
+                                                   chunk_size=7)),
+                         rows)
+
+    def test_iter_rows_empty(self):
+        data = b'{"total_rows":0,"offset":0,"rows":[\r\n\r\n]}'
+        self.assertEqual(list(example_db.iter_rows(io.BytesIO(data))), [])
+
+    def test_iter_rows_truncated(self):
+        data = b'{"total_rows":0,"offset":0,"rows":[{"id":'
+        with self.assertRaises(ValueError):
+            list(example_db.iter_rows(io.BytesIO(data)))
+
+
+class CompressedCouchBackendTestCase(ExampleDBTestCase):
+
+    def test_big_bodies_are_compressed(self):
+        backend = self.make_backend(compression=True)
+        backend.save('test', [1])
+        self.assertEqual(self.couch.encoded_requests, 0)
+        backend.save('test', list(range(1000)))
+        self.assertEqual(self.couch.encoded_requests, 1)
+        self.assertEqual(sorted(backend.fetch('test'), key=len),
+                         [[1], list(range(1000))])
+
+    def test_bulk_docs_are_compressed(self):
+        backend = self.make_backend(compression=True, batch_size=100)
+        for i in range(100):
+            backend.save('test', [i] * 10)
+        self.assertEqual(self.couch.encoded_requests, 1)
+        self.assertEqual(len(backend.fetch('test')), 100)
+
+    def test_compressed_responses(self):
+        self.couch.compress = True
+        backend = self.make_backend(compression=True)
+        for i in range(10):
+            backend.save('test', [i] * 100)
+        self.assertEqual(len(backend.fetch('test')), 10)
+        backend.delete('test', [0] * 100)
+        self.assertEqual(len(backend.fetch('test')), 9)
+
+    def test_compressed_stream(self):
+        self.couch.compress = True
+        backend = self.make_backend(compression=True, stream=True)
+        for i in range(10):
+            backend.save('test', [i] * 100)
+        self.assertEqual(sorted(backend.fetch('test')),
+                         [[i] * 100 for i in range(10)])
+        self.assertEqual(len(list(backend.fetch('test'))), 10)
+        self.assertEqual(self.couch.connections, 1)
+
+    def test_not_accepted_by_default(self):
+        self.couch.compress = True
+        backend = self.make_backend()
+        backend.save('test', list(range(1000)))
+        self.assertEqual(list(backend.fetch('test')), [list(range(1000))])
+        self.assertEqual(self.couch.encoded_requests, 0)
+
+    def test_traffic_is_counted_compressed(self):
+        self.couch.compress = True
+        stats = instrumentation.Instrumentation()
+        backend = self.make_backend(compression=True,
+                                    instrumentation=stats)
+        backend.save('test', [0] * 10000)
+        backend.fetch('test')
+        summary = stats.summary()
+        self.assertLess(summary['save']['bytes_sent'], 10000)
+        self.assertLess(summary['fetch']['bytes_received'], 10000)
+
+
+class PackedCouchBackendTestCase(ExampleDBTestCase):
+
+    values = [None, True, False, 0, 1, -1, 63, -64, 2 ** 64, -2 ** 70,
+              '', 'é', [], [0, 1, -1, 300], [1, True], [[], [None, 'a']],
+              [[1, 2], [3, [4, 5]]]]
+
+    def test_pack_roundtrip(self):
+        for value in self.values:
+            packed = example_db.pack_value(value)
+            self.assertIsInstance(packed, str)
+            self.assertEqual(example_db.unpack_value(packed), value)
+            self.assertIs(type(example_db.unpack_value(packed)), type(value))
+
+    def test_pack_is_compact(self):
+        value = list(range(-500, 500))
+        self.assertLess(len(example_db.pack_value(value)),
+                        len(json.dumps(value, separators=(',', ':'))))
+        value = [i % 64 for i in range(1000)]
+        self.assertLess(len(example_db.pack_value(value)) * 2,
+                        len(json.dumps(value, separators=(',', ':'))))
+
+    def test_pack_bad_value(self):
+        with self.assertRaises(TypeError):
+            example_db.pack_value([1.5])
+
+    def test_unpack_bad_data(self):
+        for data in ('', 'AA', '227', '~', '~Bw', '~BQM', '~/w', '~A*'):
+            with self.assertRaises(BadData):
+                example_db.unpack_value(data)
+
+    def test_format(self):
+        fmt = example_db.PackedFormat()
+        self.assertEqual(fmt.data_type(), str)
+        self.assertEqual(fmt.deserialize_data(fmt.serialize_basic([1, 2])),
+                         [1, 2])
+        self.assertEqual(fmt.deserialize_data([1, 2]), [1, 2])
+        self.assertEqual(fmt.deserialize_data('227'), '227')
+        self.assertEqual(fmt.deserialize_data('AA'), 'AA')
+        with self.assertRaises(BadData):
+            fmt.deserialize_data('~/w')
+
+    def test_example_db(self):
+        db = example_db.CouchExampleDB(self.dburl, packed=True,
+                                       setup_marker_dir=self.marker_dir)
+        self.addCleanup(db.close)
+        self.assertIsInstance(db.format, example_db.PackedFormat)
+        self.assertEqual(db.backend.data_type(), str)
+        db.backend.save('test', db.format.serialize_basic([1, 2]))
+        docs = [doc for doc in self.couch.databases['hypothesis'].values()
+                if doc.get('type') == 'example']
+        self.assertIsInstance(docs[0]['value'], str)
+
+    def test_reads_and_deletes_plain_examples(self):
+        self.make_backend().save('test', [1, 2])
+        self.make_backend().save('test', [3])
+        backend = self.make_backend(packed=True)
+        fmt = example_db.PackedFormat()
+        self.assertEqual(
+            sorted(map(fmt.deserialize_data, backend.fetch('test'))),
+            [[1, 2], [3]])
+        backend.delete('test', fmt.serialize_basic([1, 2]))
+        self.assertEqual(list(backend.fetch('test')), [[3]])
+
+    def test_reads_and_deletes_plain_strings(self):
+        # Integer examples are stored by BasicFormat as decimal strings.
+        self.make_backend().save('test', '227')
+        self.make_backend().save('test', 'AA')
+        backend = self.make_backend(packed=True)
+        fmt = example_db.PackedFormat()
+        self.assertEqual(
+            sorted(map(fmt.deserialize_data, backend.fetch('test'))),
+            ['227', 'AA'])
+        backend.delete('test', fmt.serialize_basic('227'))
+        self.assertEqual(list(backend.fetch('test')), ['AA'])
+
+    def test_content_ids_delete_both_encodings(self):
+        self.make_backend(content_ids=True).save('test', [1])
+        backend = self.make_backend(content_ids=True, packed=True)
+        backend.save('test', example_db.pack_value([1]))
+        self.assertEqual(len(list(backend.fetch('test'))), 2)
+        backend.delete('test', example_db.pack_value([1]))
+        self.assertEqual(list(backend.fetch('test')), [])
+
+    def test_outdated_validation_is_updated(self):
+        self.make_backend().fetch('test')
+        ddoc = dict(self.couch.databases['hypothesis']['_design/hypothesis'])
+        ddoc['validate_doc_update'] = 'function(newdoc, olddoc){}'
+        self.couch.handle('PUT', ['hypothesis', '_design', 'hypothesis'], {},
+                          ddoc)
+        self.make_backend(setup_marker_dir=None).fetch('test')
+        ddoc = self.couch.databases['hypothesis']['_design/hypothesis']
+        self.assertIn("typeof newdoc.value === 'string'",
+                      ddoc['validate_doc_update'])
+
+
+class FindCouchBackendTestCase(ExampleDBTestCase):
+
+    def view_requests(self):
+        return [req for req in self.couch.requests if '_view' in req[1]]
+
+    def test_save_fetch_delete(self):
+        backend = self.make_backend(lookup='find')
+        backend.save('test.foo', [1, 2])
+        backend.save('test.foo', [3])
+        backend.save('test.bar', [4])
+        self.assertEqual(sorted(backend.fetch('test.foo')), [[1, 2], [3]])
+        backend.delete('test.foo', [1, 2])
+        self.assertEqual(list(backend.fetch('test.foo')), [[3]])
+        self.assertEqual(list(backend.fetch('test.bar')), [[4]])
+        self.assertEqual(self.view_requests(), [])
+
+    def test_setup(self):
+        self.make_backend(lookup='find').fetch('test')
+        db = self.couch.databases['hypothesis']
+        self.assertNotIn('views', db['_design/hypothesis'])
+        self.assertIn('validate_doc_update', db['_design/hypothesis'])
+        self.assertEqual(db.mango_indexes, {'by_key': ['key']})
+
+    def test_view_is_kept(self):
+        self.make_backend().fetch('test')
+        self.make_backend(lookup='find').fetch('test')
+        ddoc = self.couch.databases['hypothesis']['_design/hypothesis']
+        self.assertIn('by_key', ddoc['views'])
+
+    def test_setup_marker_depends_on_lookup(self):
+        self.make_backend(lookup='find').fetch('test')
+        self.make_backend().save('test', [1])
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+        self.assertEqual(len(os.listdir(self.marker_dir)), 2)
+
+    def test_paging(self):
+        self.addCleanup(setattr, example_db, 'FIND_BATCH_SIZE',
+                        example_db.FIND_BATCH_SIZE)
+        example_db.FIND_BATCH_SIZE = 2
+        backend = self.make_backend(lookup='find')
+        for i in range(5):
+            backend.save('test', [i])
+        self.assertEqual(sorted(backend.fetch('test')),
+                         [[i] for i in range(5)])
+
+    def test_prefetch(self):
+        backend = self.make_backend(lookup='find')
+        backend.save('mod.Case.test_a', [1])
+        backend.save('mod.Case.test_b', [2])
+        backend.save('mod.Other.test_a', [3])
+        backend = self.make_backend(lookup='find', prefetch=True)
+        self.assertEqual(list(backend.fetch('mod.Case.test_a')), [[1]])
+        self.assertEqual(list(backend.fetch('mod.Case.test_b')), [[2]])
+        finds = [req for req in self.couch.requests
+                 if req == ('POST', '/hypothesis/_find')]
+        self.assertEqual(len(finds), 1)
+
+    def test_migrate(self):
+        self.make_backend().save('test', [1])
+        backend = self.make_backend(lookup='find', content_ids=True)
+        self.assertEqual(backend.migrate(), 1)
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_stream_is_not_used(self):
+        backend = self.make_backend(lookup='find', stream=True)
+        backend.save('test', [1])
+        self.assertEqual(backend.fetch('test'), [[1]])
+
+    def test_bad_lookup(self):
+        with self.assertRaises(ValueError):
+            example_db.CouchBackend(self.dburl, lookup='magic')
+
+
+class ViewUpdateCouchBackendTestCase(ExampleDBTestCase):
+
+    def wait_for_warmup(self, backend):
+        deadline = time.time() + 5
+        while backend._warmer is not None:
+            self.assertLess(time.time(), deadline, 'timed out')
+            time.sleep(0.01)
+
+    def test_stale_reads(self):
+        backend = self.make_backend(view_update='false')
+        backend.fetch('test')
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [])
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_lazy_reads(self):
+        backend = self.make_backend(view_update='lazy')
+        backend.fetch('test')
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_warmup(self):
+        backend = self.make_backend(view_update='false', warmup=True,
+                                    batch_size=10)
+        for i in range(10):
+            backend.save('test', [i])
+        self.wait_for_warmup(backend)
+        db = self.couch.databases['hypothesis']
+        updates = db.index_updates
+        self.assertEqual(len(backend.fetch('test')), 10)
+        backend.delete('test', [0])
+        self.wait_for_warmup(backend)
+        self.assertEqual(len(backend.fetch('test')), 9)
+        self.assertEqual(db.index_updates, updates + 1)
+
+    def test_warmup_find(self):
+        backend = self.make_backend(lookup='find', view_update='false',
+                                    warmup=True)
+        backend.save('test', [1])
+        self.wait_for_warmup(backend)
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+
+    def test_warmup_is_coalesced(self):
+        backend = self.make_backend(warmup=True)
+        backend.fetch('test')
+        del self.couch.requests[:]
+        with self.couch.lock:
+            # The first update waits for the server while others come.
+            for _ in range(5):
+                backend._warm_up()
+        self.wait_for_warmup(backend)
+        self.assertIn(len(self.couch.requests), (1, 2))
+        self.assertEqual(set(self.couch.requests), {
+            ('GET', '/hypothesis/_design/hypothesis/_view/by_key')})
+
+    def test_bad_view_update(self):
+        with self.assertRaises(ValueError):
+            example_db.CouchBackend(self.dburl, view_update='maybe')
+
+
+class RetentionCouchBackendTestCase(ExampleDBTestCase):
+
+    def age(self, key, value, seconds):
+        for doc in self.couch.databases['hypothesis'].values():
+            if doc.get('key') == [key] and doc.get('value') == value:
+                doc['saved_at'] -= seconds
+
+    def test_saved_at(self):
+        backend = self.make_backend()
+        backend.save('test', [1])
+        docs = [doc for doc in self.couch.databases['hypothesis'].values()
+                if doc.get('type') == 'example']
+        self.assertLessEqual(abs(docs[0]['saved_at'] - time.time()), 1)
+
+    def test_oversized_keys_are_pruned_on_close(self):
+        backend = self.make_backend(max_examples=2)
+        for i in range(4):
+            backend.save('test', [i])
+            self.age('test', [i], 10 * (4 - i))
+        backend.save('other', [1])
+        self.assertEqual(len(backend.fetch('test')), 4)
+        self.assertEqual(len(backend.fetch('other')), 1)
+        self.assertEqual(backend.oversized, {('test',)})
+        backend.close()
+        self.assertEqual(sorted(self.make_backend().fetch('test')),
+                         [[2], [3]])
+        self.assertEqual(backend.oversized, set())
+
+    def test_streamed_keys_are_noted(self):
+        backend = self.make_backend(max_examples=1, stream=True)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        self.assertEqual(len(list(backend.fetch('test'))), 2)
+        self.assertEqual(backend.oversized, {('test',)})
+
+    def test_prune_find(self):
+        backend = self.make_backend(lookup='find', max_examples=1)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        backend.save('test.foo', [1])
+        backend.save('test.foo', [2])
+        backend.save('test.bar', [1])
+        backend.save('test.bar', [2])
+        self.age('test', [1], 10)
+        for doc in self.couch.databases['hypothesis'].values():
+            if doc.get('key') == ['test', 'foo'] and doc['value'] == [1]:
+                doc['saved_at'] -= 10
+        self.assertEqual(backend.prune([['test'], ['test', 'foo']]), 2)
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+        self.assertEqual(list(backend.fetch('test.foo')), [[2]])
+        self.assertEqual(len(backend.fetch('test.bar')), 2)
+
+    def test_max_age_alone_prunes_on_close(self):
+        backend = self.make_backend(max_age=60)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        self.age('test', [1], 120)
+        backend.fetch('test')
+        backend.fetch('empty')
+        self.assertEqual(backend.oversized, {('test',)})
+        backend.close()
+        self.assertEqual(list(self.make_backend().fetch('test')), [[2]])
+
+    def test_resave_refreshes_save_time(self):
+        for kwargs in ({}, {'batch_size': 10}):
+            with self.subTest(**kwargs):
+                backend = self.make_backend(content_ids=True, max_age=60,
+                                            **kwargs)
+                backend.save('test', [1])
+                backend.flush()
+                self.age('test', [1], 120)
+                backend.save('test', [1])
+                backend.flush()
+                self.assertEqual(backend.prune([['test']]), 0)
+                self.assertEqual(list(backend.fetch('test')), [[1]])
+                backend.delete('test', [1])
+                backend.flush()
+
+    def test_prune_batches_keys(self):
+        backend = self.make_backend(max_age=60)
+        for i in range(5):
+            backend.save('test_%d' % i, [1])
+            self.age('test_%d' % i, [1], 120)
+        del self.couch.requests[:]
+        keys = [['test_%d' % i] for i in range(5)]
+        self.assertEqual(backend.prune(keys, batch_size=2), 5)
+        self.assertEqual(
+            self.couch.requests.count(
+                ('POST', '/hypothesis/_design/hypothesis/_view/by_key')),
+            3)
+
+    def test_dry_run(self):
+        backend = self.make_backend(max_age=60)
+        backend.save('test', [1])
+        self.age('test', [1], 120)
+        self.assertEqual(backend.prune([['test']], dry_run=True), 1)
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        self.assertEqual(backend.prune([['test']]), 1)
+        self.assertEqual(list(backend.fetch('test')), [])
+
+    def test_expired_docs(self):
+        docs = [{'key': ['a'], 'saved_at': 100},
+                {'key': ['a'], 'saved_at': 300},
+                {'key': ['a'], 'saved_at': 200},
+                {'key': ['a']},
+                {'key': ['b'], 'saved_at': 50}]
+        self.assertEqual(example_db.expired_docs(docs, max_examples=2),
+                         [docs[0], docs[3]])
+        self.assertEqual(example_db.expired_docs(docs, max_age=150, now=300),
+                         [docs[0], docs[4]])
+        self.assertEqual(example_db.expired_docs(docs), [])
+
+
+class InstrumentedCouchBackendTestCase(ExampleDBTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stream = io.StringIO()
+        self.instrumentation = instrumentation.Instrumentation(
+            stream=self.stream)
+
+    def test_operations(self):
+        backend = self.make_backend(instrumentation=self.instrumentation)
+        backend.save('test', [1])
+        backend.save('test', [2])
+        self.assertEqual(sorted(backend.fetch('test')), [[1], [2]])
+        backend.delete('test', [1])
+        summary = self.instrumentation.summary()
+        self.assertEqual(sorted(summary), ['delete', 'fetch', 'save',
+                                           'setup'])
+        self.assertEqual(summary['save']['calls'], 2)
+        self.assertEqual(summary['save']['requests'], 2)
+        self.assertEqual(summary['save']['statuses'], {201: 2})
+        self.assertGreater(summary['save']['bytes_sent'], 0)
+        self.assertEqual(summary['fetch']['requests'], 1)
+        self.assertGreater(summary['fetch']['bytes_received'], 0)
+        self.assertEqual(summary['delete']['requests'], 3)
+        self.assertEqual(summary['setup']['calls'], 1)
+        self.assertEqual(summary['setup']['statuses'], {404: 1, 201: 2})
+
+    def test_errors(self):
+        backend = self.make_backend(instrumentation=self.instrumentation)
+        backend.fetch('test')
+        del self.couch.databases['hypothesis']
+        with self.assertRaises(urllib.error.HTTPError):
+            backend.save('test', [1])
+        summary = self.instrumentation.summary()['save']
+        self.assertEqual((summary['calls'], summary['errors']), (1, 1))
+        self.assertEqual(summary['statuses'], {404: 1})
+        self.assertGreater(summary['bytes_received'], 0)
+
+    def test_stream(self):
+        backend = self.make_backend(instrumentation=self.instrumentation,
+                                    stream=True)
+        backend.save('test', [1])
+        self.assertEqual(list(backend.fetch('test')), [[1]])
+        summary = self.instrumentation.summary()['fetch']
+        self.assertEqual(summary['statuses'], {200: 1})
+        self.assertGreater(summary['bytes_received'], 0)
+
+    def test_hook(self):
+        events = []
+        backend = self.make_backend(
+            instrumentation=instrumentation.Instrumentation(
+                hook=events.append))
+        backend.save('test', [1])
+        requests = [(event['operation'], event['method'])
+                    for event in events if event['event'] == 'request']
+        self.assertEqual(requests[-1], ('save', 'PUT'))
+        self.assertEqual(events[-1]['event'], 'call')
+        self.assertEqual(events[-1]['operation'], 'save')
+
+    def test_close_dumps_report(self):
+        backend = self.make_backend(instrumentation=self.instrumentation)
+        backend.save('test', [1])
+        backend.close()
+        self.assertIn('save', self.stream.getvalue())
+
+    def test_mirror(self):
+        mirror = example_db.MirroredCouchBackend(
+            self.dburl, setup_marker_dir=self.marker_dir,
+            path=os.path.join(self.marker_dir, 'mirror.db'),
+            sync_interval=3600, instrumentation=self.instrumentation)
+        self.addCleanup(mirror.close)
+        mirror.save('test', [1])
+        mirror.sync()
+        summary = self.instrumentation.summary()
+        self.assertEqual(summary['save']['requests'], 0)
+        self.assertGreaterEqual(summary['sync']['calls'], 1)
+        self.assertGreater(summary['sync']['requests'], 0)
+
+
+class MirroredCouchBackendTestCase(ExampleDBTestCase):
+
+    def make_mirror(self, **kwargs):
+        kwargs.setdefault('setup_marker_dir', self.marker_dir)
+        kwargs.setdefault('path', os.path.join(self.marker_dir, 'mirror.db'))
+        kwargs.setdefault('sync_interval', 3600)
+        mirror = example_db.MirroredCouchBackend(self.dburl, **kwargs)
+        self.addCleanup(mirror.close)
+        return mirror
+
+    def test_works_offline(self):
+        self.couch.stop()
+        mirror = self.make_mirror()
+        mirror.save('test', [1])
+        mirror.save('test', [1])
+        mirror.save('test', [2])
+        mirror.delete('test', [1])
+        self.assertEqual(mirror.fetch('test'), [[2]])
+        with self.assertRaises(OSError):
+            mirror.sync()
+
+    def test_push(self):
+        mirror = self.make_mirror()
+        mirror.save('test', [1])
+        mirror.save('test', [2])
+        mirror.sync()
+        backend = self.make_backend()
+        self.assertEqual(sorted(backend.fetch('test')), [[1], [2]])
+        mirror.delete('test', [1])
+        mirror.sync()
+        self.assertEqual(list(backend.fetch('test')), [[2]])
+
+    def test_push_keeps_save_time(self):
+        mirror = self.make_mirror()
+        mirror.save('test', [1])
+        with mirror._cursor() as cursor:
+            cursor.execute('update examples set saved_at = 1000')
+        mirror.sync()
+        docs = [doc for doc in self.couch.databases['hypothesis'].values()
+                if doc.get('type') == 'example']
+        self.assertEqual([doc['saved_at'] for doc in docs], [1000])
+
+    def test_resave_refreshes_save_time(self):
+        mirror = self.make_mirror(max_age=60)
+        mirror.save('test', [1])
+        with mirror._cursor() as cursor:
+            cursor.execute('update examples set saved_at = 1000')
+        mirror.sync()
+        mirror.save('test', [1])
+        mirror.sync()
+        docs = [doc for doc in self.couch.databases['hypothesis'].values()
+                if doc.get('type') == 'example']
+        self.assertLessEqual(abs(docs[0]['saved_at'] - time.time()), 1)
+
+    def test_mirror_without_save_time_is_upgraded(self):
+        path = os.path.join(self.marker_dir, 'mirror.db')
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            create table examples(
+                id text primary key,
+                key text not null,
+                value text not null,
+                deleted integer not null default 0,
+                dirty integer not null default 0
+            );
+            insert into examples values('x', '["test"]', '[1]', 0, 1);
+        ''')
+        conn.close()
+        mirror = self.make_mirror(path=path)
+        self.assertEqual(mirror.fetch('test'), [[1]])
+        mirror.sync()
+        docs = [doc for doc in self.couch.databases['hypothesis'].values()
+                if doc.get('type') == 'example']
+        self.assertLessEqual(abs(docs[0]['saved_at'] - time.time()), 1)
+
+    def test_pull(self):
+        backend = self.make_backend()
+        backend.save('test', [1])
+        backend.save('test', [2])
+        mirror = self.make_mirror()
+        mirror.sync()
+        self.assertEqual(sorted(mirror.fetch('test')), [[1], [2]])
+        backend.delete('test', [1])
+        mirror.sync()
+        self.assertEqual(mirror.fetch('test'), [[2]])
+
+    def test_unpushed_changes_win(self):
+        backend = self.make_backend(content_ids=True)
+        backend.save('test', [1])
+        mirror = self.make_mirror()
+        mirror.sync()
+        # Background sync must not push the deletion meanwhile.
+        with mirror._sync_lock:
+            mirror.delete('test', [1])
+            docid = example_db.example_id(['test'], [1])
+            doc = dict(self.couch.databases['hypothesis'][docid],
+                       touched=True)
+            self.couch.handle('PUT', ['hypothesis', docid], {}, doc)
+            mirror._pull()
+            self.assertEqual(mirror.fetch('test'), [])
+        mirror.sync()
+        self.assertEqual(list(backend.fetch('test')), [])
+
+    def test_deleted_remotely_example_is_restored(self):
+        mirror = self.make_mirror()
+        mirror.save('test', [1])
+        mirror.sync()
+        self.make_backend(content_ids=True).delete('test', [1])
+        mirror.delete('test', [1])
+        mirror.save('test', [1])
+        mirror.sync()
+        self.assertEqual(mirror.fetch('test'), [[1]])
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+
+    def test_close_pushes_changes(self):
+        mirror = self.make_mirror()
+        mirror.fetch('test')
+        mirror.save('test', [1])
+        mirror.close()
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+        self.assertEqual(mirror.fetch('test'), [[1]])
+
+    def test_background_sync(self):
+        backend = self.make_backend()
+        backend.save('test', [1])
+        mirror = self.make_mirror(sync_interval=0.01)
+        deadline = time.time() + 5
+        while not mirror.fetch('test'):
+            self.assertLess(time.time(), deadline, 'timed out')
+            time.sleep(0.01)
+        self.assertEqual(mirror.fetch('test'), [[1]])
+
+
+class SpooledCouchBackendTestCase(ExampleDBTestCase):
+
+    def make_worker(self, **kwargs):
+        kwargs.setdefault('setup_marker_dir', self.marker_dir)
+        kwargs.setdefault('spool_dir', os.path.join(self.marker_dir, 'spool'))
+        kwargs.setdefault('flush_interval', None)
+        worker = example_db.SpooledCouchBackend(self.dburl, **kwargs)
+        self.addCleanup(worker.close)
+        return worker
+
+    def bulk_requests(self):
+        return [request for request in self.couch.requests
+                if request == ('POST', '/hypothesis/_bulk_docs')]
+
+    def test_writes_are_coalesced(self):
+        workers = [self.make_worker() for _ in range(3)]
+        for number, worker in enumerate(workers):
+            for i in range(5):
+                worker.save('mod.test_%d' % number, [i])
+        self.assertEqual(self.couch.requests, [])
+        workers[0].flush()
+        self.assertEqual(len(self.bulk_requests()), 1)
+        for number in range(3):
+            self.assertEqual(
+                sorted(self.make_backend().fetch('mod.test_%d' % number)),
+                [[i] for i in range(5)])
+        workers[1].flush()
+        self.assertEqual(len(self.bulk_requests()), 1)
+
+    def test_batch_size(self):
+        first, second = self.make_worker(batch_size=3), self.make_worker()
+        for i in range(3):
+            first.save('test', [i])
+            second.save('test', [i + 3])
+        # The first worker flushes 5 spooled writes on its third save.
+        self.assertEqual(len(self.bulk_requests()), 1)
+        self.assertEqual(len(self.make_backend().fetch('test')), 5)
+
+    def test_flush_interval(self):
+        worker = self.make_worker(flush_interval=0.05)
+        worker.save('test', [1])
+        deadline = time.time() + 5
+        while not self.bulk_requests():
+            self.assertLess(time.time(), deadline, 'timed out')
+            time.sleep(0.01)
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+
+    def test_last_write_wins(self):
+        first, second = self.make_worker(), self.make_worker()
+        first.save('test', [1])
+        first.save('test', [2])
+        second.delete('test', [1])
+        first.save('test', [3])
+        second.delete('test', [3])
+        first.save('test', [3])
+        second.flush()
+        self.assertEqual(sorted(self.make_backend().fetch('test')),
+                         [[2], [3]])
+
+    def test_deletes_are_flushed(self):
+        worker = self.make_worker()
+        worker.save('test', [1])
+        worker.save('test', [2])
+        worker.flush()
+        worker.delete('test', [1])
+        worker.close()
+        self.assertEqual(list(self.make_backend().fetch('test')), [[2]])
+
+    def test_shared_snapshot(self):
+        self.make_backend().save('mod.test_a', [1])
+        first, second = self.make_worker(), self.make_worker()
+        self.assertEqual(first.fetch('mod.test_a'), [[1]])
+        requests = len(self.couch.requests)
+        self.assertEqual(second.fetch('mod.test_a'), [[1]])
+        self.assertEqual(second.fetch('mod.test_b'), [])
+        self.assertEqual(len(self.couch.requests), requests)
+
+    def test_snapshot_sees_spooled_writes(self):
+        first, second = self.make_worker(), self.make_worker()
+        first.save('mod.test_a', [1])
+        self.assertEqual(first.fetch('mod.test_a'), [[1]])
+        second.save('mod.test_a', [2])
+        second.delete('mod.test_a', [1])
+        self.assertEqual(first.fetch('mod.test_a'), [[1]])
+        self.assertEqual(second.fetch('mod.test_a'), [[2]])
+        first.save('mod.test_a', [3])
+        self.assertEqual(sorted(first.fetch('mod.test_a')), [[1], [3]])
+
+    def test_flush_discards_snapshots(self):
+        first = self.make_worker()
+        self.assertEqual(first.fetch('mod.test_a'), [])
+        first.save('mod.test_a', [1])
+        first.flush()
+        self.assertEqual(self.make_worker().fetch('mod.test_a'), [[1]])
+
+    def test_snapshot_ttl(self):
+        first = self.make_worker(snapshot_ttl=0)
+        first.fetch('mod.test_a')
+        self.make_backend().save('mod.test_a', [1])
+        self.assertEqual(self.make_worker(snapshot_ttl=0).fetch('mod.test_a'),
+                         [[1]])
+
+    def test_failed_flush_keeps_writes(self):
+        worker = self.make_worker()
+        worker.save('test', [1])
+        self.couch.stop()
+        worker.close()
+        self.assertIsInstance(worker.flush_error, OSError)
+        self.assertEqual(len(os.listdir(worker.spool_dir)), 1)
+
+        self.couch = FakeCouchDB().start()
+        self.addCleanup(self.couch.stop)
+        self.dburl = self.couch.url + '/hypothesis'
+        self.make_worker(setup_marker_dir=None).flush()
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+
+    def test_failed_flush_on_batch_size_is_quiet(self):
+        worker = self.make_worker(batch_size=2)
+        worker.save('test', [1])
+        self.couch.stop()
+        worker.save('test', [2])
+        self.assertIsInstance(worker.flush_error, OSError)
+        self.assertEqual(len(worker._spooled_names()), 2)
+
+    def test_failed_flush_backs_off(self):
+        worker = self.make_worker(batch_size=2, flush_interval=0.05)
+        self.couch.stop()
+        flushes = []
+        flush = worker.flush
+        worker.flush = lambda: flushes.append(time.time()) or flush()
+        started = time.time()
+        for i in range(10):
+            worker.save('test', [i])
+        self.assertIsInstance(worker.flush_error, OSError)
+        self.assertLess(len(flushes), 3 + (time.time() - started) / 0.05)
+
+        # Retries go on without saves.
+        retries = len(flushes)
+        deadline = time.time() + 5
+        while len(flushes) == retries:
+            self.assertLess(time.time(), deadline, 'timed out')
+            time.sleep(0.01)
+
+    def test_resave_refreshes_save_time(self):
+        worker = self.make_worker(max_age=60)
+        worker.save('test', [1])
+        worker.flush()
+        for doc in self.couch.databases['hypothesis'].values():
+            if doc.get('type') == 'example':
+                doc['saved_at'] -= 120
+        worker.save('test', [1])
+        worker.flush()
+        self.assertEqual(self.make_backend(max_age=60).prune([['test']]), 0)
+
+    def test_packed(self):
+        worker = self.make_worker(packed=True)
+        worker.save('test', example_db.pack_value([1]))
+        worker.flush()
+        worker.delete('test', [1])
+        worker.flush()
+        self.assertEqual(list(self.make_backend().fetch('test')), [])
+
+    def test_example_db(self):
+        db = example_db.CouchExampleDB(
+            self.dburl, backend_class=example_db.SpooledCouchBackend,
+            spool_dir=os.path.join(self.marker_dir, 'spool'),
+            setup_marker_dir=self.marker_dir)
+        db.backend.save('test', [1])
+        self.assertEqual(db.backend.fetch('test'), [[1]])
+        db.close()
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+
+
+class FallbackBackendTestCase(ExampleDBTestCase):
+
+    def make_fallback(self, **kwargs):
+        # Timed out requests are still served, so retries must be idempotent.
+        backend = example_db.CouchBackend(self.dburl, timeout=0.05,
+                                          content_ids=True,
+                                          setup_marker_dir=self.marker_dir)
+        fallback = example_db.FallbackBackend(backend, **kwargs)
+        self.addCleanup(fallback.close)
+        return fallback
+
+    def test_passes_through(self):
+        fallback = self.make_fallback(max_failures=1)
+        fallback.save('test', [1])
+        fallback.save('test', [2])
+        fallback.delete('test', [1])
+        self.assertEqual(fallback.fetch('test'), [[2]])
+        self.assertFalse(fallback.degraded)
+        self.assertEqual(list(self.make_backend().fetch('test')), [[2]])
+
+    def test_failures_open_breaker(self):
+        fallback = self.make_fallback(max_failures=2, retry_interval=3600)
+        fallback.save('test', [1])
+        self.couch.latency = 0.2
+        self.assertEqual(fallback.fetch('test'), [[1]])
+        self.assertFalse(fallback.degraded)
+        fallback.save('test', [2])
+        self.assertTrue(fallback.degraded)
+        self.assertIsInstance(fallback.error, socket.timeout)
+
+        requests = len(self.couch.requests)
+        fallback.delete('test', [1])
+        fallback.save('test', [3])
+        self.assertEqual(fallback.fetch('test'), [[2], [3]])
+        self.assertEqual(len(self.couch.requests), requests)
+        self.assertEqual(fallback.queue, [('save', 'test', [2]),
+                                          ('delete', 'test', [1]),
+                                          ('save', 'test', [3])])
+
+    def test_replay_closes_breaker(self):
+        fallback = self.make_fallback(max_failures=1, retry_interval=0)
+        self.couch.latency = 0.2
+        fallback.save('test', [1])
+        self.assertTrue(fallback.degraded)
+        self.couch.latency = 0
+        fallback.save('test', [2])
+        self.assertFalse(fallback.degraded)
+        self.assertEqual(fallback.queue, [])
+        self.assertEqual(sorted(self.make_backend().fetch('test')),
+                         [[1], [2]])
+
+    def test_concurrent_replays_send_writes_once(self):
+        backend = example_db.CouchBackend(self.dburl,
+                                          setup_marker_dir=self.marker_dir)
+        fallback = example_db.FallbackBackend(backend)
+        self.addCleanup(fallback.close)
+        backend.fetch('test')
+        fallback.queue = [('save', 'test', [1]), ('save', 'test', [2])]
+        self.couch.latency = 0.1
+        threads = [threading.Thread(target=fallback.replay)
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fallback.queue, [])
+        self.assertEqual(sorted(self.make_backend().fetch('test')),
+                         [[1], [2]])
+
+    def test_queued_writes_are_fetched(self):
+        fallback = self.make_fallback(max_failures=3)
+        self.couch.latency = 0.2
+        fallback.save('test', [1])
+        self.couch.latency = 0
+        self.assertEqual(fallback.fetch('test'), [[1]])
+        self.assertFalse(fallback.degraded)
+
+    def test_close_replays_queue(self):
+        fallback = self.make_fallback(max_failures=1, retry_interval=3600)
+        self.couch.latency = 0.2
+        fallback.save('test', [1])
+        self.couch.latency = 0
+        fallback.close()
+        self.assertEqual(fallback.queue, [])
+        self.assertEqual(list(self.make_backend().fetch('test')), [[1]])
+
+    def test_budget(self):
+        fallback = self.make_fallback(budget=0.01, retry_interval=0)
+        fallback.save('test', [1])
+        self.couch.latency = 0.02
+        fallback.save('test', [2])
+        self.assertTrue(fallback.degraded)
+        self.assertTrue(fallback.exhausted)
+        self.couch.latency = 0
+        fallback.save('test', [3])
+        self.assertTrue(fallback.degraded)
+        fallback.close()
+        self.assertEqual(fallback.queue, [('save', 'test', [3])])
+        self.assertEqual(sorted(self.make_backend().fetch('test')),
+                         [[1], [2]])
+
+    def test_example_db(self):
+        db = example_db.CouchExampleDB(self.dburl, budget=10,
+                                       setup_marker_dir=self.marker_dir)
+        self.addCleanup(db.close)
+        self.assertIsInstance(db.backend, example_db.FallbackBackend)
+        self.assertIsInstance(db.backend.backend, example_db.CouchBackend)
+        db = example_db.CouchExampleDB(self.dburl)
+        self.addCleanup(db.close)
+        self.assertIsInstance(db.backend, example_db.CouchBackend)
+
+
+class ConnectionPoolTestCase(ExampleDBTestCase):
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            example_db.ConnectionPool(self.dburl, maxsize=0)
+
+    def test_http_error(self):
+        pool = example_db.ConnectionPool(self.dburl)
+        self.addCleanup(pool.close)
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            pool.urlopen('GET', self.dburl, {})
+        self.assertEqual(ctx.exception.code, 404)
+        self.assertEqual(len(pool._idle), 1)
+
+    def test_reconnects_on_closed_idle_connection(self):
+        pool = example_db.ConnectionPool(self.couch.url)
+        self.addCleanup(pool.close)
+        pool.urlopen('GET', self.couch.url, {})
+        pool._idle[0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(json.loads(
+            pool.urlopen('GET', self.couch.url, {}).decode()),
+            {'couchdb': 'Welcome'})
+
+    def test_threads_share_bounded_pool(self):
+        pool = example_db.ConnectionPool(self.couch.url, maxsize=2)
+        self.addCleanup(pool.close)
+
+        def worker():
+            for _ in range(20):
+                pool.urlopen('GET', self.couch.url, {})
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(len(pool._idle), 2)
+
+    def test_timeout(self):
+        pool = example_db.ConnectionPool(self.couch.url, timeout=0.05)
+        self.addCleanup(pool.close)
+        self.couch.latency = 0.2
+        with self.assertRaises(socket.timeout):
+            pool.urlopen('GET', self.couch.url, {})
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import hypothesis.strategies as st
+
+from hypothesis_couchdb.tests import (
+    generation_benchmark,
+)
+
+
+class GenerationBenchmarkTestCase(unittest.TestCase):
+
+    def test_run(self):
+        result = generation_benchmark.run(
+            examples=20, names=['json.numbers', 'document.rev'])
+        self.assertEqual([item['strategy'] for item in result['results']],
+                         ['document.rev', 'json.numbers'])
+        for item in result['results']:
+            self.assertEqual(item['examples'], 20)
+            self.assertGreater(item['examples_per_second'], 0)
+            self.assertGreater(item['average_bytes'], 0)
+
+    def test_all_strategies(self):
+        result = generation_benchmark.run(examples=1, timeout=0.1)
+        self.assertEqual(len(result['results']),
+                         len(generation_benchmark.strategies()))
+
+    def test_numbers_are_not_rejected(self):
+        result = generation_benchmark.measure(
+            generation_benchmark.strategies()['json.numbers'], 1000)
+        self.assertEqual(result['rejected'], 0)
+
+    def test_encoded_documents(self):
+        result = generation_benchmark.measure(
+            generation_benchmark.strategies()['document.encoded_documents'],
+            20)
+        self.assertEqual(result['examples'], 20)
+        self.assertGreater(result['average_bytes'], 0)
+
+    def test_rejections(self):
+        result = generation_benchmark.measure(
+            st.integers(min_value=0, max_value=1).filter(bool), 10)
+        self.assertEqual(result['examples'], 10)
+        self.assertGreater(result['rejected'], 0)
+        self.assertGreater(result['rejection_ratio'], 0)
+
+    def test_timeout(self):
+        result = generation_benchmark.measure(
+            st.just(1).map(lambda x: time.sleep(1)), 2, timeout=0.01)
+        self.assertEqual((result['examples'], result['timed_out']), (0, 2))
+        self.assertLess(result['seconds'], 1)
+
+    def test_compare(self):
+        old = {'results': [{'strategy': 'json.values',
+                            'examples_per_second': 100,
+                            'rejection_ratio': 0.1,
+                            'timed_out': 1}]}
+        new = {'results': [{'strategy': 'json.values',
+                            'examples_per_second': 150,
+                            'rejection_ratio': 0.0,
+                            'timed_out': 0},
+                           {'strategy': 'json.nulls',
+                            'examples_per_second': 150,
+                            'rejection_ratio': 0.0,
+                            'timed_out': 0}]}
+        self.assertEqual(generation_benchmark.compare(old, new), [
+            {'strategy': 'json.values', 'old': 100, 'new': 150,
+             'ratio': 1.5, 'old_rejection_ratio': 0.1,
+             'new_rejection_ratio': 0.0, 'old_timed_out': 1,
+             'new_timed_out': 0}])
+
+    def test_main(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        output = os.path.join(tmpdir.name, 'results.json')
+        generation_benchmark.main(['--examples', '5',
+                                   '--strategy', 'json.nulls',
+                                   '-o', output])
+        with open(output) as fobj:
+            result = json.load(fobj)
+        self.assertEqual(result['results'][0]['strategy'], 'json.nulls')
+        stdout = io.StringIO()
+        with unittest.mock.patch('sys.stdout', stdout):
+            generation_benchmark.main(['--compare', output, output])
+        self.assertEqual([item['ratio'] for item in json.loads(
+            stdout.getvalue())], [1.0])
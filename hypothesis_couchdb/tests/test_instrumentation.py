@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import io
+import unittest
+
+from hypothesis_couchdb import (
+    instrumentation,
+)
+
+
+class Dummy(object):
+
+    def __init__(self, instrumentation=None):
+        self.instrumentation = instrumentation
+
+    @instrumentation.instrumented('work')
+    def work(self, fail=False):
+        if fail:
+            raise RuntimeError('boom')
+        return 42
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def test_operation(self):
+        events = []
+        stats = instrumentation.Instrumentation(hook=events.append)
+        with stats.operation('save'):
+            self.assertEqual(stats.current_operation, 'save')
+            with stats.operation('setup'):
+                self.assertEqual(stats.current_operation, 'setup')
+            self.assertEqual(stats.current_operation, 'save')
+        self.assertIsNone(stats.current_operation)
+        self.assertEqual([(event['event'], event['operation'])
+                          for event in events],
+                         [('call', 'setup'), ('call', 'save')])
+        self.assertEqual(stats.summary()['save']['calls'], 1)
+
+    def test_operation_error(self):
+        stats = instrumentation.Instrumentation()
+        with self.assertRaises(RuntimeError):
+            with stats.operation('fetch'):
+                raise RuntimeError('boom')
+        summary = stats.summary()['fetch']
+        self.assertEqual((summary['calls'], summary['errors']), (1, 1))
+
+    def test_record_request(self):
+        stats = instrumentation.Instrumentation()
+        stats.record_request('fetch', 'GET', 'http://localhost/db', 200,
+                             0, 100, 0.003)
+        stats.record_request('fetch', 'GET', 'http://localhost/db', 404,
+                             0, 50, 0.2)
+        stats.record_request(None, 'GET', 'http://localhost/db', None,
+                             0, 0, 1)
+        summary = stats.summary()
+        self.assertEqual(summary['fetch']['requests'], 2)
+        self.assertEqual(summary['fetch']['bytes_received'], 150)
+        self.assertEqual(summary['fetch']['statuses'], {200: 1, 404: 1})
+        self.assertEqual(summary['fetch']['request_latency']['max'], 0.2)
+        self.assertEqual(summary['other']['statuses'], {None: 1})
+
+    def test_summary_is_a_copy(self):
+        stats = instrumentation.Instrumentation()
+        stats.record_call('save', 0.1)
+        stats.summary()['save']['latency']['histogram'][0] = 100
+        self.assertEqual(stats.summary()['save']['latency']['histogram'][0],
+                         0)
+
+    def test_report_and_dump(self):
+        stream = io.StringIO()
+        stats = instrumentation.Instrumentation(stream=stream)
+        stats.record_call('save', 0.01)
+        stats.record_request('save', 'PUT', 'http://localhost/db/x', 201,
+                             10, 20, 0.01)
+        stats.dump()
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('operation'))
+        self.assertTrue(lines[1].startswith('save'))
+        self.assertIn('201:1', lines[1])
+
+    def test_instrumented(self):
+        self.assertEqual(Dummy().work(), 42)
+        stats = instrumentation.Instrumentation()
+        dummy = Dummy(stats)
+        self.assertEqual(dummy.work(), 42)
+        with self.assertRaises(RuntimeError):
+            dummy.work(fail=True)
+        summary = stats.summary()['work']
+        self.assertEqual((summary['calls'], summary['errors']), (2, 1))
+
+    def test_percentile(self):
+        latency = instrumentation.new_latency()
+        self.assertEqual(instrumentation.percentile(latency, 0.95), 0)
+        for duration in [0.002] * 19 + [0.3]:
+            instrumentation.add_latency(latency, duration)
+        self.assertEqual(instrumentation.percentile(latency, 0.5), 0.0025)
+        self.assertEqual(instrumentation.percentile(latency, 1), 0.3)
+        self.assertAlmostEqual(instrumentation.mean(latency), 0.0169)
@@ -13,6 +13,7 @@
 # the License.
 #
 
+import json as stdjson
 import math
 import unittest
 
@@ -43,6 +44,21 @@ class JsonTestCase(unittest.TestCase):
     def test_numbers(self, value):
         self.check_number(value)
 
+    @hypothesis.given(json.numbers(min_value=1e308))
+    def test_numbers_with_min_value(self, value):
+        self.check_number(value)
+        self.assertGreaterEqual(value, 1e308)
+
+    @hypothesis.given(json.numbers(max_value=-1e308))
+    def test_numbers_with_max_value(self, value):
+        self.check_number(value)
+        self.assertLessEqual(value, -1e308)
+
+    @hypothesis.given(json.numbers(min_value=-1.5, max_value=2.5))
+    def test_numbers_within_bounds(self, value):
+        self.check_number(value)
+        self.assertTrue(-1.5 <= value <= 2.5)
+
     def test_strings(self):
         st = json.strings()
         value = hypothesis.find(st, lambda _: True)
@@ -85,6 +101,20 @@ class JsonTestCase(unittest.TestCase):
             lambda v: v['always'] and 'maybe' in v),
             {'always': True, 'maybe': False})
 
+    def test_objects_optional_fields_shrink_independently(self):
+        st = json.objects(optional_fields={'a': json.nulls(),
+                                           'b': json.booleans(),
+                                           'c': json.nulls()})
+        self.assertEqual(hypothesis.find(st, lambda v: 'b' in v),
+                         {'b': False})
+
+    @hypothesis.given(json.objects(json.booleans(),
+                                   required_fields={'': json.nulls()},
+                                   optional_fields={'a': json.nulls()}))
+    def test_objects_fields_override_random_ones(self, value):
+        self.assertIsNone(value[''])
+        self.assertIn(value.get('a', None), (None, True, False))
+
     def test_objects_requires_any_fields_definition(self):
         with self.assertRaises(RuntimeError):
             json.objects()
@@ -97,6 +127,136 @@ class JsonTestCase(unittest.TestCase):
         with self.assertRaises(TypeError):
             json.objects(optional_fields={42: 24})
 
+    def test_values(self):
+        self.assertIsNone(hypothesis.find(json.values(), lambda _: True))
+
+    @hypothesis.given(json.values())
+    def test_values_measure(self, value):
+        depth, leaves, size = json.measure(value)
+        self.assertEqual(size, len(stdjson.dumps(value)))
+        self.assertLessEqual(leaves, 100)
+
+    @hypothesis.given(json.values(max_depth=2, max_leaves=10,
+                                  max_encoded_bytes=200))
+    def test_values_within_limits(self, value):
+        depth, leaves, size = json.measure(value)
+        self.assertLessEqual(depth, 2)
+        self.assertLessEqual(leaves, 10)
+        self.assertLessEqual(size, 200)
+
+    def test_values_are_nested(self):
+        value = hypothesis.find(
+            json.values(max_depth=2),
+            lambda v: isinstance(v, list) and any(isinstance(x, dict) and x
+                                                  for x in v))
+        self.assertEqual(value, [{'': None}])
+
+    @hypothesis.given(json.values(max_depth=0))
+    def test_values_without_depth_are_scalars(self, value):
+        self.assertNotIsInstance(value, (list, dict))
+
+    def test_values_with_bad_limits(self):
+        with self.assertRaises(ValueError):
+            json.values(max_depth=-1)
+        with self.assertRaises(ValueError):
+            json.values(max_leaves=-1)
+        with self.assertRaises(ValueError):
+            json.values(max_encoded_bytes=3)
+
+    def test_build_value_leaves_out_what_does_not_fit(self):
+        tokens = [(json.ARRAY, '', None),
+                  (json.LEAF, '', 'too long string'),
+                  (json.ARRAY, '', None),
+                  (json.LEAF, '', 1),
+                  (json.ARRAY, '', None),
+                  (json.LEAF, '', 2),
+                  (json.CLOSE, '', None),
+                  (json.CLOSE, '', None),
+                  (json.LEAF, '', 3),
+                  (json.CLOSE, '', None),
+                  (json.LEAF, '', 4)]
+        self.assertEqual(json.build_value(tokens), [
+            'too long string', [1, [2]], 3])
+        self.assertEqual(json.build_value(tokens, max_encoded_bytes=8),
+                         [[1], 3])
+        self.assertEqual(json.build_value(tokens, max_depth=1,
+                                          max_leaves=1),
+                         ['too long string'])
+        self.assertEqual(json.build_value(tokens, max_depth=0), 4)
+
+    def test_build_value_default(self):
+        tokens = iter([(json.LEAF, '', 'too long string'),
+                       (json.LEAF, '', 1)])
+        self.assertEqual(json.build_value(tokens, max_encoded_bytes=4,
+                                          default=json.ABSENT), 1)
+        self.assertIs(json.build_value(tokens, default=json.ABSENT),
+                      json.ABSENT)
+
+    @hypothesis.given(json.arrays(json.values(max_leaves=5),
+                                  max_depth=3, max_leaves=20,
+                                  max_encoded_bytes=300))
+    def test_arrays_within_limits(self, value):
+        self.assertIsInstance(value, list)
+        depth, leaves, size = json.measure(value)
+        self.assertLessEqual(depth, 3)
+        self.assertLessEqual(leaves, 20)
+        self.assertLessEqual(size, 300)
+
+    @hypothesis.given(json.arrays(json.values(max_depth=1, max_leaves=1),
+                                  max_encoded_bytes=1000))
+    def test_arrays_keep_limits_of_elements(self, value):
+        for item in value:
+            depth, leaves, _ = json.measure(item)
+            self.assertLessEqual(depth, 1)
+            self.assertLessEqual(leaves, 1)
+
+    def test_arrays_draw_no_more_elements_than_fit(self):
+        st = json.arrays(json.nulls(), min_size=10, max_encoded_bytes=20)
+        self.assertEqual(hypothesis.find(st, lambda _: True), [None] * 3)
+
+    def test_max_items(self):
+        self.assertEqual(json.max_items(None, None, 20, json.MIN_ITEM_SIZE),
+                         6)
+        self.assertEqual(json.max_items(1, 2, 20, json.MIN_ITEM_SIZE), 2)
+        self.assertIsNone(json.max_items(2, 2, None, json.MIN_ITEM_SIZE))
+
+    def test_arrays_with_bad_limits(self):
+        with self.assertRaises(ValueError):
+            json.arrays(json.nulls(), max_depth=0)
+
+    @hypothesis.given(json.objects(json.values(max_leaves=5),
+                                   required_fields={'a': json.nulls()},
+                                   optional_fields={'b': json.strings()},
+                                   max_depth=3, max_leaves=20,
+                                   max_encoded_bytes=300))
+    def test_objects_within_limits(self, value):
+        self.assertIsNone(value['a'])
+        depth, leaves, size = json.measure(value)
+        self.assertLessEqual(depth, 3)
+        self.assertLessEqual(leaves, 20)
+        self.assertLessEqual(size, 300)
+
+    @hypothesis.given(json.objects(json.values(max_depth=0),
+                                   max_encoded_bytes=1000))
+    def test_objects_keep_limits_of_random_fields(self, value):
+        for item in value.values():
+            self.assertNotIsInstance(item, (list, dict))
+
+    def test_objects_keep_required_fields_out_of_limits(self):
+        st = json.objects(required_fields={'a': json.strings(min_size=10)},
+                          optional_fields={'b': json.nulls()},
+                          max_encoded_bytes=10)
+        self.assertEqual(hypothesis.find(st, lambda _: True),
+                         {'a': '0' * 10})
+        with self.assertRaises(NoSuchExample):
+            hypothesis.find(st, lambda v: 'b' in v)
+
+    def test_encode(self):
+        self.assertEqual(json.encode({'b': [1.5, True], 'a': 'ё'}),
+                         b'{"a":"\\u0451","b":[1.5,true]}')
+        with self.assertRaises(ValueError):
+            json.encode(float('nan'))
+
     def check_number(self, value):
         self.assertIsInstance(value, (int, float))
         self.assertFalse(math.isinf(value))
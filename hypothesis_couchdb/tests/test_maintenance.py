@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+#
+
+import contextlib
+import io
+import unittest
+
+from hypothesis_couchdb import (
+    example_db,
+    maintenance,
+)
+from hypothesis_couchdb.tests.fake_couchdb import (
+    FakeCouchDB,
+)
+
+
+class MaintenanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = FakeCouchDB().start()
+        self.addCleanup(self.couch.stop)
+        self.dburl = self.couch.url + '/hypothesis'
+        backend = example_db.CouchBackend(self.dburl, setup_marker_dir=None)
+        for i in range(5):
+            backend.save('a', [i])
+        for i in range(2):
+            backend.save('b', [i])
+        backend.close()
+        for doc in self.couch.databases['hypothesis'].values():
+            if doc.get('type') == 'example':
+                doc['saved_at'] -= 86400 * (10 - doc['value'][0])
+
+    def make_backend(self, **kwargs):
+        backend = example_db.CouchBackend(self.dburl, setup_marker_dir=None,
+                                          **kwargs)
+        self.addCleanup(backend.close)
+        return backend
+
+    def fetch(self, key):
+        return sorted(self.make_backend().fetch(key))
+
+    def test_key_counts(self):
+        self.assertEqual(maintenance.key_counts(self.make_backend()),
+                         [(['a'], 5), (['b'], 2)])
+
+    def test_prune_max_examples(self):
+        backend = self.make_backend(max_examples=3)
+        self.assertEqual(maintenance.prune(backend, batch_size=1), 2)
+        self.assertEqual(self.fetch('a'), [[2], [3], [4]])
+        self.assertEqual(self.fetch('b'), [[0], [1]])
+
+    def test_prune_max_age(self):
+        backend = self.make_backend(max_age=86400 * 8.5)
+        self.assertEqual(maintenance.prune(backend), 4)
+        self.assertEqual(self.fetch('a'), [[2], [3], [4]])
+        self.assertEqual(self.fetch('b'), [])
+
+    def test_compact(self):
+        maintenance.compact(self.make_backend())
+        self.assertEqual(self.couch.databases['hypothesis'].compactions,
+                         ['_compact', '_compact/hypothesis', '_view_cleanup'])
+
+    def test_main(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            maintenance.main([self.dburl, '--max-examples', '1', '--dry-run'])
+        self.assertEqual(output.getvalue(), 'Would delete 5 examples\n')
+        self.assertEqual(len(self.fetch('a')), 5)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            maintenance.main([self.dburl, '--max-age', '7.5', '--compact'])
+        self.assertEqual(output.getvalue(),
+                         'Deleted 5 examples\nCompaction started\n')
+        self.assertEqual(self.fetch('a'), [[3], [4]])
+        self.assertEqual(len(self.couch.databases['hypothesis'].compactions),
+                         3)
+
+    def test_nothing_to_do(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                maintenance.main([self.dburl])